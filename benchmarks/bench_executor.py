@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+线程池开销基准测试
+================
+
+对比每次调用新建 ThreadPoolExecutor 与复用共享线程池的单次调用开销。
+服务调用使用空操作替代，因此测得的是纯粹的调度开销。
+
+运行方式:
+    python benchmarks/bench_executor.py --iterations 2000
+"""
+
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+# 添加父级目录到路径，以便可以导入stable_llm_service
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stable_llm_service import StableLLMService
+
+
+class NoopService:
+    """不发起网络请求的空服务"""
+
+    def chat(self, prompt):
+        return {"raw_content": prompt}
+
+
+def per_attempt_executor(iterations: int) -> float:
+    """旧实现: 每次调用都创建并关闭线程池"""
+    service = NoopService()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        with ThreadPoolExecutor() as executor:
+            executor.submit(service.chat, "ping").result(timeout=10.0)
+    return time.perf_counter() - start
+
+
+def shared_executor(iterations: int) -> float:
+    """新实现: 通过StableLLMService复用共享线程池"""
+    with patch("stable_llm_service.ServiceFactory.create_service", return_value=NoopService()):
+        with StableLLMService(openai_api_key="bench", service_order=["openai"]) as service:
+            # 预热，创建工作线程
+            service._call_with_timeout("openai_primary", "chat", "ping")
+            start = time.perf_counter()
+            for _ in range(iterations):
+                service._call_with_timeout("openai_primary", "chat", "ping")
+            return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="线程池单次调用开销基准测试")
+    parser.add_argument("--iterations", type=int, default=2000, help="调用次数")
+    args = parser.parse_args()
+
+    before = per_attempt_executor(args.iterations)
+    after = shared_executor(args.iterations)
+
+    print(f"调用次数: {args.iterations}")
+    print(f"每次新建线程池: {before / args.iterations * 1e6:.1f} µs/次")
+    print(f"共享线程池:     {after / args.iterations * 1e6:.1f} µs/次")
+    print(f"加速比: {before / after:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
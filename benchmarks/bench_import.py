@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+导入耗时基准测试
+==============
+
+使用 `python -X importtime` 在全新的解释器中导入stable_llm_service，
+报告模块自身及其依赖的累计导入耗时，并检查提供商SDK和PIL没有在导入时被加载。
+
+运行方式:
+    python benchmarks/bench_import.py --runs 5
+    python benchmarks/bench_import.py --max-ms 150  # 超过阈值时以非零状态退出
+"""
+
+import os
+import sys
+import argparse
+import subprocess
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 导入stable_llm_service时不应加载的模块
+HEAVY_MODULES = ("openai", "anthropic", "google.generativeai", "PIL", "dotenv")
+
+CHECK_SCRIPT = (
+    "import sys, logging, stable_llm_service; "
+    "loaded = [m for m in {modules!r} if m in sys.modules]; "
+    "print(','.join(loaded)); "
+    "print(len(logging.getLogger().handlers))"
+)
+
+
+def import_time_us() -> int:
+    """在新解释器中导入一次，返回stable_llm_service的累计导入耗时(微秒)"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import stable_llm_service"],
+        cwd=ROOT, capture_output=True, text=True, check=True
+    )
+    for line in result.stderr.splitlines():
+        # 格式: "import time: self [us] | cumulative | imported package"
+        parts = [part.strip() for part in line.split("|")]
+        if len(parts) == 3 and parts[2] == "stable_llm_service":
+            return int(parts[1])
+    raise RuntimeError("importtime输出中未找到stable_llm_service")
+
+
+def check_side_effects():
+    """返回导入后已加载的重量级模块和根日志处理器数量"""
+    result = subprocess.run(
+        [sys.executable, "-c", CHECK_SCRIPT.format(modules=HEAVY_MODULES)],
+        cwd=ROOT, capture_output=True, text=True, check=True
+    )
+    loaded, handlers = result.stdout.splitlines()
+    return [m for m in loaded.split(",") if m], int(handlers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="stable_llm_service导入耗时基准测试")
+    parser.add_argument("--runs", type=int, default=5, help="重复导入次数")
+    parser.add_argument("--max-ms", type=float, default=None, help="导入耗时中位数上限(毫秒)")
+    args = parser.parse_args()
+
+    samples = [import_time_us() / 1000 for _ in range(args.runs)]
+    median = statistics.median(samples)
+    loaded, handlers = check_side_effects()
+
+    print(f"导入次数: {args.runs}")
+    print(f"累计导入耗时: 中位数 {median:.1f} ms, 最小 {min(samples):.1f} ms, 最大 {max(samples):.1f} ms")
+    print(f"导入时加载的重量级模块: {', '.join(loaded) or '无'}")
+    print(f"根日志处理器数量: {handlers}")
+
+    failed = bool(loaded) or handlers > 0
+    if args.max_ms is not None and median > args.max_ms:
+        print(f"导入耗时超过阈值 {args.max_ms} ms")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -15,12 +15,21 @@ import os
 import sys
 import argparse
 import json
-from PIL import Image
+import logging
 
-from .stable_llm_service import StableLLMService
+from .stable_llm_service import StableLLMService, PreparedImage
+
+def _configure_logging():
+    """配置命令行工具的日志输出(库本身在导入时不配置日志)"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[logging.StreamHandler()]
+    )
 
 def chat_command():
     """提供交互式聊天命令行界面"""
+    _configure_logging()
     parser = argparse.ArgumentParser(description="与大模型进行聊天")
     parser.add_argument("--timeout", type=float, default=15.0, help="服务超时时间(秒)")
     parser.add_argument("--service-order", type=str, help="逗号分隔的服务调用顺序，例如：openai,anthropic,gemini")
@@ -86,6 +95,7 @@ def chat_command():
 
 def analyze_command():
     """提供图像分析命令行界面"""
+    _configure_logging()
     parser = argparse.ArgumentParser(description="使用大模型分析图像")
     parser.add_argument("image", help="要分析的图像文件路径")
     parser.add_argument("--prompt", default="描述这张图片。你看到了什么？", help="分析提示词")
@@ -99,9 +109,9 @@ def analyze_command():
         print(f"错误: 图像文件'{args.image}'不存在")
         sys.exit(1)
     
-    # 加载图像
+    # 检查图像能否识别，只读取文件头
     try:
-        image = Image.open(args.image)
+        PreparedImage(args.image).validate()
     except Exception as e:
         print(f"加载图像失败: {str(e)}")
         sys.exit(1)
@@ -124,8 +134,8 @@ def analyze_command():
     
     print(f"正在分析图像 '{args.image}'...")
     
-    # 发送图像分析请求
-    response = service.analyze(args.prompt, image)
+    # 发送图像分析请求，直接传递文件路径，可接受的格式无需解码即可上传
+    response = service.analyze(args.prompt, args.image)
     
     # 输出结果
     if args.json:
@@ -38,52 +38,89 @@ import json
 import random
 import logging
 import functools
+import importlib
+import hashlib
+import unicodedata
+import math
 from enum import Enum
-from typing import Dict, List, Optional, Any, Callable, Union, Tuple
-from concurrent.futures import ThreadPoolExecutor, TimeoutError
-from dataclasses import dataclass
+from typing import Dict, List, Optional, Any, Callable, Union, Tuple, Iterable, Iterator, Mapping, Sequence
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, wait, FIRST_COMPLETED
+from collections import deque, OrderedDict
+from itertools import islice
+from dataclasses import dataclass, field, fields, replace
+from types import MappingProxyType
 import base64
 from io import BytesIO
 import os
 import sys
+import mmap
+import sqlite3
+import threading
 
-# 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler()]
-)
 logger = logging.getLogger("StableLLMService")
 
-# 尝试导入并加载.env文件
-try:
-    from dotenv import load_dotenv
-    # 尝试加载.env文件中的环境变量
+# =======================
+# 延迟导入
+# =======================
+
+# 各提供商SDK和PIL在首次构建对应服务或解码图像时才导入，模块导入本身没有副作用。
+# 导入后的模块保存在同名的模块级变量中
+openai = None
+anthropic = None
+genai = None
+Image = None
+httpx = None
+tomllib = None
+
+# 变量名 -> (模块路径, pip安装名)
+_LAZY_MODULES = {
+    "openai": ("openai", "openai"),
+    "anthropic": ("anthropic", "anthropic"),
+    "genai": ("google.generativeai", "google-generativeai"),
+    "Image": ("PIL.Image", "pillow"),
+    "httpx": ("httpx", "httpx"),
+    # Python 3.11起标准库自带tomllib，更早的版本使用接口相同的tomli
+    "tomllib": ("tomllib" if sys.version_info >= (3, 11) else "tomli", "tomli"),
+}
+
+def _lazy_import(name: str):
+    """
+    导入并返回延迟加载的依赖模块
+    
+    Args:
+        name: 模块级变量名，如"openai"或"Image"
+        
+    Returns:
+        导入的模块
+        
+    Raises:
+        ImportError: 依赖未安装
+    """
+    module = globals()[name]
+    if module is None:
+        module_path, package = _LAZY_MODULES[name]
+        try:
+            module = importlib.import_module(module_path)
+        except ImportError as e:
+            raise ImportError(f"未安装{module_path}，请运行: pip install {package}") from e
+        globals()[name] = module
+    return module
+
+_dotenv_loaded = False
+
+def load_env_file() -> None:
+    """加载.env文件中的环境变量，只在首次调用时执行"""
+    global _dotenv_loaded
+    if _dotenv_loaded:
+        return
+    _dotenv_loaded = True
+    try:
+        from dotenv import load_dotenv
+    except ImportError:
+        logger.debug("未安装python-dotenv库，跳过加载.env文件")
+        return
     load_dotenv()
     logger.info("已尝试加载.env文件中的环境变量")
-except ImportError:
-    logger.warning("未安装python-dotenv库，无法自动加载.env文件。请运行: pip install python-dotenv")
-
-# 尝试导入大模型依赖，如果不存在则提供安装指南
-try:
-    import openai
-except ImportError:
-    logger.warning("未安装OpenAI SDK，请运行: pip install openai")
-
-try:
-    import anthropic
-except ImportError:
-    logger.warning("未安装Anthropic SDK，请运行: pip install anthropic")
-
-try:
-    import google.generativeai as genai
-except ImportError:
-    logger.warning("未安装Google Generative AI SDK，请运行: pip install google-generativeai")
-
-try:
-    from PIL import Image
-except ImportError:
-    logger.warning("未安装PIL库，请运行: pip install pillow")
 
 # =======================
 # 配置数据结构
@@ -99,489 +136,3763 @@ class LLMServiceConfig:
     temperature: float = 0.5
     timeout: float = 15.0  # 超时时间(秒)
     is_primary: bool = True  # 是否为主要服务
+    http_pool: Optional["HTTPClientPool"] = None  # 同一提供商各模型共享的HTTP连接池
+    key_pool: Optional["APIKeyPool"] = None  # 同一提供商各模型共享的API密钥池，默认只使用api_key
 
 # =======================
 # 服务健康监控器
 # =======================
 
+class SlidingWindow:
+    """
+    按时间分桶的调用结果环形缓冲区
+    
+    窗口被等分为bucket_count个桶，每个桶累计该时间段内的调用数、失败数和慢调用数，
+    同时维护整个窗口的总计。记录时只清理过期的桶，单次记录的摊还开销为O(1)。
+    """
+    
+    def __init__(self, window_size: float = 60.0, bucket_count: int = 10):
+        """
+        Args:
+            window_size: 窗口长度(秒)
+            bucket_count: 桶数量，决定窗口滑动的粒度
+        """
+        if window_size <= 0 or bucket_count < 1:
+            raise ValueError("window_size必须大于0且bucket_count必须大于等于1")
+        self.bucket_width = window_size / bucket_count
+        self.bucket_count = bucket_count
+        self._calls = [0] * bucket_count
+        self._failures = [0] * bucket_count
+        self._slow = [0] * bucket_count
+        self._epoch = None  # 最近一次写入的桶序号
+        self.calls = 0
+        self.failures = 0
+        self.slow_calls = 0
+    
+    def _advance(self, now: float) -> int:
+        """将窗口推进到now所在的桶，清空期间过期的桶，返回该桶的下标"""
+        epoch = int(now // self.bucket_width)
+        if self._epoch is None or epoch - self._epoch >= self.bucket_count:
+            self.reset()
+        elif epoch > self._epoch:
+            for expired in range(self._epoch + 1, epoch + 1):
+                index = expired % self.bucket_count
+                self.calls -= self._calls[index]
+                self.failures -= self._failures[index]
+                self.slow_calls -= self._slow[index]
+                self._calls[index] = self._failures[index] = self._slow[index] = 0
+        if self._epoch is None or epoch > self._epoch:
+            self._epoch = epoch
+        return epoch % self.bucket_count
+    
+    def record(self, success: bool, slow: bool = False, now: Optional[float] = None) -> None:
+        """记录一次调用结果"""
+        index = self._advance(time.time() if now is None else now)
+        self._calls[index] += 1
+        self.calls += 1
+        if not success:
+            self._failures[index] += 1
+            self.failures += 1
+        if slow:
+            self._slow[index] += 1
+            self.slow_calls += 1
+    
+    def rates(self, now: Optional[float] = None) -> Tuple[int, float, float]:
+        """窗口内的(调用数, 失败率, 慢调用率)"""
+        self._advance(time.time() if now is None else now)
+        if not self.calls:
+            return 0, 0.0, 0.0
+        return self.calls, self.failures / self.calls, self.slow_calls / self.calls
+    
+    def reset(self) -> None:
+        """清空窗口"""
+        for counts in (self._calls, self._failures, self._slow):
+            counts[:] = [0] * self.bucket_count
+        self._epoch = None
+        self.calls = self.failures = self.slow_calls = 0
+
+class _BreakerState:
+    """单个服务的断路器状态，字段只在持有lock时修改"""
+    
+    __slots__ = (
+        "lock", "state", "failures", "disabled_until", "trips",
+        "probes", "probe_granted_at", "transitions", "window"
+    )
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.state = ServiceHealthMonitor.CLOSED
+        self.failures = 0  # 连续失败次数
+        self.disabled_until = 0.0  # 打开状态的结束时间
+        self.trips = 0  # 连续打开断路器的次数，用于计算冷却期
+        self.probes = 0  # 半开状态下已放行且未返回结果的探测数
+        self.probe_granted_at = 0.0  # 最近一次放行探测的时间
+        self.transitions = deque(maxlen=10)  # 最近的状态转换记录
+        self.window = None  # SlidingWindow，只在启用按比率触发时创建
+
 class ServiceHealthMonitor:
-    """服务健康监控，实现断路器模式"""
+    """
+    服务健康监控，实现带半开状态的断路器
+    
+    连续失败达到阈值后断路器打开(open)，冷却期内服务不可用；冷却期结束后进入
+    半开状态(half_open)，只放行half_open_probes个探测请求：探测成功则关闭断路器
+    (closed)，失败则重新打开，冷却期按backoff_multiplier指数增长直至
+    max_cool_down_period。
     
-    def __init__(self, failure_threshold: int = 3, cool_down_period: float = 60.0):
+    配置failure_rate_threshold或slow_call_rate_threshold后，还会在每个服务的
+    滑动窗口内统计失败率和慢调用率，窗口内调用数达到minimum_calls且任一比率
+    达到阈值时同样打开断路器。半开状态下耗时超过slow_call_threshold的探测请求
+    按失败处理。
+    
+    每个服务的状态保存在独立的对象中并由各自的锁保护，不同服务之间没有竞争。
+    断路器关闭时的可用性检查和无失败记录的成功调用只读取字段，不获取锁。
+    """
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(
+        self,
+        failure_threshold: int = 3,
+        cool_down_period: float = 60.0,
+        half_open_probes: int = 1,
+        backoff_multiplier: float = 2.0,
+        max_cool_down_period: Optional[float] = None,
+        failure_rate_threshold: Optional[float] = None,
+        slow_call_threshold: Optional[float] = None,
+        slow_call_rate_threshold: Optional[float] = None,
+        minimum_calls: int = 10,
+        window_size: float = 60.0,
+        bucket_count: int = 10
+    ):
         """
         初始化健康监控器
         
         Args:
             failure_threshold: 触发断路器的连续失败阈值
-            cool_down_period: 冷却期(秒)，在此期间服务将被禁用
+            cool_down_period: 首次打开断路器时的冷却期(秒)，在此期间服务将被禁用
+            half_open_probes: 半开状态下同时放行的探测请求数
+            backoff_multiplier: 探测失败后冷却期的增长倍数
+            max_cool_down_period: 冷却期上限(秒)，默认为cool_down_period的16倍
+            failure_rate_threshold: 滑动窗口内触发断路器的失败率(0-1)，默认不启用
+            slow_call_threshold: 耗时超过该值(秒)的调用计为慢调用
+            slow_call_rate_threshold: 滑动窗口内触发断路器的慢调用率(0-1)，默认不启用
+            minimum_calls: 按比率判断前窗口内至少需要的调用数
+            window_size: 滑动窗口长度(秒)
+            bucket_count: 滑动窗口的桶数量
         """
-        self.failure_counts = {}  # 服务失败计数
-        self.disabled_until = {}  # 服务禁用时间
+        if slow_call_rate_threshold is not None and slow_call_threshold is None:
+            raise ValueError("启用slow_call_rate_threshold时必须指定slow_call_threshold")
+        if half_open_probes < 1:
+            raise ValueError(f"half_open_probes必须大于等于1: {half_open_probes}")
+        self._services = {}  # 服务名称 -> _BreakerState
+        self._services_lock = threading.Lock()  # 只在创建或移除状态对象时使用
         self.failure_threshold = failure_threshold
         self.cool_down_period = cool_down_period
+        self.half_open_probes = half_open_probes
+        self.backoff_multiplier = backoff_multiplier
+        self.max_cool_down_period = max(
+            cool_down_period,
+            max_cool_down_period if max_cool_down_period is not None else cool_down_period * 16
+        )
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_threshold = slow_call_threshold
+        self.slow_call_rate_threshold = slow_call_rate_threshold
+        self.minimum_calls = minimum_calls
+        self.window_size = window_size
+        self.bucket_count = bucket_count
+        self._windowed = failure_rate_threshold is not None or slow_call_rate_threshold is not None
+    
+    def _get(self, service_name: str) -> _BreakerState:
+        """获取服务的状态对象，首次访问时创建"""
+        state = self._services.get(service_name)
+        if state is None:
+            with self._services_lock:
+                state = self._services.get(service_name)
+                if state is None:
+                    state = self._services[service_name] = _BreakerState()
+        return state
+    
+    @property
+    def failure_counts(self) -> Dict[str, int]:
+        """各服务当前的连续失败次数(快照)"""
+        return {name: state.failures for name, state in list(self._services.items())}
+    
+    @property
+    def disabled_until(self) -> Dict[str, float]:
+        """断路器打开的服务及其冷却结束时间(快照)"""
+        return {
+            name: state.disabled_until
+            for name, state in list(self._services.items())
+            if state.state == self.OPEN
+        }
+    
+    def failure_count(self, service_name: str) -> int:
+        """服务当前的连续失败次数"""
+        state = self._services.get(service_name)
+        return state.failures if state is not None else 0
+    
+    def _transition(self, state: _BreakerState, to: str) -> None:
+        """切换断路器状态并记录转换，调用方需持有state.lock"""
+        state.transitions.append({"at": round(time.time(), 3), "from": state.state, "to": to})
+        state.state = to
+    
+    def _refresh(self, service_name: str, state: _BreakerState) -> str:
+        """冷却期已过的打开状态转为半开，返回当前状态"""
+        current = state.state
+        if current == self.OPEN and time.time() > state.disabled_until:
+            with state.lock:
+                if state.state == self.OPEN and time.time() > state.disabled_until:
+                    state.probes = 0
+                    self._transition(state, self.HALF_OPEN)
+                    logger.info(f"服务 {service_name} 冷却期结束，进入半开状态")
+                current = state.state
+        return current
+    
+    def state(self, service_name: str) -> str:
+        """获取断路器状态，冷却期已过的打开状态转为半开"""
+        state = self._services.get(service_name)
+        return self._refresh(service_name, state) if state is not None else self.CLOSED
+    
+    def _probe_slots(self, state: _BreakerState) -> int:
+        """半开状态下剩余的探测名额，超过冷却期仍未返回结果的探测视为已结束"""
+        if state.probes and time.time() - state.probe_granted_at > self.cool_down_period:
+            state.probes = 0
+        return self.half_open_probes - state.probes
     
     def is_available(self, service_name: str) -> bool:
-        """检查服务是否可用"""
-        if service_name in self.disabled_until:
-            if time.time() > self.disabled_until[service_name]:
-                # 冷却期已过，重新启用服务
-                del self.disabled_until[service_name]
-                self.failure_counts[service_name] = 0
-                logger.info(f"服务 {service_name} 已重新启用")
+        """检查服务是否可用，不占用半开状态的探测名额"""
+        state = self._services.get(service_name)
+        if state is None:
+            return True
+        current = self._refresh(service_name, state)
+        if current == self.HALF_OPEN:
+            with state.lock:
+                return state.state != self.OPEN and (
+                    state.state == self.CLOSED or self._probe_slots(state) > 0
+                )
+        return current == self.CLOSED
+    
+    def try_acquire(self, service_name: str) -> bool:
+        """
+        检查服务是否可以调用，半开状态下占用一个探测名额
+        
+        获得名额的调用必须以record_success、record_failure或release结束。
+        """
+        state = self._services.get(service_name)
+        if state is None or state.state == self.CLOSED:
+            # 热路径: 断路器关闭时不获取锁
+            return True
+        if self._refresh(service_name, state) == self.OPEN:
+            return False
+        with state.lock:
+            if state.state == self.CLOSED:
                 return True
+            if state.state == self.OPEN or self._probe_slots(state) <= 0:
+                return False
+            state.probes += 1
+            state.probe_granted_at = time.time()
+            return True
+    
+    def release(self, service_name: str) -> None:
+        """归还探测名额，用于结果不计入健康状态的调用"""
+        state = self._services.get(service_name)
+        if state is None or state.state != self.HALF_OPEN:
+            return
+        with state.lock:
+            if state.probes:
+                state.probes -= 1
+    
+    def _open(self, service_name: str, state: _BreakerState) -> None:
+        """打开断路器，冷却期随连续打开次数指数增长，调用方需持有state.lock"""
+        state.trips += 1
+        cool_down = min(
+            self.cool_down_period * self.backoff_multiplier ** (state.trips - 1),
+            self.max_cool_down_period
+        )
+        state.disabled_until = time.time() + cool_down
+        state.probes = 0
+        if state.window is not None:
+            # 关闭后重新开始统计，不让打开前的结果再次触发断路器
+            state.window.reset()
+        self._transition(state, self.OPEN)
+        logger.warning(f"服务 {service_name} 暂时禁用 {cool_down} 秒")
+    
+    def _is_slow(self, latency: Optional[float]) -> bool:
+        """判断调用是否为慢调用，未配置slow_call_threshold或耗时未知时为False"""
+        return self.slow_call_threshold is not None and latency is not None and latency > self.slow_call_threshold
+    
+    def _window_tripped(self, state: _BreakerState, success: bool, latency: Optional[float]) -> bool:
+        """将调用结果计入滑动窗口，返回失败率或慢调用率是否达到阈值，调用方需持有state.lock"""
+        if not self._windowed:
             return False
-        return True
+        if state.window is None:
+            state.window = SlidingWindow(self.window_size, self.bucket_count)
+        window = state.window
+        window.record(success, self._is_slow(latency))
+        if window.calls < self.minimum_calls:
+            return False
+        calls, failure_rate, slow_rate = window.rates()
+        return calls >= self.minimum_calls and (
+            (self.failure_rate_threshold is not None and failure_rate >= self.failure_rate_threshold)
+            or (self.slow_call_rate_threshold is not None and slow_rate >= self.slow_call_rate_threshold)
+        )
     
-    def record_failure(self, service_name: str) -> None:
+    def record_failure(self, service_name: str, latency: Optional[float] = None) -> None:
         """记录服务失败"""
-        count = self.failure_counts.get(service_name, 0) + 1
-        self.failure_counts[service_name] = count
+        state = self._get(service_name)
+        with state.lock:
+            if state.state == self.OPEN:
+                # 断路器打开前发出的调用迟到的结果，不延长冷却期
+                return
+            
+            state.failures += 1
+            tripped = state.state == self.CLOSED and self._window_tripped(state, False, latency)
+            
+            if state.state == self.HALF_OPEN or state.failures >= self.failure_threshold or tripped:
+                # 探测失败、连续失败达到阈值或窗口内比率达到阈值，禁用服务一段时间
+                self._open(service_name, state)
+    
+    def record_success(self, service_name: str, latency: Optional[float] = None) -> None:
+        """记录服务成功，latency用于判断慢调用"""
+        state = self._get(service_name)
+        if state.state == self.CLOSED and not state.failures and not self._windowed:
+            # 热路径: 没有需要清除的失败计数，也不需要更新窗口
+            return
+        
+        with state.lock:
+            if state.state == self.OPEN:
+                return
+            if state.state == self.HALF_OPEN and self._is_slow(latency):
+                # 探测请求成功但仍然过慢，按探测失败处理
+                self._open(service_name, state)
+                return
+            state.failures = 0
+            if state.state == self.CLOSED:
+                if self._window_tripped(state, True, latency):
+                    self._open(service_name, state)
+                return
+            
+            state.trips = 0
+            state.probes = 0
+            self._transition(state, self.CLOSED)
+            logger.info(f"服务 {service_name} 探测成功，断路器已关闭")
+    
+    def snapshot(self, service_name: str) -> Dict[str, Any]:
+        """获取断路器状态、连续打开次数、剩余冷却时间、最近的状态转换和窗口统计"""
+        state = self._get(service_name)
+        self._refresh(service_name, state)
+        with state.lock:
+            snapshot = {
+                "state": state.state,
+                "trips": state.trips,
+                "transitions": list(state.transitions)
+            }
+            if state.state == self.OPEN:
+                snapshot["cool_down_remaining"] = max(0, round(state.disabled_until - time.time(), 1))
+            if state.window is not None:
+                calls, failure_rate, slow_rate = state.window.rates()
+                snapshot["window"] = {
+                    "calls": calls,
+                    "failure_rate": round(failure_rate, 4),
+                    "slow_call_rate": round(slow_rate, 4)
+                }
+        return snapshot
+    
+    def reset(self, service_name: str) -> None:
+        """清除服务的失败计数和断路器状态，用于服务配置变更后"""
+        with self._services_lock:
+            self._services.pop(service_name, None)
+
+class LatencyTracker:
+    """记录各服务最近成功调用的耗时，用于估算延迟分位数"""
+    
+    def __init__(self, window_size: int = 100, min_samples: int = 10):
+        """
+        初始化延迟记录器
         
-        if count >= self.failure_threshold:
-            # 触发断路器，禁用服务一段时间
-            self.disabled_until[service_name] = time.time() + self.cool_down_period
-            logger.warning(f"服务 {service_name} 暂时禁用 {self.cool_down_period} 秒")
+        Args:
+            window_size: 每个服务保留的最近样本数
+            min_samples: 计算分位数所需的最少样本数
+        """
+        self.window_size = window_size
+        self.min_samples = min_samples
+        self.samples = {}  # 服务名称 -> 最近的耗时样本
+        self._lock = threading.Lock()
     
-    def record_success(self, service_name: str) -> None:
-        """记录服务成功"""
-        self.failure_counts[service_name] = 0
+    def record(self, service_name: str, latency: float) -> None:
+        """记录一次成功调用的耗时(秒)"""
+        with self._lock:
+            if service_name not in self.samples:
+                self.samples[service_name] = deque(maxlen=self.window_size)
+            self.samples[service_name].append(latency)
+    
+    def percentile(self, service_name: str, q: float) -> Optional[float]:
+        """
+        获取服务耗时的分位数
+        
+        Args:
+            service_name: 服务名称
+            q: 分位数(0-100)
+            
+        Returns:
+            Optional[float]: 耗时分位数(秒)，样本不足时返回None
+        """
+        with self._lock:
+            samples = sorted(self.samples.get(service_name, ()))
+        
+        if len(samples) < self.min_samples:
+            return None
+        
+        index = min(len(samples) - 1, max(0, math.ceil(q / 100 * len(samples)) - 1))
+        return samples[index]
 
 # =======================
-# 基础LLM服务接口
+# 路由策略
 # =======================
 
-class BaseLLMService:
-    """LLM服务的基础抽象类"""
+class RoutingPolicy:
+    """
+    路由策略基类，决定同一故障转移层级内各服务的尝试顺序
     
-    def __init__(self, config: LLMServiceConfig):
-        self.config = config
-        self.provider = config.provider
-        self.model_name = config.model_name
-        self.api_key = config.api_key
-        self.max_tokens = config.max_tokens
-        self.temperature = config.temperature
+    默认策略保持service_order的静态顺序。子类可根据record()收到的调用结果
+    在order()中为每个请求重新排序。
+    """
     
-    def chat(self, prompt: str) -> Dict[str, Any]:
+    def order(self, service_names: Sequence[str], tier: str = "primary") -> Sequence[str]:
         """
-        发送聊天请求
+        为一个请求排列同一层级内的候选服务
         
         Args:
-            prompt: 用户提示词
+            service_names: 按service_order排列的服务名称
+            tier: 故障转移层级，如"primary"
             
         Returns:
-            Dict: 包含响应内容的字典
+            Sequence[str]: 本次请求的尝试顺序
         """
-        raise NotImplementedError("Subclass must implement chat()")
+        return service_names
     
-    def analyze(self, prompt: str, image: 'Image.Image') -> Dict[str, Any]:
+    def bind(self, providers: Mapping[str, str]) -> None:
         """
-        分析图像
+        路由计划编译或重新加载后调用
         
         Args:
-            prompt: 用户提示词
-            image: PIL图像对象
-            
-        Returns:
-            Dict: 包含响应内容的字典
+            providers: 服务名称 -> 提供商名称，来自编译后的路由计划
         """
-        raise NotImplementedError("Subclass must implement analyze()")
+        pass
     
-    @staticmethod
-    def encode_image(image: 'Image.Image') -> str:
-        """将PIL图像编码为base64字符串"""
-        buffer = BytesIO()
-        image.save(buffer, format="PNG")
-        return base64.b64encode(buffer.getvalue()).decode('utf-8')
-
-# =======================
-# OpenAI服务实现
-# =======================
+    def on_call_start(self, service_name: str) -> None:
+        """一次调用开始时调用"""
+        pass
+    
+    def on_call_end(self, service_name: str) -> None:
+        """一次调用结束(包括失败和超时后实际结束)时调用"""
+        pass
+    
+    def record(self, service_name: str, latency: Optional[float], success: bool) -> None:
+        """
+        记录一次调用结果
+        
+        Args:
+            service_name: 服务名称
+            latency: 调用耗时(秒)，未知时为None
+            success: 调用是否成功
+        """
+        pass
+    
+    def snapshot(self, service_name: str) -> Optional[Dict[str, Any]]:
+        """获取服务的路由统计，用于状态输出"""
+        return None
 
-class OpenAIService(BaseLLMService):
-    """OpenAI API服务实现"""
+class LatencyAwarePolicy(RoutingPolicy):
+    """
+    按EWMA延迟和成功率排序的路由策略
     
-    def __init__(self, config: LLMServiceConfig):
-        super().__init__(config)
-        self.client = openai.OpenAI(api_key=self.api_key)
+    每个服务的得分为"有效延迟 / 有效成功率"，即获得一次成功响应的期望耗时，
+    得分低者优先。统计按half_life衰减: 长时间没有新样本的服务，其延迟向候选中
+    的最佳延迟靠拢、成功率向1靠拢，因此恢复后的服务会重新获得流量。另有
+    exploration比例的请求随机选择一个非最优服务优先尝试，以持续刷新统计。
+    """
     
-    def chat(self, prompt: str) -> Dict[str, Any]:
-        """实现OpenAI聊天"""
-        try:
-            response = self.client.chat.completions.create(
-                model=self.model_name,
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=self.max_tokens,
-                temperature=self.temperature
-            )
-            return {
-                "raw_content": response.choices[0].message.content,
-                "provider": self.provider,
-                "model": self.model_name,
-                "finish_reason": response.choices[0].finish_reason
-            }
-        except Exception as e:
-            raise Exception(f"OpenAI API 错误: {str(e)}")
+    def __init__(
+        self,
+        alpha: float = 0.2,
+        half_life: float = 60.0,
+        exploration: float = 0.05,
+        rng: Optional[random.Random] = None
+    ):
+        """
+        Args:
+            alpha: EWMA平滑系数，越大越偏重最新样本
+            half_life: 统计衰减的半衰期(秒)
+            exploration: 探索流量比例(0-1)
+            rng: 随机数生成器，便于测试时固定随机性
+        """
+        if not 0 < alpha <= 1:
+            raise ValueError(f"alpha必须在(0, 1]范围内: {alpha}")
+        if not 0 <= exploration <= 1:
+            raise ValueError(f"exploration必须在[0, 1]范围内: {exploration}")
+        self.alpha = alpha
+        self.half_life = half_life
+        self.exploration = exploration
+        self.rng = rng or random.Random()
+        self.stats = {}  # 服务名称 -> [EWMA延迟, EWMA成功率, 更新时间]
+        self.explorations = 0
+        self._lock = threading.Lock()
     
-    def analyze(self, prompt: str, image: 'Image.Image') -> Dict[str, Any]:
-        """实现OpenAI图像分析"""
-        try:
-            base64_image = self.encode_image(image)
-            
-            response = self.client.chat.completions.create(
-                model=self.model_name,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": prompt},
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/png;base64,{base64_image}"
-                                }
-                            }
-                        ]
-                    }
-                ],
-                max_tokens=self.max_tokens,
-                temperature=self.temperature
-            )
+    def _weight(self, updated_at: float, now: float) -> float:
+        """统计的剩余权重，随距上次更新的时间按半衰期衰减"""
+        return 0.5 ** (max(0.0, now - updated_at) / self.half_life)
+    
+    def record(self, service_name: str, latency: Optional[float], success: bool) -> None:
+        now = time.time()
+        with self._lock:
+            entry = self.stats.get(service_name)
+            if entry is None:
+                self.stats[service_name] = [latency, 1.0 if success else 0.0, now]
+                return
             
-            return {
-                "raw_content": response.choices[0].message.content,
-                "provider": self.provider,
-                "model": self.model_name,
-                "finish_reason": response.choices[0].finish_reason
-            }
-        except Exception as e:
-            raise Exception(f"OpenAI API 图像分析错误: {str(e)}")
-
-# =======================
-# Anthropic服务实现
-# =======================
+            # 陈旧的统计按衰减后的权重参与平滑，新样本的权重至少为alpha
+            alpha = max(self.alpha, 1 - self._weight(entry[2], now))
+            if latency is not None:
+                entry[0] = latency if entry[0] is None else alpha * latency + (1 - alpha) * entry[0]
+            entry[1] = alpha * (1.0 if success else 0.0) + (1 - alpha) * entry[1]
+            entry[2] = now
+    
+    def _scores(self, service_names: Sequence[str]) -> Dict[str, float]:
+        """计算候选服务的得分(获得一次成功响应的期望耗时)"""
+        now = time.time()
+        with self._lock:
+            entries = {name: list(self.stats[name]) for name in service_names if name in self.stats}
+        
+        known = [entry[0] for entry in entries.values() if entry[0] is not None]
+        best = min(known) if known else 1.0
+        
+        scores = {}
+        for name in service_names:
+            entry = entries.get(name)
+            if entry is None:
+                # 没有样本的服务按最佳延迟和完全成功乐观估计
+                scores[name] = best
+                continue
+            weight = self._weight(entry[2], now)
+            latency = best if entry[0] is None else weight * entry[0] + (1 - weight) * best
+            success = weight * entry[1] + (1 - weight)
+            scores[name] = latency / max(success, 0.01)
+        return scores
+    
+    def order(self, service_names: Sequence[str], tier: str = "primary") -> Sequence[str]:
+        if len(service_names) < 2:
+            return service_names
+        
+        scores = self._scores(service_names)
+        with self._lock:
+            sampled = {name for name in service_names if name in self.stats}
+        # 同分时没有样本的服务优先，以便尽快获得其统计；其余保持静态顺序
+        ordered = sorted(service_names, key=lambda name: (scores[name], name in sampled))
+        
+        if self.exploration and self.rng.random() < self.exploration:
+            explored = ordered.pop(self.rng.randrange(1, len(ordered)))
+            ordered.insert(0, explored)
+            with self._lock:
+                self.explorations += 1
+        return ordered
+    
+    def snapshot(self, service_name: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self.stats.get(service_name)
+            if entry is None:
+                return None
+            latency, success, updated_at = entry
+        return {
+            "ewma_latency": None if latency is None else round(latency, 4),
+            "success_rate": round(success, 4),
+            "age": round(time.time() - updated_at, 1)
+        }
 
-class AnthropicService(BaseLLMService):
-    """Anthropic API服务实现"""
+class LoadBalancingPolicy(RoutingPolicy):
+    """
+    在同一层级的服务之间分摊请求的路由策略
     
-    def __init__(self, config: LLMServiceConfig):
-        super().__init__(config)
-        self.client = anthropic.Anthropic(api_key=self.api_key)
+    weighted策略按权重随机决定每个请求的尝试顺序，各服务作为首选的概率与权重
+    成正比；least_outstanding策略优先选择"进行中调用数 / 权重"最小的服务，
+    同分时按权重随机。默认只作用于主要服务层级，备用层级保持静态顺序。
+    """
     
-    def chat(self, prompt: str) -> Dict[str, Any]:
-        """实现Anthropic聊天"""
-        try:
-            response = self.client.messages.create(
-                model=self.model_name,
-                max_tokens=self.max_tokens,
-                temperature=self.temperature,
-                messages=[{"role": "user", "content": prompt}]
-            )
-            
-            return {
-                "raw_content": response.content[0].text,
-                "provider": self.provider,
-                "model": self.model_name,
-                "finish_reason": response.stop_reason
-            }
-        except Exception as e:
-            raise Exception(f"Anthropic API 错误: {str(e)}")
+    STRATEGIES = ("weighted", "least_outstanding")
     
-    def analyze(self, prompt: str, image: 'Image.Image') -> Dict[str, Any]:
-        """实现Anthropic图像分析"""
-        try:
-            base64_image = self.encode_image(image)
-            
-            response = self.client.messages.create(
-                model=self.model_name,
-                max_tokens=self.max_tokens,
-                temperature=self.temperature,
-                messages=[{
-                    "role": "user", 
-                    "content": [
-                        {
-                            "type": "text", 
-                            "text": prompt
-                        },
-                        {
-                            "type": "image",
-                            "source": {
-                                "type": "base64",
-                                "media_type": "image/png",
-                                "data": base64_image
-                            }
-                        }
-                    ]
-                }]
-            )
-            
+    def __init__(
+        self,
+        weights: Optional[Dict[str, float]] = None,
+        strategy: str = "weighted",
+        tiers: Tuple[str, ...] = ("primary",),
+        default_weight: float = 1.0,
+        rng: Optional[random.Random] = None
+    ):
+        """
+        Args:
+            weights: 服务名称或提供商名称 -> 权重，服务名称优先；提供商按路由计划中服务的配置匹配
+            strategy: "weighted"或"least_outstanding"
+            tiers: 参与负载均衡的故障转移层级
+            default_weight: 未配置权重的服务使用的权重
+            rng: 随机数生成器，便于测试时固定随机性
+        """
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f"不支持的负载均衡策略: {strategy}")
+        self.weights = dict(weights or {})
+        if any(weight <= 0 for weight in self.weights.values()):
+            raise ValueError("权重必须大于0")
+        self.strategy = strategy
+        self.tiers = tuple(tiers)
+        self.default_weight = default_weight
+        self.rng = rng or random.Random()
+        self.outstanding = {}  # 服务名称 -> 进行中的调用数
+        self.selected = {}  # 服务名称 -> 被排在首位的次数
+        self.providers = {}  # 服务名称 -> 提供商名称，由bind()整体替换
+        self._lock = threading.Lock()
+    
+    @classmethod
+    def from_quotas(
+        cls,
+        quotas: Dict[str, Dict[str, float]],
+        tokens_per_request: int = 1000,
+        **kwargs
+    ) -> "LoadBalancingPolicy":
+        """
+        按各服务的速率配额计算权重
+        
+        每个服务的权重为其每分钟可承受的请求数，即min(RPM, TPM / 每请求token数)，
+        持续吞吐因此随所有配额之和扩展。
+        
+        Args:
+            quotas: 服务名称或提供商名称 -> {"rpm": 每分钟请求数, "tpm": 每分钟token数}，
+                两项均可省略其一
+            tokens_per_request: 每个请求平均消耗的token数(输入与输出之和)
+            **kwargs: 传给构造函数的其他参数
+        """
+        weights = {}
+        for name, quota in quotas.items():
+            limits = []
+            if quota.get("rpm"):
+                limits.append(float(quota["rpm"]))
+            if quota.get("tpm"):
+                limits.append(quota["tpm"] / tokens_per_request)
+            if not limits:
+                raise ValueError(f"{name} 的配额必须包含rpm或tpm")
+            weights[name] = min(limits)
+        return cls(weights=weights, **kwargs)
+    
+    def bind(self, providers: Mapping[str, str]) -> None:
+        self.providers = dict(providers)
+    
+    def weight(self, service_name: str) -> float:
+        """服务的权重，依次查找服务名称和路由计划中该服务的提供商名称"""
+        if service_name in self.weights:
+            return self.weights[service_name]
+        return self.weights.get(self.providers.get(service_name), self.default_weight)
+    
+    def order(self, service_names: Sequence[str], tier: str = "primary") -> Sequence[str]:
+        if len(service_names) < 2 or tier not in self.tiers:
+            return service_names
+        
+        # 加权无放回抽样(Efraimidis-Spirakis): 键为u^(1/w)，降序排列
+        keys = {name: self.rng.random() ** (1.0 / self.weight(name)) for name in service_names}
+        with self._lock:
+            if self.strategy == "least_outstanding":
+                loads = {name: self.outstanding.get(name, 0) / self.weight(name) for name in service_names}
+                ordered = sorted(service_names, key=lambda name: (loads[name], -keys[name]))
+            else:
+                ordered = sorted(service_names, key=lambda name: -keys[name])
+            self.selected[ordered[0]] = self.selected.get(ordered[0], 0) + 1
+        return ordered
+    
+    def on_call_start(self, service_name: str) -> None:
+        with self._lock:
+            self.outstanding[service_name] = self.outstanding.get(service_name, 0) + 1
+    
+    def on_call_end(self, service_name: str) -> None:
+        with self._lock:
+            self.outstanding[service_name] = max(0, self.outstanding.get(service_name, 0) - 1)
+    
+    def snapshot(self, service_name: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
             return {
-                "raw_content": response.content[0].text,
-                "provider": self.provider,
-                "model": self.model_name,
-                "finish_reason": response.stop_reason
+                "weight": self.weight(service_name),
+                "outstanding": self.outstanding.get(service_name, 0),
+                "selected": self.selected.get(service_name, 0)
             }
-        except Exception as e:
-            raise Exception(f"Anthropic API 图像分析错误: {str(e)}")
 
 # =======================
-# Google Gemini服务实现
+# 图像预处理
 # =======================
 
-class GeminiService(BaseLLMService):
-    """Google Gemini API服务实现"""
+# 各提供商的有效图像尺寸上限，超出部分会被服务端缩小，不会带来更多细节
+# max_images为单次请求的图像数量上限，超出上限的提供商在故障转移时被跳过
+PROVIDER_IMAGE_LIMITS = {
+    # OpenAI高细节模式: 先缩放至2048x2048以内，再将短边缩至768，按512px分块计费
+    "openai": {"max_long_edge": 2048, "max_short_edge": 768, "max_images": 10},
+    # Anthropic: 长边超过1568像素时服务端会缩小图像
+    "anthropic": {"max_long_edge": 1568, "max_short_edge": None, "max_images": 20},
+    # Gemini: 图像最大3072x3072
+    "gemini": {"max_long_edge": 3072, "max_short_edge": None, "max_images": 3600},
+}
+
+# analyze接受的图像输入: PIL图像、已编码的图像数据、文件路径或URL
+ImageInput = Union['Image.Image', bytes, bytearray, memoryview, str, os.PathLike]
+
+MEDIA_TYPES = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp", "GIF": "image/gif"}
+
+# 各提供商可直接接受的图像格式，符合要求的已编码图像无需解码和重新编码
+PROVIDER_IMAGE_FORMATS = {
+    "openai": {"PNG", "JPEG", "WEBP", "GIF"},
+    "anthropic": {"PNG", "JPEG", "WEBP", "GIF"},
+    "gemini": {"PNG", "JPEG", "WEBP"},
+}
+
+# 可以直接传递图像URL的提供商，其余提供商由本地下载后上传
+URL_IMAGE_PROVIDERS = {"openai", "anthropic"}
+
+def _sniff_image_format(data: memoryview) -> Optional[str]:
+    """根据文件头识别图像格式"""
+    header = bytes(data[:12])
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "PNG"
+    if header.startswith(b"\xff\xd8\xff"):
+        return "JPEG"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "WEBP"
+    if header[:6] in (b"GIF87a", b"GIF89a"):
+        return "GIF"
+    return None
+
+@dataclass
+class EncodedImage:
+    """编码后待上传的图像"""
+    media_type: str
+    data: bytes
+    base64_data: str
+    metadata: Dict[str, Any]
+    url: Optional[str] = None  # 直接传递给提供商的图像URL，此时data为空
+
+class PreparedImage:
+    """
+    一次analyze请求中各服务共享的图像
     
-    def __init__(self, config: LLMServiceConfig):
-        super().__init__(config)
-        genai.configure(api_key=self.api_key)
-        self.model = genai.GenerativeModel(
-            model_name=self.model_name,
-            generation_config=genai.GenerationConfig(
-                temperature=self.temperature,
-                max_output_tokens=self.max_tokens
-            )
-        )
+    按提供商的尺寸上限缩小图像并按内容选择编码格式(含透明通道或颜色较少的图像
+    使用PNG，照片使用JPEG)。相同的目标尺寸和格式只编码一次，故障转移链中的所有
+    尝试复用同一份结果。编码结果还会按图像内容摘要缓存在进程级的LRU表中，
+    重复的图像无需再次编码。
     
-    def chat(self, prompt: str) -> Dict[str, Any]:
-        """实现Gemini聊天"""
+    除PIL图像外还接受已编码的图像数据(bytes、memoryview)、文件路径(通过mmap读取)
+    和URL。格式和尺寸已满足提供商要求的数据直接上传，只有需要转码时才用PIL解码。
+    """
+    
+    # 进程级编码缓存: (内容摘要, 目标尺寸, 格式, 质量) -> EncodedImage
+    _memo = OrderedDict()
+    _memo_bytes = 0
+    _memo_lock = threading.Lock()
+    MEMO_MAX_BYTES = 64 * 1024 * 1024
+    
+    def __init__(
+        self,
+        image: ImageInput,
+        quality: int = 85,
+        image_format: Optional[str] = None,
+        downscale: bool = True
+    ):
+        """
+        Args:
+            image: PIL图像对象、已编码的图像数据、文件路径或http(s) URL
+            quality: JPEG/WebP编码质量(1-95)
+            image_format: 强制使用的编码格式("PNG"、"JPEG"或"WEBP")，默认按内容选择
+            downscale: 是否按提供商的尺寸上限缩小图像
+        """
+        if image_format is not None and image_format not in ("PNG", "JPEG", "WEBP"):
+            raise ValueError(f"不支持的图像格式: {image_format}")
+        
+        self._image = None  # 解码后的PIL图像，按需创建
+        self._data = None  # 已编码的图像数据
+        self.url = None
+        if isinstance(image, (bytes, bytearray, memoryview)):
+            self._data = memoryview(image)
+        elif isinstance(image, str) and image.startswith(("http://", "https://")):
+            self.url = image
+        elif isinstance(image, (str, os.PathLike)):
+            with open(image, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    raise ValueError(f"图像文件为空: {os.fspath(image)}")
+                self._data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        else:
+            self._image = image
+        
+        self.quality = quality
+        self.image_format = image_format
+        self.downscale = downscale
+        self._digest = None
+        self._encoded = {}  # 目标尺寸 -> EncodedImage
+        self._lock = threading.Lock()
+    
+    @classmethod
+    def wrap(cls, image: Union[ImageInput, "PreparedImage"], **options) -> "PreparedImage":
+        """将图像包装为PreparedImage，已包装的对象原样返回"""
+        return image if isinstance(image, cls) else cls(image, **options)
+    
+    @property
+    def image(self) -> 'Image.Image':
+        """PIL图像对象，已编码的数据在首次访问时才解码(PIL只读取文件头，像素按需解码)"""
+        if self._image is None:
+            self._image = _lazy_import("Image").open(BytesIO(self._fetch()))
+        return self._image
+    
+    def validate(self) -> None:
+        """
+        检查已编码的图像数据能否识别，在调用任何服务之前执行
+        
+        常见格式只检查文件头，其余格式交给PIL读取文件头。URL不在此下载，
+        以便直接传给支持URL的提供商，下载失败时按请求错误处理。
+        
+        Raises:
+            ValueError: 数据为空或不是可识别的图像
+        """
+        if self._data is None:
+            return
+        if not len(self._data):
+            raise ValueError("图像数据为空")
+        if _sniff_image_format(self._data) is not None:
+            return
         try:
-            response = self.model.generate_content(prompt)
-            
-            return {
-                "raw_content": response.text,
-                "provider": self.provider,
-                "model": self.model_name,
-                "finish_reason": None  # Gemini不提供finish_reason
-            }
+            self.image
         except Exception as e:
-            raise Exception(f"Gemini API 错误: {str(e)}")
+            # 未安装PIL时也无法转码这些格式，同样视为无法识别
+            raise ValueError(f"无法识别的图像数据: {str(e)}") from e
     
-    def analyze(self, prompt: str, image: 'Image.Image') -> Dict[str, Any]:
-        """实现Gemini图像分析"""
+    @property
+    def source_format(self) -> Optional[str]:
+        """已编码数据的图像格式，PIL图像或无法识别时为None"""
+        if self._image is not None and self._data is None:
+            return None
+        return _sniff_image_format(self._fetch())
+    
+    def _fetch(self) -> memoryview:
+        """获取已编码的图像数据，URL在首次使用时下载"""
+        if self._data is None:
+            import urllib.request  # 只有URL输入才需要，避免导入时加载http/ssl
+            with urllib.request.urlopen(self.url, timeout=30) as response:
+                self._data = memoryview(response.read())
+        return self._data
+    
+    @property
+    def digest(self) -> str:
+        """图像内容摘要(基于已编码数据、URL或PIL图像的模式、尺寸和像素数据)"""
+        if self._digest is None:
+            if self._data is not None:
+                digest = hashlib.sha256(self._data)
+            elif self.url is not None:
+                digest = hashlib.sha256(self.url.encode("utf-8"))
+            else:
+                digest = hashlib.sha256(f"{self.image.mode}:{self.image.size}".encode("utf-8"))
+                digest.update(self.image.tobytes())
+            self._digest = digest.hexdigest()
+        return self._digest
+    
+    def target_size(self, provider: str) -> Tuple[int, int]:
+        """计算提供商能够利用的最大尺寸，不放大图像"""
+        width, height = self.image.size
+        limits = PROVIDER_IMAGE_LIMITS.get(provider)
+        if not self.downscale or limits is None:
+            return width, height
+        
+        scale = min(1.0, limits["max_long_edge"] / max(width, height))
+        if limits["max_short_edge"] is not None:
+            scale = min(scale, limits["max_short_edge"] / min(width, height))
+        return max(1, round(width * scale)), max(1, round(height * scale))
+    
+    def encoded_for(self, provider: str) -> EncodedImage:
+        """
+        获取适合指定提供商上传的编码结果
+        
+        Args:
+            provider: 提供商名称，如"openai"
+        
+        Returns:
+            EncodedImage: 编码后的图像及其元数据
+        """
+        with self._lock:
+            if self.url is not None and self._data is None and provider in URL_IMAGE_PROVIDERS:
+                return EncodedImage(
+                    media_type="",
+                    data=b"",
+                    base64_data="",
+                    metadata={"passthrough": True, "url": self.url},
+                    url=self.url
+                )
+            
+            if self._can_pass_through(provider):
+                encoded = self._encoded.get("passthrough")
+                if encoded is None:
+                    encoded = self._pass_through()
+                    self._encoded["passthrough"] = encoded
+                return encoded
+            
+            size = self.target_size(provider)
+            encoded = self._encoded.get(size)
+            if encoded is None:
+                encoded = self._encode(size)
+                self._encoded[size] = encoded
+            return encoded
+    
+    def _can_pass_through(self, provider: str) -> bool:
+        """已编码数据的格式和尺寸均满足提供商要求时可以直接上传"""
+        if self._image is not None and self._data is None:
+            return False
+        
+        source_format = self.source_format
+        if source_format not in PROVIDER_IMAGE_FORMATS.get(provider, ()):
+            return False
+        if self.image_format not in (None, source_format):
+            return False
+        if not self.downscale:
+            return True
+        
         try:
-            response = self.model.generate_content([prompt, image])
+            return self.target_size(provider) == tuple(self.image.size)
+        except ImportError:
+            # 未安装PIL时无法读取尺寸，直接上传由服务端处理
+            return True
+    
+    def _pass_through(self) -> EncodedImage:
+        """不经解码直接上传已编码的数据"""
+        start = time.perf_counter()
+        data = self._fetch()
+        source_format = self.source_format
+        return EncodedImage(
+            media_type=MEDIA_TYPES[source_format],
+            data=data,
+            base64_data=base64.b64encode(data).decode('utf-8'),
+            metadata={
+                "passthrough": True,
+                "format": source_format,
+                "original_bytes": len(data),
+                "encoded_bytes": len(data),
+                "bytes_saved": 0,
+                "encode_time": round(time.perf_counter() - start, 6)
+            }
+        )
+    
+    def _encode(self, size: Tuple[int, int]) -> EncodedImage:
+        """缩放并编码图像，优先复用进程级缓存"""
+        memo_key = (self.digest, size, self.image_format, self.quality)
+        encoded = self._memo_get(memo_key)
+        if encoded is not None:
+            return encoded
+        
+        start = time.perf_counter()
+        image = self.image
+        if size != tuple(image.size):
+            image = image.resize(size, resample=_lanczos_filter())
+        
+        image_format = self.image_format or self._choose_format(image)
+        save_options = {}
+        if image_format in ("JPEG", "WEBP"):
+            save_options["quality"] = self.quality
+            if image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+        
+        buffer = BytesIO()
+        image.save(buffer, format=image_format, **save_options)
+        data = buffer.getvalue()
+        
+        width, height = self.image.size
+        if self._data is not None:
+            original_bytes = len(self._data)
+        else:
+            # PIL图像以未压缩的像素数据大小计
+            original_bytes = width * height * len(self.image.getbands())
+        encoded = EncodedImage(
+            media_type=MEDIA_TYPES[image_format],
+            data=data,
+            base64_data=base64.b64encode(data).decode('utf-8'),
+            metadata={
+                "original_size": [width, height],
+                "sent_size": list(size),
+                "format": image_format,
+                "original_bytes": original_bytes,
+                "encoded_bytes": len(data),
+                "bytes_saved": original_bytes - len(data),
+                "encode_time": round(time.perf_counter() - start, 6)
+            }
+        )
+        self._memo_put(memo_key, encoded)
+        return encoded
+    
+    @staticmethod
+    def _choose_format(image: 'Image.Image') -> str:
+        """按内容选择格式: 含透明通道或颜色较少(截图、图表)使用PNG，其余使用JPEG"""
+        if image.mode in ("RGBA", "LA", "PA") or "transparency" in getattr(image, "info", {}):
+            return "PNG"
+        if image.mode in ("1", "P") or image.getcolors(maxcolors=256) is not None:
+            return "PNG"
+        return "JPEG"
+    
+    @classmethod
+    def _memo_get(cls, key: Tuple) -> Optional[EncodedImage]:
+        with cls._memo_lock:
+            encoded = cls._memo.get(key)
+            if encoded is not None:
+                cls._memo.move_to_end(key)
+            return encoded
+    
+    @classmethod
+    def _memo_put(cls, key: Tuple, encoded: EncodedImage) -> None:
+        size = len(encoded.data) + len(encoded.base64_data)
+        if size > cls.MEMO_MAX_BYTES:
+            return
+        with cls._memo_lock:
+            if key in cls._memo:
+                return
+            cls._memo[key] = encoded
+            cls._memo_bytes += size
+            while cls._memo_bytes > cls.MEMO_MAX_BYTES:
+                _, evicted = cls._memo.popitem(last=False)
+                cls._memo_bytes -= len(evicted.data) + len(evicted.base64_data)
+    
+    @classmethod
+    def clear_memo(cls) -> None:
+        """清空进程级编码缓存"""
+        with cls._memo_lock:
+            cls._memo.clear()
+            cls._memo_bytes = 0
+
+def _lanczos_filter():
+    """获取PIL的LANCZOS重采样滤波器，兼容新旧版本Pillow"""
+    try:
+        pil_image = _lazy_import("Image")
+    except ImportError:
+        return None
+    return getattr(pil_image, "Resampling", pil_image).LANCZOS
+
+class PreparedImageSet:
+    """一次analyze请求中的一组图像，可在线程池中并行编码"""
+    
+    def __init__(self, images: List[PreparedImage], executor: Optional[ThreadPoolExecutor] = None):
+        """
+        Args:
+            images: 请求中的图像，顺序即发送顺序
+            executor: 用于并行编码的线程池，为None时顺序编码
+        """
+        if not images:
+            raise ValueError("至少需要提供一张图像")
+        self.images = images
+        self.executor = executor
+        self._digest = None
+    
+    def __len__(self) -> int:
+        return len(self.images)
+    
+    @property
+    def digest(self) -> str:
+        """整组图像的内容摘要，单张图像时与该图像的摘要相同"""
+        if self._digest is None:
+            if len(self.images) == 1:
+                self._digest = self.images[0].digest
+            else:
+                digests = self._map(lambda image: image.digest)
+                self._digest = hashlib.sha256("|".join(digests).encode("utf-8")).hexdigest()
+        return self._digest
+    
+    def encoded_for(self, provider: str) -> List[EncodedImage]:
+        """获取所有图像适合指定提供商上传的编码结果"""
+        return self._map(lambda image: image.encoded_for(provider))
+    
+    def _map(self, fn: Callable) -> List[Any]:
+        if self.executor is None or len(self.images) == 1:
+            return [fn(image) for image in self.images]
+        return list(self.executor.map(fn, self.images))
+
+# =======================
+# HTTP连接池
+# =======================
+
+class HTTPClientPool:
+    """
+    按(提供商, API密钥)共享的HTTP客户端
+    
+    同一提供商的主要模型和备用模型使用同一个httpx客户端，故障转移时可以复用
+    已建立的keep-alive连接，无需重新进行TCP和TLS握手。客户端在首次使用时创建。
+    """
+    
+    def __init__(
+        self,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 32,
+        keepalive_expiry: float = 60.0,
+        http2: bool = False
+    ):
+        """
+        Args:
+            max_connections: 每个客户端的最大连接数
+            max_keepalive_connections: 每个客户端保留的最大空闲连接数
+            keepalive_expiry: 空闲连接的保留时间(秒)
+            http2: 是否启用HTTP/2，需要安装h2 (pip install httpx[http2])
+        """
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.http2 = http2
+        self._clients = {}  # (提供商, API密钥, 是否异步) -> httpx客户端
+        self._requests = {}  # (提供商, API密钥, 是否异步) -> 已发送的请求数
+        self._lock = threading.Lock()
+    
+    def client(self, provider: str, api_key: str) -> "httpx.Client":
+        """获取提供商和API密钥对应的同步客户端"""
+        return self._get(provider, api_key, False)
+    
+    def async_client(self, provider: str, api_key: str) -> "httpx.AsyncClient":
+        """获取提供商和API密钥对应的异步客户端"""
+        return self._get(provider, api_key, True)
+    
+    def _get(self, provider: str, api_key: str, is_async: bool):
+        key = (provider, api_key, is_async)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = self._create(key)
+                self._clients[key] = client
+                self._requests[key] = 0
+            return client
+    
+    def _create(self, key: Tuple[str, str, bool]):
+        """创建调优后的httpx客户端，通过事件钩子统计请求数"""
+        httpx = _lazy_import("httpx")
+        limits = httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_expiry
+        )
+        
+        def count_request(request) -> None:
+            with self._lock:
+                self._requests[key] += 1
+        
+        if key[2]:
+            async def acount_request(request) -> None:
+                count_request(request)
+            
+            return httpx.AsyncClient(
+                limits=limits, http2=self.http2, follow_redirects=True,
+                event_hooks={"request": [acount_request]}
+            )
+        return httpx.Client(
+            limits=limits, http2=self.http2, follow_redirects=True,
+            event_hooks={"request": [count_request]}
+        )
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        获取连接池使用情况
+        
+        Returns:
+            Dict: "提供商:密钥指纹[:async]" -> 请求数、连接数、空闲连接数和连接上限
+        """
+        with self._lock:
+            items = list(self._clients.items())
+            requests = dict(self._requests)
+        
+        stats = {}
+        for key, client in items:
+            provider, api_key, is_async = key
+            fingerprint = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:8]
+            # httpx没有公开连接池状态，从底层httpcore连接池读取，读取失败时为None
+            pool = getattr(getattr(client, "_transport", None), "_pool", None)
+            connections = getattr(pool, "connections", None)
+            if not isinstance(connections, list):
+                connections = None
+            stats[f"{provider}:{fingerprint}" + (":async" if is_async else "")] = {
+                "requests": requests[key],
+                "connections": None if connections is None else len(connections),
+                "idle_connections": None if connections is None else sum(
+                    1 for connection in connections if connection.is_idle()
+                ),
+                "max_connections": self.max_connections,
+                "http2": self.http2
+            }
+        return stats
+    
+    def close(self) -> None:
+        """关闭所有同步客户端，异步客户端需要通过aclose()关闭"""
+        with self._lock:
+            sync_keys = [key for key in self._clients if not key[2]]
+            clients = [self._clients.pop(key) for key in sync_keys]
+        for client in clients:
+            client.close()
+    
+    async def aclose(self) -> None:
+        """关闭所有客户端"""
+        self.close()
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for client in clients:
+            await client.aclose()
+
+# =======================
+# 错误分类
+# =======================
+
+class ErrorCategory(str, Enum):
+    """服务调用错误的类别，故障转移链按类别决定后续处理"""
+    RATE_LIMIT = "rate_limit"
+    TIMEOUT = "timeout"
+    AUTH = "auth"
+    INVALID_REQUEST = "invalid_request"
+    CONTEXT_LENGTH = "context_length"  # 请求超出模型的上下文长度，属于invalid_request的特例
+    MODEL_NOT_FOUND = "model_not_found"  # 模型不存在或已下线，其他提供商的模型不受影响
+    QUEUE_TIMEOUT = "queue_timeout"  # 调用在本地线程池中排队超时，请求从未发出
+    SERVER = "server"
+    CONTENT_FILTER = "content_filter"
+    UNKNOWN = "unknown"
+
+# SDK异常类名 -> 错误类别，覆盖openai、anthropic、google-api-core、httpx和内置异常
+ERROR_TYPE_CATEGORIES = {
+    "RateLimitError": ErrorCategory.RATE_LIMIT,
+    "ResourceExhausted": ErrorCategory.RATE_LIMIT,
+    "TooManyRequests": ErrorCategory.RATE_LIMIT,
+    "APITimeoutError": ErrorCategory.TIMEOUT,
+    "DeadlineExceeded": ErrorCategory.TIMEOUT,
+    "TimeoutException": ErrorCategory.TIMEOUT,
+    "TimeoutError": ErrorCategory.TIMEOUT,
+    "AuthenticationError": ErrorCategory.AUTH,
+    "PermissionDeniedError": ErrorCategory.AUTH,
+    "Unauthenticated": ErrorCategory.AUTH,
+    "PermissionDenied": ErrorCategory.AUTH,
+    "BadRequestError": ErrorCategory.INVALID_REQUEST,
+    "UnidentifiedImageError": ErrorCategory.INVALID_REQUEST,  # PIL无法识别的图像
+    "URLError": ErrorCategory.INVALID_REQUEST,  # 图像URL下载失败
+    "NotFoundError": ErrorCategory.MODEL_NOT_FOUND,
+    "NotFound": ErrorCategory.MODEL_NOT_FOUND,
+    "UnprocessableEntityError": ErrorCategory.INVALID_REQUEST,
+    "InvalidArgument": ErrorCategory.INVALID_REQUEST,
+    "InternalServerError": ErrorCategory.SERVER,
+    "ServiceUnavailable": ErrorCategory.SERVER,
+    "APIConnectionError": ErrorCategory.SERVER,
+    "BlockedPromptException": ErrorCategory.CONTENT_FILTER,
+    "StopCandidateException": ErrorCategory.CONTENT_FILTER,
+    "ContentFilterFinishReasonError": ErrorCategory.CONTENT_FILTER,
+}
+
+# HTTP状态码 -> 错误类别，异常类型无法识别时使用
+HTTP_STATUS_CATEGORIES = {
+    400: ErrorCategory.INVALID_REQUEST,
+    401: ErrorCategory.AUTH,
+    403: ErrorCategory.AUTH,
+    404: ErrorCategory.MODEL_NOT_FOUND,
+    408: ErrorCategory.TIMEOUT,
+    413: ErrorCategory.INVALID_REQUEST,
+    422: ErrorCategory.INVALID_REQUEST,
+    429: ErrorCategory.RATE_LIMIT,
+    504: ErrorCategory.TIMEOUT,
+}
+
+# 表示内容被安全策略拦截的错误码(OpenAI在400响应体中返回)
+CONTENT_FILTER_CODES = frozenset({"content_filter", "content_policy_violation"})
+
+# 请求错误中表示超出上下文长度的错误码和消息关键词
+CONTEXT_LENGTH_CODES = frozenset({"context_length_exceeded", "string_above_max_length"})
+CONTEXT_LENGTH_KEYWORDS = (
+    'context length', 'context window', 'prompt is too long',
+    'maximum number of tokens', 'too many tokens'
+)
+
+# 请求错误中表示API密钥无效的消息关键词(Gemini以InvalidArgument返回无效密钥)
+AUTH_KEYWORDS = ('api key not valid', 'api_key_invalid', 'invalid api key')
+
+# 限流错误消息中的关键词，只用于既没有已知类型也没有状态码的异常
+RATE_LIMIT_KEYWORDS = (
+    'rate limit', 'ratelimit', 'too many requests',
+    '429', 'quota exceeded', 'capacity', 'throttle'
+)
+
+class LLMServiceError(Exception):
+    """
+    服务调用失败的结构化错误
+    
+    保留原始SDK异常的类型名、HTTP状态码、Retry-After和错误类别，故障转移链
+    直接读取category，无需再解析错误消息。原始异常保存在__cause__中。
+    """
+    
+    def __init__(
+        self,
+        message: str,
+        category: ErrorCategory = ErrorCategory.UNKNOWN,
+        provider: Optional[str] = None,
+        status_code: Optional[int] = None,
+        retry_after: Optional[float] = None,
+        error_type: Optional[str] = None
+    ):
+        super().__init__(message)
+        self.category = category
+        self.provider = provider
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.error_type = error_type
+    
+    @classmethod
+    def from_exception(cls, error: Exception, provider: Optional[str] = None, prefix: str = "") -> "LLMServiceError":
+        """
+        将SDK异常转换为LLMServiceError，已是LLMServiceError的异常原样返回
+        
+        Args:
+            error: 原始异常
+            provider: 提供商名称
+            prefix: 错误消息前缀，如"OpenAI API 错误"
+        """
+        if isinstance(error, cls):
+            return error
+        wrapped = cls(
+            f"{prefix}: {str(error)}" if prefix else str(error),
+            category=classify_error(error),
+            provider=provider,
+            status_code=_status_code(error),
+            retry_after=_retry_after(error),
+            error_type=type(error).__name__
+        )
+        wrapped.__cause__ = error
+        return wrapped
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """错误详情，用于errors列表"""
+        return {
+            "category": self.category.value,
+            "status_code": self.status_code,
+            "error_type": self.error_type,
+            "retry_after": self.retry_after
+        }
+
+def _status_code(error: Exception) -> Optional[int]:
+    """读取异常携带的HTTP状态码，没有时返回None"""
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    if status is None:
+        # google-api-core的异常以code属性表示HTTP状态码
+        status = getattr(error, "code", None)
+    return status if isinstance(status, int) else None
+
+def classify_error(error: Exception) -> ErrorCategory:
+    """
+    判断错误类别
+    
+    依次使用LLMServiceError已有的类别、异常类名(含父类)、错误码和HTTP状态码，
+    都无法识别时才按限流关键词检查错误消息。请求错误再按错误码和消息区分
+    是否为无效的API密钥或超出上下文长度。
+    """
+    if isinstance(error, LLMServiceError):
+        return error.category
+    code = getattr(error, "code", None)
+    if code in CONTENT_FILTER_CODES:
+        return ErrorCategory.CONTENT_FILTER
+    category = None
+    for cls in type(error).__mro__:
+        category = ERROR_TYPE_CATEGORIES.get(cls.__name__)
+        if category is not None:
+            break
+    if category is None:
+        status = _status_code(error)
+        if status is not None:
+            category = HTTP_STATUS_CATEGORIES.get(
+                status, ErrorCategory.SERVER if status >= 500 else ErrorCategory.UNKNOWN
+            )
+    if category is None:
+        error_str = str(error).lower()
+        if any(keyword in error_str for keyword in RATE_LIMIT_KEYWORDS):
+            return ErrorCategory.RATE_LIMIT
+        return ErrorCategory.UNKNOWN
+    if category is ErrorCategory.INVALID_REQUEST:
+        error_str = str(error).lower()
+        if any(keyword in error_str for keyword in AUTH_KEYWORDS):
+            return ErrorCategory.AUTH
+        if code in CONTEXT_LENGTH_CODES or any(keyword in error_str for keyword in CONTEXT_LENGTH_KEYWORDS):
+            return ErrorCategory.CONTEXT_LENGTH
+    return category
+
+class FailoverAction(str, Enum):
+    """服务调用失败后故障转移链的处理方式"""
+    RETRY = "retry"  # 计入服务失败，尝试下一个服务
+    SKIP_PROVIDER = "skip_provider"  # 计入服务失败，本次请求跳过同一提供商的其余服务
+    SKIP_MODEL = "skip_model"  # 不计入服务失败，尝试下一个服务
+    FAIL_FAST = "fail_fast"  # 不计入服务失败，停止故障转移并返回错误
+
+# 错误类别 -> 处理方式，未列出的类别为RETRY。
+# 请求本身有问题时换用其他服务也会以同样方式失败，不应触发健康服务的断路器
+DEFAULT_FAILOVER_ACTIONS = MappingProxyType({
+    ErrorCategory.INVALID_REQUEST: FailoverAction.FAIL_FAST,
+    ErrorCategory.CONTENT_FILTER: FailoverAction.FAIL_FAST,
+    ErrorCategory.CONTEXT_LENGTH: FailoverAction.SKIP_MODEL,  # 上下文更长的模型可能可以处理
+    ErrorCategory.MODEL_NOT_FOUND: FailoverAction.SKIP_MODEL,  # 模型已下线，其余模型仍可用
+    ErrorCategory.QUEUE_TIMEOUT: FailoverAction.SKIP_MODEL,  # 本地线程池已满，与服务健康无关
+    ErrorCategory.AUTH: FailoverAction.SKIP_PROVIDER,  # 同一提供商的其余服务使用相同的密钥
+})
+
+# 由请求内容导致的错误类别，不计入API密钥的失败次数
+REQUEST_ERROR_CATEGORIES = frozenset({
+    ErrorCategory.INVALID_REQUEST, ErrorCategory.CONTEXT_LENGTH, ErrorCategory.CONTENT_FILTER,
+    ErrorCategory.MODEL_NOT_FOUND
+})
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """判断是否为限流错误"""
+    return classify_error(error) is ErrorCategory.RATE_LIMIT
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """读取SDK错误响应中的Retry-After头(秒)，没有时返回None"""
+    if isinstance(error, LLMServiceError):
+        return error.retry_after
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    try:
+        value = headers.get("retry-after") if headers is not None else None
+        return float(value) if value is not None else None
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+# =======================
+# API密钥池
+# =======================
+
+class APIKeyPool:
+    """
+    同一提供商的多个API密钥
+    
+    每个密钥独立维护限流冷却和断路器状态: 返回限流错误的密钥按Retry-After
+    (没有时为rate_limit_cool_down)冷却，连续失败达到阈值的密钥被暂时禁用，
+    其余密钥继续提供服务，不影响整个提供商。
+    """
+    
+    STRATEGIES = ("round_robin", "least_loaded")
+    
+    def __init__(
+        self,
+        keys: List[str],
+        strategy: str = "round_robin",
+        rate_limit_cool_down: float = 60.0,
+        failure_threshold: int = 3,
+        cool_down_period: float = 60.0
+    ):
+        """
+        Args:
+            keys: API密钥列表
+            strategy: "round_robin"轮询或"least_loaded"选择进行中请求最少的密钥
+            rate_limit_cool_down: 限流响应没有Retry-After时的冷却时间(秒)
+            failure_threshold: 触发密钥断路器的连续失败次数
+            cool_down_period: 密钥断路器的禁用时间(秒)
+        """
+        if not keys:
+            raise ValueError("至少需要一个API密钥")
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f"不支持的密钥选择策略: {strategy}")
+        self.keys = list(dict.fromkeys(keys))  # 去重并保持顺序
+        self.strategy = strategy
+        self.rate_limit_cool_down = rate_limit_cool_down
+        self.failure_threshold = failure_threshold
+        self.cool_down_period = cool_down_period
+        # 密钥 -> 状态
+        self._state = {
+            key: {"in_flight": 0, "requests": 0, "rate_limited": 0, "failures": 0, "available_at": 0.0}
+            for key in self.keys
+        }
+        self._next = 0
+        self._lock = threading.Lock()
+    
+    def __len__(self) -> int:
+        return len(self.keys)
+    
+    def acquire(self) -> str:
+        """
+        选择一个可用的密钥并计入进行中请求
+        
+        Raises:
+            LLMServiceError: 所有密钥都在冷却中，类别为限流
+        """
+        now = time.time()
+        with self._lock:
+            available = [key for key in self.keys if self._state[key]["available_at"] <= now]
+            if not available:
+                wait_time = min(state["available_at"] for state in self._state.values()) - now
+                raise LLMServiceError(
+                    f"所有API密钥都在冷却中 (rate limit)，{wait_time:.1f}秒后恢复",
+                    category=ErrorCategory.RATE_LIMIT,
+                    retry_after=wait_time
+                )
+            
+            if self.strategy == "least_loaded":
+                key = min(available, key=lambda k: self._state[k]["in_flight"])
+            else:
+                # 从上次位置开始轮询，跳过冷却中的密钥
+                key = next(
+                    self.keys[(self._next + i) % len(self.keys)]
+                    for i in range(len(self.keys))
+                    if self.keys[(self._next + i) % len(self.keys)] in available
+                )
+                self._next = (self.keys.index(key) + 1) % len(self.keys)
+            
+            state = self._state[key]
+            state["in_flight"] += 1
+            state["requests"] += 1
+            return key
+    
+    def release(self, key: str, error: Optional[Exception] = None) -> bool:
+        """
+        归还密钥并记录调用结果
+        
+        Args:
+            key: acquire()返回的密钥
+            error: 调用失败时的异常
+            
+        Returns:
+            bool: 是否为限流错误(密钥已进入冷却)
+        """
+        with self._lock:
+            state = self._state[key]
+            state["in_flight"] -= 1
+            if error is None:
+                state["failures"] = 0
+                return False
+            
+            category = classify_error(error)
+            if category is ErrorCategory.RATE_LIMIT:
+                retry_after = _retry_after(error)
+                state["rate_limited"] += 1
+                state["available_at"] = time.time() + (
+                    retry_after if retry_after is not None else self.rate_limit_cool_down
+                )
+                return True
+            if category in REQUEST_ERROR_CATEGORIES:
+                # 请求本身的问题，与密钥无关
+                return False
             
+            state["failures"] += 1
+            if state["failures"] >= self.failure_threshold:
+                state["available_at"] = time.time() + self.cool_down_period
+                state["failures"] = 0
+            return False
+    
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """获取各密钥的状态，密钥以SHA-256指纹表示"""
+        now = time.time()
+        with self._lock:
             return {
-                "raw_content": response.text,
-                "provider": self.provider,
-                "model": self.model_name,
-                "finish_reason": None
+                hashlib.sha256(key.encode("utf-8")).hexdigest()[:8]: {
+                    "in_flight": state["in_flight"],
+                    "requests": state["requests"],
+                    "rate_limited": state["rate_limited"],
+                    "failures": state["failures"],
+                    "cool_down_remaining": round(max(0.0, state["available_at"] - now), 1)
+                }
+                for key, state in self._state.items()
             }
-        except Exception as e:
-            raise Exception(f"Gemini API 图像分析错误: {str(e)}")
 
 # =======================
-# 服务工厂
+# 基础LLM服务接口
 # =======================
 
-class ServiceFactory:
-    """LLM服务工厂，创建不同提供商的服务实例"""
+class BaseLLMService:
+    """LLM服务的基础抽象类"""
+    
+    def __init__(self, config: LLMServiceConfig):
+        self.config = config
+        self.provider = config.provider
+        self.model_name = config.model_name
+        self.api_key = config.api_key
+        self.max_tokens = config.max_tokens
+        self.temperature = config.temperature
+        self.timeout = config.timeout
+        self.key_pool = config.key_pool or APIKeyPool([config.api_key])
+    
+    def chat(self, prompt: str) -> Dict[str, Any]:
+        """
+        发送聊天请求
+        
+        Args:
+            prompt: 用户提示词
+        
+        Returns:
+            Dict: 包含响应内容的字典
+        """
+        raise NotImplementedError("Subclass must implement chat()")
+    
+    def analyze(self, prompt: str, image: 'Image.Image') -> Dict[str, Any]:
+        """
+        分析图像
+        
+        Args:
+            prompt: 用户提示词
+            image: PIL图像对象、PreparedImage，或多张图像组成的PreparedImageSet/列表
+        
+        Returns:
+            Dict: 包含响应内容的字典
+        """
+        raise NotImplementedError("Subclass must implement analyze()")
+    
+    async def achat(self, prompt: str) -> Dict[str, Any]:
+        """异步发送聊天请求，参数与返回值同chat()"""
+        raise NotImplementedError("Subclass must implement achat()")
+    
+    async def aanalyze(self, prompt: str, image: 'Image.Image') -> Dict[str, Any]:
+        """异步分析图像，参数与返回值同analyze()"""
+        raise NotImplementedError("Subclass must implement aanalyze()")
+    
+    async def aclose(self) -> None:
+        """关闭异步客户端持有的连接"""
+        pass
+    
+    def _http_client_kwargs(self, api_key: str, is_async: bool = False) -> Dict[str, Any]:
+        """
+        获取传给SDK客户端的共享HTTP客户端参数
+        
+        未配置连接池或未安装httpx时返回空字典，由SDK自行创建HTTP客户端
+        """
+        http_pool = self.config.http_pool
+        if http_pool is None:
+            return {}
+        try:
+            if is_async:
+                return {"http_client": http_pool.async_client(self.provider, api_key)}
+            return {"http_client": http_pool.client(self.provider, api_key)}
+        except ImportError as e:
+            logger.debug(f"无法使用共享HTTP客户端: {str(e)}")
+            return {}
+    
+    def _create_clients(self, client_cls: Callable, async_client_cls: Callable) -> None:
+        """为密钥池中的每个API密钥创建同步和异步SDK客户端"""
+        self.clients = {}
+        self.async_clients = {}
+        for api_key in self.key_pool.keys:
+            # 将超时下推到SDK客户端，关闭SDK内部重试，由故障转移链负责重试
+            self.clients[api_key] = client_cls(
+                api_key=api_key,
+                timeout=self.timeout,
+                max_retries=0,
+                **self._http_client_kwargs(api_key)
+            )
+            self.async_clients[api_key] = async_client_cls(
+                api_key=api_key,
+                timeout=self.timeout,
+                max_retries=0,
+                **self._http_client_kwargs(api_key, is_async=True)
+            )
+        self.client = self.clients[self.key_pool.keys[0]]
+        self.async_client = self.async_clients[self.key_pool.keys[0]]
+    
+    def _with_api_key(self, call: Callable[[str], Any]) -> Any:
+        """
+        从密钥池选择密钥执行调用
+        
+        某个密钥被限流时立即换用下一个可用密钥重试，所有密钥都被限流或冷却时
+        抛出限流错误，由故障转移链切换到下一个服务。
+        """
+        last_error = None
+        for _ in range(len(self.key_pool)):
+            try:
+                api_key = self.key_pool.acquire()
+            except Exception:
+                if last_error is not None:
+                    raise last_error
+                raise
+            try:
+                result = call(api_key)
+            except Exception as e:
+                if self.key_pool.release(api_key, e):
+                    last_error = e
+                    continue
+                raise
+            self.key_pool.release(api_key)
+            return result
+        raise last_error
+    
+    async def _awith_api_key(self, call: Callable[[str], Any]) -> Any:
+        """异步版本的_with_api_key，call返回可等待对象"""
+        last_error = None
+        for _ in range(len(self.key_pool)):
+            try:
+                api_key = self.key_pool.acquire()
+            except Exception:
+                if last_error is not None:
+                    raise last_error
+                raise
+            try:
+                result = await call(api_key)
+            except Exception as e:
+                if self.key_pool.release(api_key, e):
+                    last_error = e
+                    continue
+                raise
+            except BaseException:
+                # 超时取消(CancelledError)时也要归还密钥
+                self.key_pool.release(api_key)
+                raise
+            self.key_pool.release(api_key)
+            return result
+        raise last_error
+    
+    async def _aclose_sdk_client(self) -> None:
+        """关闭SDK异步客户端，共享的HTTP客户端由连接池统一关闭"""
+        if self.config.http_pool is None:
+            for async_client in self.async_clients.values():
+                await async_client.close()
+    
+    def _encode_images(self, image: Union[ImageInput, PreparedImage, PreparedImageSet, list]) -> List[EncodedImage]:
+        """
+        将请求中的图像编码为适合当前提供商上传的格式
+        
+        解码或下载图像失败属于请求错误(换用其他服务同样会失败)，以INVALID_REQUEST类别抛出
+        """
+        try:
+            if isinstance(image, PreparedImageSet):
+                return image.encoded_for(self.provider)
+            if isinstance(image, (list, tuple)):
+                return [PreparedImage.wrap(item).encoded_for(self.provider) for item in image]
+            return [PreparedImage.wrap(image).encoded_for(self.provider)]
+        except (OSError, ValueError, ImportError) as e:
+            # 图像无法处理(含未安装PIL而必须重新编码)时换用其他服务同样失败
+            raise LLMServiceError(
+                f"图像处理失败: {str(e)}",
+                category=ErrorCategory.INVALID_REQUEST,
+                provider=self.provider,
+                error_type=type(e).__name__
+            ) from e
+    
+    async def _aencode_images(self, image: Union[ImageInput, PreparedImage, PreparedImageSet, list]) -> List[EncodedImage]:
+        """在线程中编码图像，避免阻塞事件循环"""
+        import asyncio  # 事件循环运行时asyncio已加载，延迟导入不影响同步用户的启动时间
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._encode_images, image)
     
     @staticmethod
-    def create_service(config: LLMServiceConfig) -> BaseLLMService:
+    def _with_image_metadata(result: Dict[str, Any], encoded: List[EncodedImage]) -> Dict[str, Any]:
+        """在响应中附加图像预处理元数据，多张图像时为列表"""
+        metadata = [item.metadata for item in encoded]
+        result["image_metadata"] = metadata[0] if len(metadata) == 1 else metadata
+        return result
+    
+    @staticmethod
+    def encode_image(image: 'Image.Image') -> str:
+        """将PIL图像编码为base64字符串"""
+        buffer = BytesIO()
+        image.save(buffer, format="PNG")
+        return base64.b64encode(buffer.getvalue()).decode('utf-8')
+
+# =======================
+# OpenAI服务实现
+# =======================
+
+class OpenAIService(BaseLLMService):
+    """OpenAI API服务实现"""
+    
+    def __init__(self, config: LLMServiceConfig):
+        super().__init__(config)
+        openai = _lazy_import("openai")
+        self._create_clients(openai.OpenAI, openai.AsyncOpenAI)
+    
+    def _chat_request(self, prompt: str) -> Dict[str, Any]:
+        """构造聊天请求参数"""
+        return {
+            "model": self.model_name,
+            "messages": [{"role": "user", "content": prompt}],
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature
+        }
+    
+    def _analyze_request(self, prompt: str, encoded_images: List[EncodedImage]) -> Dict[str, Any]:
+        """构造图像分析请求参数"""
+        return {
+            "model": self.model_name,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [{"type": "text", "text": prompt}] + [
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": encoded.url or f"data:{encoded.media_type};base64,{encoded.base64_data}"
+                            }
+                        }
+                        for encoded in encoded_images
+                    ]
+                }
+            ],
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature
+        }
+    
+    def _parse_response(self, response) -> Dict[str, Any]:
+        """将SDK响应转换为统一格式"""
+        return {
+            "raw_content": response.choices[0].message.content,
+            "provider": self.provider,
+            "model": self.model_name,
+            "finish_reason": response.choices[0].finish_reason
+        }
+    
+    def chat(self, prompt: str) -> Dict[str, Any]:
+        """实现OpenAI聊天"""
+        try:
+            request = self._chat_request(prompt)
+            response = self._with_api_key(
+                lambda api_key: self.clients[api_key].chat.completions.create(**request)
+            )
+            return self._parse_response(response)
+        except Exception as e:
+            raise LLMServiceError.from_exception(e, self.provider, "OpenAI API 错误")
+    
+    def analyze(self, prompt: str, image: 'Image.Image') -> Dict[str, Any]:
+        """实现OpenAI图像分析"""
+        try:
+            encoded_images = self._encode_images(image)
+            request = self._analyze_request(prompt, encoded_images)
+            response = self._with_api_key(
+                lambda api_key: self.clients[api_key].chat.completions.create(**request)
+            )
+            return self._with_image_metadata(self._parse_response(response), encoded_images)
+        except Exception as e:
+            raise LLMServiceError.from_exception(e, self.provider, "OpenAI API 图像分析错误")
+    
+    async def achat(self, prompt: str) -> Dict[str, Any]:
+        """实现OpenAI异步聊天"""
+        try:
+            request = self._chat_request(prompt)
+            response = await self._awith_api_key(
+                lambda api_key: self.async_clients[api_key].chat.completions.create(**request)
+            )
+            return self._parse_response(response)
+        except Exception as e:
+            raise LLMServiceError.from_exception(e, self.provider, "OpenAI API 错误")
+    
+    async def aanalyze(self, prompt: str, image: 'Image.Image') -> Dict[str, Any]:
+        """实现OpenAI异步图像分析"""
+        try:
+            encoded_images = await self._aencode_images(image)
+            request = self._analyze_request(prompt, encoded_images)
+            response = await self._awith_api_key(
+                lambda api_key: self.async_clients[api_key].chat.completions.create(**request)
+            )
+            return self._with_image_metadata(self._parse_response(response), encoded_images)
+        except Exception as e:
+            raise LLMServiceError.from_exception(e, self.provider, "OpenAI API 图像分析错误")
+    
+    async def aclose(self) -> None:
+        await self._aclose_sdk_client()
+
+# =======================
+# Anthropic服务实现
+# =======================
+
+class AnthropicService(BaseLLMService):
+    """Anthropic API服务实现"""
+    
+    def __init__(self, config: LLMServiceConfig):
+        super().__init__(config)
+        anthropic = _lazy_import("anthropic")
+        self._create_clients(anthropic.Anthropic, anthropic.AsyncAnthropic)
+    
+    def _chat_request(self, prompt: str) -> Dict[str, Any]:
+        """构造聊天请求参数"""
+        return {
+            "model": self.model_name,
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature,
+            "messages": [{"role": "user", "content": prompt}]
+        }
+    
+    def _analyze_request(self, prompt: str, encoded_images: List[EncodedImage]) -> Dict[str, Any]:
+        """构造图像分析请求参数"""
+        return {
+            "model": self.model_name,
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature,
+            "messages": [{
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": prompt
+                    }
+                ] + [
+                    {
+                        "type": "image",
+                        "source": self._image_source(encoded)
+                    }
+                    for encoded in encoded_images
+                ]
+            }]
+        }
+    
+    @staticmethod
+    def _image_source(encoded: EncodedImage) -> Dict[str, Any]:
+        """构造图像来源，URL直接传递，其余以base64上传"""
+        if encoded.url:
+            return {"type": "url", "url": encoded.url}
+        return {
+            "type": "base64",
+            "media_type": encoded.media_type,
+            "data": encoded.base64_data
+        }
+    
+    def _parse_response(self, response) -> Dict[str, Any]:
+        """将SDK响应转换为统一格式"""
+        return {
+            "raw_content": response.content[0].text,
+            "provider": self.provider,
+            "model": self.model_name,
+            "finish_reason": response.stop_reason
+        }
+    
+    def chat(self, prompt: str) -> Dict[str, Any]:
+        """实现Anthropic聊天"""
+        try:
+            request = self._chat_request(prompt)
+            response = self._with_api_key(
+                lambda api_key: self.clients[api_key].messages.create(**request)
+            )
+            return self._parse_response(response)
+        except Exception as e:
+            raise LLMServiceError.from_exception(e, self.provider, "Anthropic API 错误")
+    
+    def analyze(self, prompt: str, image: 'Image.Image') -> Dict[str, Any]:
+        """实现Anthropic图像分析"""
+        try:
+            encoded_images = self._encode_images(image)
+            request = self._analyze_request(prompt, encoded_images)
+            response = self._with_api_key(
+                lambda api_key: self.clients[api_key].messages.create(**request)
+            )
+            return self._with_image_metadata(self._parse_response(response), encoded_images)
+        except Exception as e:
+            raise LLMServiceError.from_exception(e, self.provider, "Anthropic API 图像分析错误")
+    
+    async def achat(self, prompt: str) -> Dict[str, Any]:
+        """实现Anthropic异步聊天"""
+        try:
+            request = self._chat_request(prompt)
+            response = await self._awith_api_key(
+                lambda api_key: self.async_clients[api_key].messages.create(**request)
+            )
+            return self._parse_response(response)
+        except Exception as e:
+            raise LLMServiceError.from_exception(e, self.provider, "Anthropic API 错误")
+    
+    async def aanalyze(self, prompt: str, image: 'Image.Image') -> Dict[str, Any]:
+        """实现Anthropic异步图像分析"""
+        try:
+            encoded_images = await self._aencode_images(image)
+            request = self._analyze_request(prompt, encoded_images)
+            response = await self._awith_api_key(
+                lambda api_key: self.async_clients[api_key].messages.create(**request)
+            )
+            return self._with_image_metadata(self._parse_response(response), encoded_images)
+        except Exception as e:
+            raise LLMServiceError.from_exception(e, self.provider, "Anthropic API 图像分析错误")
+    
+    async def aclose(self) -> None:
+        await self._aclose_sdk_client()
+
+# =======================
+# Google Gemini服务实现
+# =======================
+
+class GeminiService(BaseLLMService):
+    """Google Gemini API服务实现"""
+    
+    def __init__(self, config: LLMServiceConfig):
+        super().__init__(config)
+        genai = _lazy_import("genai")
+        # genai.configure是进程级配置，密钥池只用于记录该密钥的限流冷却、断路器状态和统计
+        genai.configure(api_key=self.api_key)
+        self.model = genai.GenerativeModel(
+            model_name=self.model_name,
+            generation_config=genai.GenerationConfig(
+                temperature=self.temperature,
+                max_output_tokens=self.max_tokens
+            )
+        )
+    
+    def _parse_response(self, response) -> Dict[str, Any]:
+        """将SDK响应转换为统一格式"""
+        return {
+            "raw_content": response.text,
+            "provider": self.provider,
+            "model": self.model_name,
+            "finish_reason": None  # Gemini不提供finish_reason
+        }
+    
+    def chat(self, prompt: str) -> Dict[str, Any]:
+        """实现Gemini聊天"""
+        try:
+            response = self._with_api_key(
+                lambda api_key: self.model.generate_content(
+                    prompt,
+                    request_options={"timeout": self.timeout}
+                )
+            )
+            return self._parse_response(response)
+        except Exception as e:
+            raise LLMServiceError.from_exception(e, self.provider, "Gemini API 错误")
+    
+    def analyze(self, prompt: str, image: 'Image.Image') -> Dict[str, Any]:
+        """实现Gemini图像分析"""
+        try:
+            encoded_images = self._encode_images(image)
+            contents = [prompt] + [
+                {"mime_type": encoded.media_type, "data": bytes(encoded.data)}
+                for encoded in encoded_images
+            ]
+            response = self._with_api_key(
+                lambda api_key: self.model.generate_content(
+                    contents,
+                    request_options={"timeout": self.timeout}
+                )
+            )
+            return self._with_image_metadata(self._parse_response(response), encoded_images)
+        except Exception as e:
+            raise LLMServiceError.from_exception(e, self.provider, "Gemini API 图像分析错误")
+    
+    async def achat(self, prompt: str) -> Dict[str, Any]:
+        """实现Gemini异步聊天"""
+        try:
+            response = await self._awith_api_key(
+                lambda api_key: self.model.generate_content_async(
+                    prompt,
+                    request_options={"timeout": self.timeout}
+                )
+            )
+            return self._parse_response(response)
+        except Exception as e:
+            raise LLMServiceError.from_exception(e, self.provider, "Gemini API 错误")
+    
+    async def aanalyze(self, prompt: str, image: 'Image.Image') -> Dict[str, Any]:
+        """实现Gemini异步图像分析"""
+        try:
+            encoded_images = await self._aencode_images(image)
+            contents = [prompt] + [
+                {"mime_type": encoded.media_type, "data": bytes(encoded.data)}
+                for encoded in encoded_images
+            ]
+            response = await self._awith_api_key(
+                lambda api_key: self.model.generate_content_async(
+                    contents,
+                    request_options={"timeout": self.timeout}
+                )
+            )
+            return self._with_image_metadata(self._parse_response(response), encoded_images)
+        except Exception as e:
+            raise LLMServiceError.from_exception(e, self.provider, "Gemini API 图像分析错误")
+
+# =======================
+# 服务工厂
+# =======================
+
+class ServiceFactory:
+    """LLM服务工厂，创建不同提供商的服务实例"""
+    
+    @staticmethod
+    def create_service(config: LLMServiceConfig) -> BaseLLMService:
+        """
+        创建LLM服务实例
+        
+        Args:
+            config: 服务配置
+            
+        Returns:
+            BaseLLMService: 服务实例
+        """
+        if config.provider == "openai":
+            return OpenAIService(config)
+        elif config.provider == "anthropic":
+            return AnthropicService(config)
+        elif config.provider == "gemini":
+            return GeminiService(config)
+        else:
+            raise ValueError(f"不支持的服务提供商: {config.provider}")
+
+# =======================
+# 响应缓存
+# =======================
+
+class ResponseCache:
+    """进程内响应缓存，支持TTL过期和LRU淘汰"""
+    
+    def __init__(
+        self,
+        ttl: float = 300.0,
+        max_entries: int = 1024,
+        max_bytes: Optional[int] = None
+    ):
+        """
+        初始化响应缓存
+        
+        Args:
+            ttl: 缓存有效期(秒)
+            max_entries: 最大缓存条目数
+            max_bytes: 缓存响应的最大总字节数(按JSON序列化后的大小估算)，None表示不限制
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # 缓存键 -> (过期时间, 响应, 字节数)
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    @staticmethod
+    def make_key(
+        method_name: str,
+        prompt: str,
+        image_digest: Optional[str],
+        temperature: float,
+        max_tokens: int
+    ) -> str:
+        """
+        生成缓存键
+        
+        提示词经过Unicode NFC规范化并去除首尾空白后参与哈希。
+        
+        Args:
+            method_name: 方法名称，如'chat'或'analyze'
+            prompt: 用户提示词
+            image_digest: 图像内容摘要，无图像时为None
+            temperature: 采样温度
+            max_tokens: 最大输出token数
+            
+        Returns:
+            str: 缓存键
+        """
+        normalized_prompt = unicodedata.normalize("NFC", prompt).strip()
+        payload = json.dumps(
+            [method_name, normalized_prompt, image_digest, temperature, max_tokens],
+            ensure_ascii=False
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """获取缓存的响应，未命中或已过期时返回None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            
+            expires_at, response, size = entry
+            if time.time() > expires_at:
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return dict(response)
+    
+    def put(self, key: str, response: Dict[str, Any]) -> None:
+        """缓存响应，超出容量时淘汰最久未使用的条目"""
+        size = len(json.dumps(response, ensure_ascii=False, default=str).encode("utf-8"))
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.time() + self.ttl, dict(response), size)
+            self._total_bytes += size
+            
+            while len(self._entries) > self.max_entries or (
+                self.max_bytes is not None and self._total_bytes > self.max_bytes
+            ):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+    
+    def _remove(self, key: str) -> None:
+        _, _, size = self._entries.pop(key)
+        self._total_bytes -= size
+    
+    def clear(self) -> None:
+        """清空缓存"""
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        获取缓存统计
+        
+        Returns:
+            Dict: 条目数、字节数以及命中、未命中、淘汰和过期计数
+        """
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations
+            }
+
+class SQLiteResponseCache:
+    """
+    基于SQLite(WAL模式)的磁盘响应缓存
+    
+    多个进程可以同时读写同一个缓存文件，缓存内容在进程重启后仍然有效。
+    接口与ResponseCache一致。为避免每次命中都写磁盘，最近访问时间每隔
+    touch_interval秒才更新一次，因此LRU淘汰是近似的。
+    
+    条目数和总字节数由触发器维护在单行的cache_meta表中，写入时无需扫描全表；
+    过期条目和淘汰候选都通过索引查找。
+    """
+    
+    def __init__(
+        self,
+        path: str,
+        ttl: float = 3600.0,
+        max_entries: int = 100000,
+        max_bytes: Optional[int] = None,
+        touch_interval: float = 60.0
+    ):
+        """
+        初始化磁盘响应缓存
+        
+        Args:
+            path: SQLite数据库文件路径
+            ttl: 缓存有效期(秒)
+            max_entries: 最大缓存条目数
+            max_bytes: 缓存响应的最大总字节数，None表示不限制
+            touch_interval: 命中时更新最近访问时间的最小间隔(秒)
+        """
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.touch_interval = touch_interval
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        # 计数仅统计当前进程
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, "
+                "response TEXT NOT NULL, "
+                "size INTEGER NOT NULL, "
+                "expires_at REAL NOT NULL, "
+                "accessed_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_responses_accessed_at ON responses (accessed_at)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_responses_expires_at ON responses (expires_at)"
+            )
+            # 多个进程可能同时初始化同一个文件，在写事务中创建计数表和触发器
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS cache_meta ("
+                    "id INTEGER PRIMARY KEY CHECK (id = 1), "
+                    "entries INTEGER NOT NULL, "
+                    "bytes INTEGER NOT NULL)"
+                )
+                # 旧版本创建的缓存文件没有计数，按现有数据初始化一次
+                conn.execute(
+                    "INSERT OR IGNORE INTO cache_meta (id, entries, bytes) "
+                    "SELECT 1, COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+                )
+                conn.execute(
+                    "CREATE TRIGGER IF NOT EXISTS responses_insert AFTER INSERT ON responses BEGIN "
+                    "UPDATE cache_meta SET entries = entries + 1, bytes = bytes + NEW.size WHERE id = 1; END"
+                )
+                conn.execute(
+                    "CREATE TRIGGER IF NOT EXISTS responses_delete AFTER DELETE ON responses BEGIN "
+                    "UPDATE cache_meta SET entries = entries - 1, bytes = bytes - OLD.size WHERE id = 1; END"
+                )
+                conn.execute(
+                    "CREATE TRIGGER IF NOT EXISTS responses_update AFTER UPDATE OF size ON responses BEGIN "
+                    "UPDATE cache_meta SET bytes = bytes + NEW.size - OLD.size WHERE id = 1; END"
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+    
+    def _connection(self) -> sqlite3.Connection:
+        """获取当前线程的数据库连接"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+    
+    def _count(self, name: str) -> None:
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + 1)
+    
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """获取缓存的响应，未命中或已过期时返回None"""
+        conn = self._connection()
+        row = conn.execute(
+            "SELECT response, expires_at, accessed_at FROM responses WHERE key = ?",
+            (key,)
+        ).fetchone()
+        
+        if row is None:
+            self._count("misses")
+            return None
+        
+        response, expires_at, accessed_at = row
+        now = time.time()
+        if now > expires_at:
+            conn.execute("DELETE FROM responses WHERE key = ? AND expires_at = ?", (key, expires_at))
+            self._count("expirations")
+            self._count("misses")
+            return None
+        
+        if now - accessed_at > self.touch_interval:
+            conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+        
+        self._count("hits")
+        return json.loads(response)
+    
+    def put(self, key: str, response: Dict[str, Any]) -> None:
+        """缓存响应，超出容量时淘汰最久未使用的条目"""
+        data = json.dumps(response, ensure_ascii=False, default=str)
+        size = len(data.encode("utf-8"))
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        
+        now = time.time()
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # 使用UPSERT而非INSERT OR REPLACE: REPLACE删除旧行时不触发删除触发器
+            conn.execute(
+                "INSERT INTO responses (key, response, size, expires_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET response = excluded.response, size = excluded.size, "
+                "expires_at = excluded.expires_at, accessed_at = excluded.accessed_at",
+                (key, data, size, now + self.ttl, now)
+            )
+            self._evict(conn, now)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    
+    def _evict(self, conn: sqlite3.Connection, now: float) -> None:
+        """删除过期条目，并按最近访问时间淘汰超出容量的条目"""
+        conn.execute("DELETE FROM responses WHERE expires_at < ?", (now,))
+        
+        entries, total_bytes = conn.execute(
+            "SELECT entries, bytes FROM cache_meta WHERE id = 1"
+        ).fetchone()
+        excess_entries = max(0, entries - self.max_entries)
+        excess_bytes = max(0, total_bytes - self.max_bytes) if self.max_bytes is not None else 0
+        if not excess_entries and not excess_bytes:
+            return
+        
+        victims = []
+        freed = 0
+        for key, size in conn.execute("SELECT key, size FROM responses ORDER BY accessed_at"):
+            if len(victims) >= excess_entries and freed >= excess_bytes:
+                break
+            victims.append((key,))
+            freed += size
+        
+        conn.executemany("DELETE FROM responses WHERE key = ?", victims)
+        with self._stats_lock:
+            self.evictions += len(victims)
+    
+    def clear(self) -> None:
+        """清空缓存"""
+        self._connection().execute("DELETE FROM responses")
+    
+    def close(self) -> None:
+        """关闭当前线程的数据库连接"""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        获取缓存统计
+        
+        Returns:
+            Dict: 条目数、字节数以及当前进程的命中、未命中、淘汰和过期计数
+        """
+        entries, total_bytes = self._connection().execute(
+            "SELECT entries, bytes FROM cache_meta WHERE id = 1"
+        ).fetchone()
+        with self._stats_lock:
+            return {
+                "entries": entries,
+                "bytes": total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations
+            }
+
+# =======================
+# 路由计划
+# =======================
+
+@dataclass(frozen=True)
+class RouteEntry:
+    """路由计划中的一个模型"""
+    provider: str
+    model: str
+    options: Dict[str, Any] = field(default_factory=dict)  # 覆盖LLMServiceConfig的字段，如max_tokens
+    name: Optional[str] = None  # 服务名称，默认为"<提供商>_<层级名称>"
+
+@dataclass(frozen=True)
+class RoutingTier:
+    """路由计划中的一个故障转移层级"""
+    name: str
+    entries: Tuple[RouteEntry, ...]
+    label: Optional[str] = None  # 日志中的服务描述，默认按层级序号生成
+    message: Optional[str] = None  # 进入该层级时的日志
+
+# 默认路由计划: 主要服务 → 备用服务 → 第三级备选服务
+DEFAULT_ROUTING_PLAN = (
+    RoutingTier("primary", (
+        RouteEntry("openai", "chatgpt-4o-latest"),
+        RouteEntry("anthropic", "claude-3-7-sonnet-20250219"),
+        RouteEntry("gemini", "gemini-2.0-flash-001"),
+    ), label="服务"),
+    RoutingTier("fallback", (
+        RouteEntry("openai", "gpt-4o-mini"),
+        RouteEntry("anthropic", "claude-3-5-sonnet-latest"),
+        RouteEntry("gemini", "gemini-2.0-pro-exp-02-05"),
+    ), label="备用服务", message="所有主要服务调用失败，尝试备用服务"),
+    RoutingTier("fallback2", (
+        RouteEntry("gemini", "gemini-2.0-flash-lite-preview-02-05"),
+    ), label="第三级备选服务", message="所有备用服务调用失败，尝试第三级备选服务"),
+)
+
+@dataclass(frozen=True)
+class CompiledTier:
+    """编译后的层级，service_names已按服务调用顺序排列"""
+    name: str
+    label: str
+    message: Optional[str]
+    service_names: Tuple[str, ...]
+
+@dataclass(frozen=True)
+class CompiledRoutingPlan:
+    """编译后的不可变路由计划"""
+    tiers: Tuple[CompiledTier, ...]
+    configs: Mapping[str, LLMServiceConfig]  # 服务名称 -> 服务配置
+    max_images: Mapping[str, Optional[int]]  # 服务名称 -> 单次请求的图像数量上限
+
+def _as_tier(tier: Union[RoutingTier, Dict[str, Any]]) -> RoutingTier:
+    """将字典形式的层级转换为RoutingTier"""
+    if isinstance(tier, RoutingTier):
+        return tier
+    entries = tuple(
+        entry if isinstance(entry, RouteEntry) else RouteEntry(**entry)
+        for entry in tier.get("entries", ())
+    )
+    return RoutingTier(
+        name=tier["name"],
+        entries=entries,
+        label=tier.get("label"),
+        message=tier.get("message")
+    )
+
+def compile_routing_plan(
+    plan: Sequence[Union[RoutingTier, Dict[str, Any]]],
+    key_pools: Mapping[str, "APIKeyPool"],
+    service_order: Sequence[str],
+    provider_limits: Optional[Mapping[str, Mapping[str, Any]]] = None,
+    **config_defaults
+) -> CompiledRoutingPlan:
+    """
+    将路由计划编译为不可变的候选列表
+    
+    没有API密钥或不在service_order中的提供商被剔除；同一层级内的条目按提供商
+    在service_order中的位置稳定排序。
+    
+    Args:
+        plan: 按故障转移顺序排列的层级，元素为RoutingTier或等价的字典
+        key_pools: 提供商 -> API密钥池
+        service_order: 提供商调用顺序
+        provider_limits: 提供商 -> 限制，目前支持max_images，未指定时使用PROVIDER_IMAGE_LIMITS
+        **config_defaults: 各服务配置的默认字段，如timeout、max_tokens
+        
+    Returns:
+        CompiledRoutingPlan: 编译后的路由计划
+        
+    Raises:
+        ValueError: 层级或服务名称重复、选项不是LLMServiceConfig的字段
+    """
+    rank = {provider: index for index, provider in enumerate(service_order)}
+    provider_limits = provider_limits or {}
+    config_fields = {f.name for f in fields(LLMServiceConfig)}
+    tier_names = set()
+    configs = {}
+    max_images = {}
+    tiers = []
+    
+    for index, tier in enumerate(_as_tier(tier) for tier in plan):
+        if tier.name in tier_names:
+            raise ValueError(f"路由计划中的层级名称重复: {tier.name}")
+        tier_names.add(tier.name)
+        
+        entries = sorted(
+            (entry for entry in tier.entries if entry.provider in rank and entry.provider in key_pools),
+            key=lambda entry: rank[entry.provider]
+        )
+        service_names = []
+        for entry in entries:
+            service_name = entry.name or f"{entry.provider}_{tier.name}"
+            if service_name in configs:
+                raise ValueError(f"路由计划中的服务名称重复: {service_name}，请为条目指定name")
+            unknown = set(entry.options) - config_fields
+            if unknown:
+                raise ValueError(f"{service_name} 的选项不是服务配置字段: {', '.join(sorted(unknown))}")
+            
+            key_pool = key_pools[entry.provider]
+            config = LLMServiceConfig(
+                provider=entry.provider,
+                model_name=entry.model,
+                api_key=key_pool.keys[0],
+                is_primary=index == 0,
+                key_pool=key_pool,
+                **config_defaults
+            )
+            configs[service_name] = replace(config, **entry.options)
+            limits = {**PROVIDER_IMAGE_LIMITS.get(entry.provider, {}), **provider_limits.get(entry.provider, {})}
+            max_images[service_name] = limits.get("max_images")
+            service_names.append(service_name)
+        
+        tiers.append(CompiledTier(
+            name=tier.name,
+            label=tier.label or ("服务" if index == 0 else f"第{index + 1}级备选服务"),
+            message=tier.message,
+            service_names=tuple(service_names)
+        ))
+    
+    return CompiledRoutingPlan(
+        tiers=tuple(tiers),
+        configs=MappingProxyType(configs),
+        max_images=MappingProxyType(max_images)
+    )
+
+class ModelRegistry:
+    """
+    基于TOML或JSON文件的模型注册表
+    
+    文件描述提供商、模型、限制和故障转移层级，格式如下(JSON格式的结构相同):
+    
+        [providers.openai]
+        options = { timeout = 20.0 }   # 该提供商所有模型的默认选项
+        limits = { max_images = 10 }   # 覆盖PROVIDER_IMAGE_LIMITS
+        
+        [[tiers]]
+        name = "primary"
+        label = "服务"
+        entries = [
+            { provider = "openai", model = "chatgpt-4o-latest" },
+            { provider = "gemini", model = "gemini-2.0-flash-001", options = { max_tokens = 4000 } },
+        ]
+    
+    API密钥不写入注册表，仍来自构造参数或环境变量。
+    """
+    
+    def __init__(self, path: Union[str, os.PathLike]):
+        """
+        Args:
+            path: 注册表文件路径，扩展名为.toml时按TOML解析，否则按JSON解析
+        """
+        self.path = os.fspath(path)
+        self._signature = None  # 最近一次加载时文件的(修改时间, 大小)
+    
+    def signature(self) -> Optional[Tuple[int, int]]:
+        """文件当前的(修改时间, 大小)，文件不存在时为None"""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+    
+    def changed(self) -> bool:
+        """文件自上次加载后是否有变化"""
+        return self.signature() != self._signature
+    
+    def load(self) -> Tuple[Tuple[RoutingTier, ...], Dict[str, Dict[str, Any]]]:
+        """
+        读取并解析注册表
+        
+        无论解析是否成功都会记录文件签名，格式错误的文件在再次修改前不会被重复加载。
+        
+        Returns:
+            Tuple: (路由计划, 提供商 -> 限制)
+            
+        Raises:
+            ValueError: 注册表格式错误
+            OSError: 文件无法读取
+        """
+        self._signature = self.signature()
+        with open(self.path, "rb") as f:
+            data = f.read()
+        if self.path.endswith(".toml"):
+            document = _lazy_import("tomllib").loads(data.decode("utf-8"))
+        else:
+            document = json.loads(data)
+        return self.parse(document)
+    
+    @staticmethod
+    def parse(document: Mapping[str, Any]) -> Tuple[Tuple[RoutingTier, ...], Dict[str, Dict[str, Any]]]:
+        """将注册表内容转换为路由计划和提供商限制，提供商的默认选项合并到各条目中"""
+        try:
+            providers = document.get("providers", {})
+            tiers = []
+            for tier in document.get("tiers", ()):
+                entries = []
+                for entry in tier.get("entries", ()):
+                    defaults = providers.get(entry["provider"], {}).get("options", {})
+                    entries.append(RouteEntry(
+                        provider=entry["provider"],
+                        model=entry["model"],
+                        options={**defaults, **entry.get("options", {})},
+                        name=entry.get("name")
+                    ))
+                tiers.append(RoutingTier(
+                    name=tier["name"],
+                    entries=tuple(entries),
+                    label=tier.get("label"),
+                    message=tier.get("message")
+                ))
+            limits = {name: dict(provider.get("limits", {})) for name, provider in providers.items()}
+        except (KeyError, TypeError, AttributeError) as e:
+            raise ValueError(f"模型注册表格式错误: {e!r}") from e
+        if not tiers:
+            raise ValueError("模型注册表中没有定义任何层级")
+        return tuple(tiers), limits
+
+# =======================
+# 稳定LLM服务
+# =======================
+
+class _CallTiming:
+    """一次提交到线程池的服务调用的超时、提交时间和在工作线程中实际开始执行的时间"""
+    
+    __slots__ = ("timeout", "submitted_at", "started_at", "started")
+    
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.started = threading.Event()
+    
+    def wrap(self, method: Callable) -> Callable:
+        """包装服务方法，在开始执行时记录时间"""
+        def run(*args, **kwargs):
+            self.started_at = time.time()
+            self.started.set()
+            return method(*args, **kwargs)
+        return run
+    
+    def deadline(self) -> float:
+        """排队中的调用最多等待timeout开始执行，开始执行后再计timeout"""
+        return (self.started_at or self.submitted_at) + self.timeout
+    
+    def elapsed(self) -> float:
+        """调用的执行耗时，尚未开始时为排队时间"""
+        return time.time() - (self.started_at or self.submitted_at)
+
+class StableLLMService:
+    """稳定的LLM服务，实现多服务提供商策略和故障转移"""
+    
+    # warmup(measure_memory=True)测量内存占用时使用的锁，所有实例共享，避免并发构建时互相停止tracemalloc
+    _memory_measure_lock = threading.Lock()
+    
+    def __init__(
+        self, 
+        openai_api_key: Optional[Union[str, List[str]]] = None,
+        anthropic_api_key: Optional[Union[str, List[str]]] = None,
+        gemini_api_key: Optional[Union[str, List[str]]] = None,
+        service_timeout: float = 10.0,
+        failure_threshold: int = 3,
+        cool_down_period: float = 60.0,
+        service_order: Optional[List[str]] = None,
+        max_workers: Optional[int] = None,
+        hedge_delay: Optional[Union[float, str]] = None,
+        temperature: float = 0.5,
+        max_tokens: int = 2000,
+        cache: Optional[Union["ResponseCache", "SQLiteResponseCache"]] = None,
+        image_quality: int = 85,
+        image_format: Optional[str] = None,
+        downscale_images: bool = True,
+        image_workers: Optional[int] = None,
+        http_pool: Optional[HTTPClientPool] = None,
+        routing_policy: Optional[Union[str, RoutingPolicy]] = None,
+        key_strategy: str = "round_robin",
+        key_cool_down: float = 60.0,
+        routing_plan: Optional[Sequence[Union["RoutingTier", Dict[str, Any]]]] = None,
+        registry: Optional[Union[str, os.PathLike, "ModelRegistry"]] = None,
+        reload_interval: Optional[float] = 5.0,
+        reload_signal: Optional[int] = None,
+        failover_actions: Optional[Mapping[Union[ErrorCategory, str], Union[FailoverAction, str]]] = None,
+        half_open_probes: int = 1,
+        max_cool_down_period: Optional[float] = None,
+        health_monitor: Optional[ServiceHealthMonitor] = None
+    ):
+        """
+        初始化稳定LLM服务
+        
+        Args:
+            openai_api_key: OpenAI API密钥，可为多个密钥的列表或逗号分隔的字符串
+            anthropic_api_key: Anthropic API密钥，同上
+            gemini_api_key: Google Gemini API密钥，同上(Gemini只使用第一个密钥)
+            service_timeout: 服务超时时间(秒)，路由条目options中的timeout可为单个模型覆盖
+            failure_threshold: 触发断路器的连续失败阈值
+            cool_down_period: 冷却期(秒)
+            service_order: 服务调用顺序
+            max_workers: 共享线程池的最大工作线程数，默认为 min(32, CPU核数 + 4)
+            hedge_delay: 对冲请求延迟，默认不启用。为数值(秒)时，当前服务在该时间内
+                未响应即并行调用下一个服务；为"p95"时使用该服务观测到的p95耗时
+            temperature: 各服务使用的采样温度
+            max_tokens: 各服务的最大输出token数
+            cache: 响应缓存(ResponseCache或SQLiteResponseCache)，默认不启用。建议配合temperature=0使用
+            image_quality: 图像以JPEG/WebP上传时的编码质量
+            image_format: 强制使用的图像编码格式("PNG"、"JPEG"或"WEBP")，默认按内容选择
+            downscale_images: 是否按各提供商的有效分辨率缩小图像后再上传
+            image_workers: 多图像请求中并行编码图像的线程数，默认为 min(4, CPU核数)
+            http_pool: OpenAI/Anthropic各模型共享的HTTP连接池，默认为每个实例创建一个。
+                传入的连接池可在多个实例间共享，需由调用方负责关闭
+            routing_policy: 同一层级内服务的路由策略，默认按service_order的静态顺序。
+                为"latency"时使用默认参数的LatencyAwarePolicy，为"weighted"或
+                "least_outstanding"时使用等权重的LoadBalancingPolicy
+            key_strategy: 同一提供商多个API密钥的选择策略，"round_robin"或"least_loaded"
+            key_cool_down: 密钥被限流且响应没有Retry-After时的冷却时间(秒)
+            routing_plan: 路由计划，按故障转移顺序排列的层级，每个层级包含若干
+                (提供商, 模型, 选项)条目，默认为DEFAULT_ROUTING_PLAN
+            registry: 模型注册表文件路径或ModelRegistry，指定时路由计划从注册表加载，
+                不能与routing_plan同时使用
+            reload_interval: 检查注册表文件变化的间隔(秒)，为None时不监视文件
+            reload_signal: 触发重新加载注册表的信号，如signal.SIGHUP，只能在主线程中设置
+            failover_actions: 错误类别 -> 故障转移处理方式，覆盖DEFAULT_FAILOVER_ACTIONS中的对应项
+            half_open_probes: 冷却期结束后断路器半开时放行的探测请求数
+            max_cool_down_period: 探测失败后冷却期指数增长的上限(秒)，默认为cool_down_period的16倍
+            health_monitor: 自定义的健康监控器，例如启用按失败率或慢调用率触发的断路器。
+                指定时忽略failure_threshold、cool_down_period、half_open_probes和max_cool_down_period
+        """
+        self.service_timeout = service_timeout
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.cache = cache
+        self.image_options = {
+            "quality": image_quality,
+            "image_format": image_format,
+            "downscale": downscale_images
+        }
+        
+        # 从环境变量获取API密钥（如果未提供），首次构建服务时加载.env文件
+        load_env_file()
+        self.key_pools = {}
+        for provider, explicit_keys in (
+            ("openai", openai_api_key),
+            ("anthropic", anthropic_api_key),
+            ("gemini", gemini_api_key)
+        ):
+            keys = self._resolve_api_keys(provider, explicit_keys)
+            if provider == "gemini" and len(keys) > 1:
+                # genai.configure是进程级配置，无法按请求切换密钥，密钥池只保留实际使用的密钥
+                logger.warning("Gemini SDK不支持按请求切换API密钥，只使用第一个密钥")
+                keys = keys[:1]
+            if keys:
+                # 同一提供商的所有模型共享密钥池，每个密钥独立冷却和熔断
+                self.key_pools[provider] = APIKeyPool(
+                    keys,
+                    strategy=key_strategy,
+                    rate_limit_cool_down=key_cool_down,
+                    failure_threshold=failure_threshold,
+                    cool_down_period=cool_down_period
+                )
+        
+        # 从环境变量获取服务调用顺序（如果未提供）
+        if service_order is None and os.environ.get("SERVICE_ORDER"):
+            service_order = os.environ.get("SERVICE_ORDER").split(",")
+            logger.info(f"从环境变量读取服务调用顺序: {', '.join(service_order)}")
+        
+        # 同一提供商和API密钥的所有模型共享一个HTTP客户端
+        self._owns_http_pool = http_pool is None
+        self.http_pool = http_pool or HTTPClientPool()
+        
+        # 设置服务调用顺序
+        self.service_order = service_order or self._default_service_order()
+        logger.info(f"服务调用顺序: {', '.join(self.service_order)}")
+        
+        # 编译路由计划，热路径只遍历编译后的不可变候选列表
+        if registry is not None and routing_plan is not None:
+            raise ValueError("routing_plan和registry不能同时指定")
+        self.registry = ModelRegistry(registry) if isinstance(registry, (str, os.PathLike)) else registry
+        provider_limits = None
+        if self.registry is not None:
+            routing_plan, provider_limits = self.registry.load()
+        self.routing_plan = tuple(routing_plan or DEFAULT_ROUTING_PLAN)
+        self._plan = self._compile_plan(self.routing_plan, provider_limits)
+        self._reload_lock = threading.Lock()
+        self.reload_count = 0
+        
+        # 初始化服务缓存，服务在首次使用时才构建
+        self.services = {}
+        self._service_locks = {name: threading.Lock() for name in self.configs}
+        self._service_errors = {}  # 服务名称 -> 构建失败的错误信息
+        self._service_stats = {}  # 服务名称 -> 构建耗时、内存占用和调用次数
+        
+        # 初始化健康监控器
+        self.health_monitor = health_monitor or ServiceHealthMonitor(
+            failure_threshold=failure_threshold,
+            cool_down_period=cool_down_period,
+            half_open_probes=half_open_probes,
+            max_cool_down_period=max_cool_down_period
+        )
+        
+        # 初始化延迟记录器和对冲请求配置
+        self.latency_tracker = LatencyTracker()
+        if isinstance(hedge_delay, str) and hedge_delay != "p95":
+            raise ValueError(f"不支持的对冲延迟: {hedge_delay}")
+        self.hedge_delay = hedge_delay
+        
+        # 初始化路由策略
+        if routing_policy == "latency":
+            routing_policy = LatencyAwarePolicy()
+        elif routing_policy in LoadBalancingPolicy.STRATEGIES:
+            routing_policy = LoadBalancingPolicy(strategy=routing_policy)
+        elif isinstance(routing_policy, str):
+            raise ValueError(f"不支持的路由策略: {routing_policy}")
+        self.routing_policy = routing_policy or RoutingPolicy()
+        self.routing_policy.bind(self._providers(self._plan))
+        
+        # 按错误类别决定故障转移方式
+        self.failover_actions = dict(DEFAULT_FAILOVER_ACTIONS)
+        for category, action in (failover_actions or {}).items():
+            self.failover_actions[ErrorCategory(category)] = FailoverAction(action)
+        self._fanout_stats = {
+            "hedges_fired": 0,  # 发出的对冲请求数
+            "hedges_won": 0,  # 对冲请求先于原请求成功的次数
+            "races": 0,  # 竞速模式请求数
+            "extra_calls": 0  # 结果被丢弃的额外调用数
+        }
+        
+        # 初始化共享线程池，所有chat/analyze调用复用同一组工作线程
+        self.max_workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers,
+            thread_name_prefix="StableLLMService"
+        )
+        self._executor_lock = threading.Lock()
+        self._submitted_calls = 0
+        self._completed_calls = 0
+        self._abandoned_calls = 0  # 因超时被放弃的调用总数
+        self._leaked_calls = 0  # 已放弃但仍占用工作线程的调用数
+        self._closed = False
+        
+        # 多图像请求的图像编码在独立线程池中进行，避免占满服务调用线程后互相等待
+        self._image_executor = ThreadPoolExecutor(
+            max_workers=image_workers or min(4, os.cpu_count() or 1),
+            thread_name_prefix="StableLLMService-image"
+        )
+        
+        # 监视注册表文件变化，信号处理函数只设置事件，由监视线程执行重新加载
+        self._reload_event = threading.Event()
+        self._watcher = None
+        if self.registry is not None and (reload_interval or reload_signal is not None):
+            if reload_signal is not None:
+                import signal
+                signal.signal(reload_signal, lambda signum, frame: self._reload_event.set())
+            self._watcher = threading.Thread(
+                target=self._watch_registry,
+                args=(reload_interval or None,),
+                name="StableLLMService-registry",
+                daemon=True
+            )
+            self._watcher.start()
+    
+    def __enter__(self) -> "StableLLMService":
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+    
+    def close(self, wait: bool = True) -> None:
+        """
+        关闭服务并释放共享线程池
+        
+        Args:
+            wait: 是否等待正在执行的调用完成
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self._watcher is not None:
+            self._reload_event.set()
+            self._watcher.join(timeout=1.0)
+        self._executor.shutdown(wait=wait)
+        self._image_executor.shutdown(wait=wait)
+        if self._owns_http_pool:
+            self.http_pool.close()
+        logger.info("服务已关闭")
+    
+    async def __aenter__(self) -> "StableLLMService":
+        return self
+    
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        await self.aclose()
+    
+    async def aclose(self) -> None:
+        """关闭各服务的异步客户端，并关闭服务"""
+        for service in self.services.values():
+            try:
+                await service.aclose()
+            except Exception as e:
+                logger.warning(f"关闭异步客户端失败: {str(e)}")
+        if self._owns_http_pool:
+            await self.http_pool.aclose()
+        self.close(wait=False)
+    
+    @staticmethod
+    def _resolve_api_keys(provider: str, explicit_keys: Optional[Union[str, List[str]]]) -> List[str]:
+        """
+        解析提供商的API密钥列表
+        
+        优先使用显式传入的密钥，其次为环境变量<PROVIDER>_API_KEYS(逗号分隔)，
+        最后为<PROVIDER>_API_KEY
+        """
+        if explicit_keys is None:
+            prefix = provider.upper()
+            explicit_keys = os.environ.get(f"{prefix}_API_KEYS") or os.environ.get(f"{prefix}_API_KEY")
+        if not explicit_keys:
+            return []
+        if isinstance(explicit_keys, str):
+            explicit_keys = explicit_keys.split(",")
+        return [key.strip() for key in explicit_keys if key and key.strip()]
+    
+    def get_key_pool_stats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        获取各提供商API密钥池的状态
+        
+        Returns:
+            Dict: 提供商 -> 密钥指纹 -> 进行中请求数、请求数、限流次数、连续失败次数和剩余冷却时间
+        """
+        return {provider: pool.stats() for provider, pool in self.key_pools.items()}
+    
+    def _default_service_order(self) -> List[str]:
+        """确定默认服务调用顺序: 已配置API密钥的提供商"""
+        available_providers = list(self.key_pools)
+        
+        if not available_providers:
+            raise ValueError("未配置任何服务提供商，请提供至少一个API密钥")
+        
+        return available_providers
+    
+    def _compile_plan(
+        self,
+        routing_plan: Sequence[Union[RoutingTier, Dict[str, Any]]],
+        provider_limits: Optional[Mapping[str, Mapping[str, Any]]] = None
+    ) -> CompiledRoutingPlan:
+        """使用本实例的密钥池、服务顺序和默认参数编译路由计划"""
+        return compile_routing_plan(
+            routing_plan,
+            self.key_pools,
+            self.service_order,
+            provider_limits=provider_limits,
+            timeout=self.service_timeout,
+            max_tokens=self.max_tokens,
+            temperature=self.temperature,
+            http_pool=self.http_pool
+        )
+    
+    def reload_registry(self) -> Dict[str, List[str]]:
+        """
+        重新加载模型注册表并原子替换路由表
+        
+        新路由表在锁外加载和编译，完成后以单次赋值替换，进行中的请求继续使用
+        开始时取得的路由表。配置未变化的服务沿用已构建的实例及其客户端；配置
+        变化的服务在下次使用时按新配置构建，其断路器状态被清除。加载或编译失败
+        时保留当前路由表。
+        
+        Returns:
+            Dict: "added"、"removed"、"changed"和"kept"对应的服务名称列表
+            
+        Raises:
+            ValueError: 未配置注册表或注册表格式错误
+        """
+        if self.registry is None:
+            raise ValueError("未配置模型注册表")
+        routing_plan, provider_limits = self.registry.load()
+        plan = self._compile_plan(routing_plan, provider_limits)
+        
+        with self._reload_lock:
+            old_configs = self._plan.configs
+            diff = {"added": [], "removed": [], "changed": [], "kept": []}
+            for service_name, config in plan.configs.items():
+                if service_name not in old_configs:
+                    diff["added"].append(service_name)
+                elif old_configs[service_name] != config:
+                    diff["changed"].append(service_name)
+                else:
+                    diff["kept"].append(service_name)
+            diff["removed"] = [name for name in old_configs if name not in plan.configs]
+            
+            for service_name in diff["added"]:
+                self._service_locks.setdefault(service_name, threading.Lock())
+            for service_name in diff["changed"] + diff["removed"]:
+                self._service_errors.pop(service_name, None)
+                self._service_stats.pop(service_name, None)
+                self.health_monitor.reset(service_name)
+            
+            # 先替换服务表再替换路由表，两者都是新对象，读取方不会看到修改中的字典
+            self.services = {
+                name: service for name, service in self.services.items() if name in diff["kept"]
+            }
+            self._plan = plan
+            self.routing_policy.bind(self._providers(plan))
+            self.routing_plan = routing_plan
+            self.reload_count += 1
+        
+        logger.info(
+            f"已重新加载模型注册表: 新增 {len(diff['added'])}，移除 {len(diff['removed'])}，"
+            f"变更 {len(diff['changed'])}，沿用 {len(diff['kept'])}"
+        )
+        return diff
+    
+    def _watch_registry(self, interval: Optional[float]) -> None:
+        """监视线程: 文件变化或收到信号时重新加载注册表"""
+        while not self._closed:
+            requested = self._reload_event.wait(interval)
+            if self._closed:
+                return
+            self._reload_event.clear()
+            if requested or self.registry.changed():
+                try:
+                    self.reload_registry()
+                except Exception as e:
+                    logger.error(f"重新加载模型注册表失败，继续使用当前路由表: {str(e)}")
+    
+    @staticmethod
+    def _providers(plan: CompiledRoutingPlan) -> Dict[str, str]:
+        """服务名称 -> 提供商名称"""
+        return {name: config.provider for name, config in plan.configs.items()}
+    
+    @property
+    def configs(self) -> Mapping[str, LLMServiceConfig]:
+        """服务名称 -> 服务配置，来自编译后的路由计划"""
+        return self._plan.configs
+    
+    def _initialize_service(
+        self, service_name: str, measure_memory: bool = False
+    ) -> Optional[BaseLLMService]:
+        """
+        按需构建服务，每个服务只构建一次
+        
+        并发的首次调用中只有一个线程执行构建，其余线程等待其结果。构建失败会被
+        记录，之后不再重试，该服务在故障转移链中按未初始化处理。
+        
+        Args:
+            service_name: 服务名称，如'openai_primary'
+            measure_memory: 是否用tracemalloc估算构建占用的内存，会显著拖慢SDK导入，
+                只在warmup中按需开启；不测量时memory_bytes为None
+            
+        Returns:
+            Optional[BaseLLMService]: 服务实例，未配置或构建失败时为None
+        """
+        service = self.services.get(service_name)
+        if service is not None or service_name not in self.configs:
+            return service
+        
+        with self._service_locks[service_name]:
+            service = self.services.get(service_name)
+            if service is not None or service_name in self._service_errors:
+                return service
+            
+            config = self.configs.get(service_name)
+            if config is None:
+                return None
+            start = time.perf_counter()
+            try:
+                if measure_memory:
+                    service, memory_bytes = self._measure_memory(ServiceFactory.create_service, config)
+                else:
+                    service, memory_bytes = ServiceFactory.create_service(config), None
+            except Exception as e:
+                self._service_errors[service_name] = str(e)
+                logger.error(f"初始化服务 {service_name} 失败: {str(e)}")
+                return None
+            
+            self._service_stats[service_name] = {
+                "construct_time": round(time.perf_counter() - start, 6),
+                "memory_bytes": memory_bytes,
+                "calls": 0
+            }
+            with self._reload_lock:
+                # 构建期间路由表被替换且该服务配置已变化时，本次调用仍使用该实例，但不缓存
+                if self.configs.get(service_name) == config:
+                    self.services[service_name] = service
+            logger.info(f"已初始化服务: {service_name} ({config.model_name})")
+            return service
+    
+    @staticmethod
+    def _measure_memory(fn: Callable, *args) -> Tuple[Any, Optional[int]]:
+        """
+        执行fn并估算其新分配且仍被持有的内存(字节)
+        
+        未启用tracemalloc时只在本次调用期间临时启用。首次构建某提供商的服务时
+        包含导入SDK的开销，期间其他线程的分配也会被计入，结果为近似值。
+        """
+        import tracemalloc
+        
+        with StableLLMService._memory_measure_lock:
+            started = not tracemalloc.is_tracing()
+            if started:
+                tracemalloc.start()
+            try:
+                before = tracemalloc.get_traced_memory()[0]
+                result = fn(*args)
+                return result, max(0, tracemalloc.get_traced_memory()[0] - before)
+            finally:
+                if started:
+                    tracemalloc.stop()
+    
+    def _service_for_call(self, service_name: str) -> BaseLLMService:
+        """获取用于本次调用的服务实例，按需构建并计入调用次数"""
+        service = self._initialize_service(service_name)
+        if service is None:
+            raise Exception(f"服务 {service_name} 未初始化")
+        stats = self._service_stats.get(service_name)
+        if stats is not None:
+            with self._executor_lock:
+                stats["calls"] += 1
+        return service
+    
+    def warmup(
+        self, service_names: Optional[Iterable[str]] = None, measure_memory: bool = False
+    ) -> Dict[str, Any]:
+        """
+        提前构建服务，避免首个请求承担构建开销
+        
+        Args:
+            service_names: 要构建的服务名称，默认为所有已配置的服务
+            measure_memory: 是否估算每个服务构建时的内存占用(memory_bytes)，
+                会使构建变慢；已构建的服务不会重新测量
+            
+        Returns:
+            Dict: 服务名称 -> 构建统计，构建失败的服务为{"error": 错误信息}
+        """
+        results = {}
+        for service_name in service_names or list(self.configs):
+            if self._initialize_service(service_name, measure_memory) is None:
+                results[service_name] = {
+                    "error": self._service_errors.get(service_name, "未配置的服务")
+                }
+            else:
+                results[service_name] = dict(self._service_stats.get(service_name, {}))
+        return results
+    
+    def _get_service(self, provider: str, primary: bool = True) -> Optional[BaseLLMService]:
+        """获取指定提供商的服务"""
+        service_key = f"{provider}_{'primary' if primary else 'fallback'}"
+        return self._initialize_service(service_key)
+    
+    def _is_rate_limited(self, error: Exception) -> bool:
+        """检测是否为限流错误"""
+        return is_rate_limit_error(error)
+    
+    def _call_with_timeout(
+        self, 
+        service_name: str, 
+        method_name: str, 
+        *args, 
+        **kwargs
+    ) -> Dict[str, Any]:
+        """
+        带超时控制的服务调用
+        
+        超时从调用在工作线程中开始执行时计算。线程池被挂起的调用占满时，排队
+        超过一个超时周期的调用被取消并抛出queue_timeout错误，不计入服务失败。
+        """
+        if self._closed:
+            raise RuntimeError("服务已关闭，无法继续调用")
+        
+        service = self._service_for_call(service_name)
+        method = getattr(service, method_name)
+        
+        timing = _CallTiming(self._timeout_for(service_name))
+        future = self._submit_call(service_name, timing.wrap(method), *args, **kwargs)
+        try:
+            if not timing.started.wait(timing.timeout):
+                if self._cancel_queued(future):
+                    raise self._queue_timeout_error(service_name, timing.timeout)
+                timing.started.wait()  # 取消失败说明调用刚刚开始执行
+            result = future.result(timeout=max(0.0, timing.deadline() - time.time()))
+            self._record_success(service_name, timing.elapsed())
+            return result
+        except TimeoutError:
+            # 不等待挂起的调用结束，直接放弃并交还控制权给故障转移链
+            self._abandon(future)
+            raise self._timeout_error(service_name, timing.timeout)
+    
+    def _timeout_for(self, service_name: str) -> float:
+        """服务的调用超时，路由条目或注册表options中的timeout优先于service_timeout"""
+        config = self.configs.get(service_name)
+        return config.timeout if config is not None else self.service_timeout
+    
+    def _timeout_error(self, service_name: str, timeout: float) -> LLMServiceError:
+        """服务调用执行超时的错误，同步、异步和并发调用共用"""
+        return LLMServiceError(
+            f"服务 {service_name} 响应超时 (>{timeout}s)",
+            category=ErrorCategory.TIMEOUT,
+            error_type="TimeoutError"
+        )
+    
+    def _queue_timeout_error(self, service_name: str, timeout: float) -> LLMServiceError:
+        """调用在线程池中排队超时的错误"""
+        return LLMServiceError(
+            f"服务 {service_name} 的调用在线程池中排队超时 (>{timeout}s)，请求未发出",
+            category=ErrorCategory.QUEUE_TIMEOUT,
+            error_type="QueueTimeout"
+        )
+    
+    def _cancel_queued(self, future) -> bool:
+        """取消尚未开始执行的调用并计入放弃数，调用已开始执行时返回False"""
+        if not future.cancel():
+            return False
+        with self._executor_lock:
+            self._abandoned_calls += 1
+        return True
+    
+    def _abandon(self, future) -> None:
+        """放弃一个已超时的调用，仍在运行的调用计入泄漏数直到其结束"""
+        if self._cancel_queued(future):
+            return
+        
+        with self._executor_lock:
+            self._abandoned_calls += 1
+            self._leaked_calls += 1
+        future.add_done_callback(self._on_leaked_call_done)
+    
+    def _on_leaked_call_done(self, future) -> None:
+        with self._executor_lock:
+            self._leaked_calls -= 1
+    
+    def _discard(self, future, service_name: str, timing: Optional[_CallTiming] = None) -> None:
+        """
+        丢弃一个不再需要的调用结果
+        
+        调用结束后仍按其真实结果和执行耗时更新服务健康状态，被取消的调用不计为失败。
+        """
+        if future.cancel():
+            self.health_monitor.release(service_name)
+            return
+        
+        with self._executor_lock:
+            self._fanout_stats["extra_calls"] += 1
+        self._abandon(future)
+        
+        def record_outcome(done_future):
+            latency = None if timing is None else timing.elapsed()
+            error = done_future.exception()
+            if error is None:
+                self.health_monitor.record_success(service_name, latency)
+                self.routing_policy.record(service_name, None, True)
+            elif self.failover_actions.get(classify_error(error)) in (
+                FailoverAction.SKIP_MODEL, FailoverAction.FAIL_FAST
+            ):
+                self.health_monitor.release(service_name)
+            else:
+                self.health_monitor.record_failure(service_name, latency)
+                self.routing_policy.record(service_name, None, False)
+        
+        future.add_done_callback(record_outcome)
+    
+    def _submit(self, fn: Callable, *args, **kwargs):
+        """向共享线程池提交任务，并维护调用计数"""
+        with self._executor_lock:
+            self._submitted_calls += 1
+        future = self._executor.submit(fn, *args, **kwargs)
+        future.add_done_callback(self._on_call_done)
+        return future
+    
+    def _submit_call(self, service_name: str, method: Callable, *args, **kwargs):
+        """提交一次服务调用，并向路由策略报告调用的开始和实际结束"""
+        self.routing_policy.on_call_start(service_name)
+        try:
+            future = self._submit(method, *args, **kwargs)
+        except Exception:
+            self.routing_policy.on_call_end(service_name)
+            raise
+        future.add_done_callback(lambda _: self.routing_policy.on_call_end(service_name))
+        return future
+    
+    def _on_call_done(self, future) -> None:
+        with self._executor_lock:
+            self._completed_calls += 1
+    
+    def get_executor_stats(self) -> Dict[str, Any]:
         """
-        创建LLM服务实例
+        获取共享线程池的运行统计
         
-        Args:
-            config: 服务配置
-            
         Returns:
-            BaseLLMService: 服务实例
+            Dict: 包含线程数、排队深度和调用计数的字典
         """
-        if config.provider == "openai":
-            return OpenAIService(config)
-        elif config.provider == "anthropic":
-            return AnthropicService(config)
-        elif config.provider == "gemini":
-            return GeminiService(config)
-        else:
-            raise ValueError(f"不支持的服务提供商: {config.provider}")
-
-# =======================
-# 稳定LLM服务
-# =======================
-
-class StableLLMService:
-    """稳定的LLM服务，实现多服务提供商策略和故障转移"""
+        with self._executor_lock:
+            submitted = self._submitted_calls
+            completed = self._completed_calls
+            abandoned = self._abandoned_calls
+            leaked = self._leaked_calls
+        
+        return {
+            "max_workers": self.max_workers,
+            "threads": len(getattr(self._executor, "_threads", ())),
+            "queue_depth": self._executor._work_queue.qsize(),
+            "in_flight": submitted - completed,
+            "submitted": submitted,
+            "completed": completed,
+            "abandoned_calls": abandoned,
+            "leaked_calls": leaked,
+            "closed": self._closed
+        }
     
-    def __init__(
-        self, 
-        openai_api_key: Optional[str] = None,
-        anthropic_api_key: Optional[str] = None,
-        gemini_api_key: Optional[str] = None,
-        service_timeout: float = 10.0,
-        failure_threshold: int = 3,
-        cool_down_period: float = 60.0,
-        service_order: Optional[List[str]] = None
+    def _iter_candidates(
+        self,
+        errors: List[Dict[str, Any]],
+        image_count: int = 0,
+        skipped_providers: Optional[set] = None
     ):
         """
-        初始化稳定LLM服务
+        按故障转移顺序生成可调用的服务
+        
+        依次遍历编译后路由计划的各个层级，跳过构建失败的服务；断路器已触发或
+        单次请求图像数量上限不足的服务会被跳过并记录到errors中。生成的服务
+        已占用断路器的探测名额(半开状态时)，调用结果必须记录到健康监控器。
         
         Args:
-            openai_api_key: OpenAI API密钥
-            anthropic_api_key: Anthropic API密钥
-            gemini_api_key: Google Gemini API密钥
-            service_timeout: 服务超时时间(秒)
-            failure_threshold: 触发断路器的连续失败阈值
-            cool_down_period: 冷却期(秒)
-            service_order: 服务调用顺序
+            errors: 错误记录列表，被跳过的服务会追加到其中
+            image_count: 请求中的图像数量
+            skipped_providers: 本次请求跳过的提供商，生成过程中可由调用方添加
+            
+        Yields:
+            Tuple[str, str]: (服务名称, 日志中使用的服务层级描述)
         """
-        self.service_timeout = service_timeout
+        plan = self._plan
+        for tier in plan.tiers:
+            if tier.message:
+                logger.info(tier.message)
+            
+            label = tier.label
+            for service_name in self.routing_policy.order(tier.service_names, tier.name):
+                if skipped_providers and plan.configs[service_name].provider in skipped_providers:
+                    logger.info(f"{label} {service_name} 的提供商已拒绝本次请求，跳过")
+                    continue
+                
+                # 检查图像数量是否超出提供商上限，不计入服务失败
+                max_images = plan.max_images[service_name]
+                if max_images is not None and image_count > max_images:
+                    logger.warning(f"{label} {service_name} 最多支持 {max_images} 张图像，跳过")
+                    errors.append({
+                        "service": service_name,
+                        "error": f"图像数量 {image_count} 超出上限 {max_images}"
+                    })
+                    continue
+                
+                # 首次使用时构建服务，构建失败的服务跳过
+                if self._initialize_service(service_name) is None:
+                    logger.warning(f"{label} {service_name} 未初始化，跳过")
+                    continue
+                
+                # 检查服务是否可用，半开状态下占用一个探测名额，因此放在最后检查
+                if not self.health_monitor.try_acquire(service_name):
+                    logger.warning(f"{label} {service_name} 暂时禁用，跳过")
+                    errors.append({
+                        "service": service_name,
+                        "error": "服务暂时禁用（断路器已触发）"
+                    })
+                    continue
+                
+                yield service_name, label
+    
+    def _record_success(self, service_name: str, latency: float) -> None:
+        """记录一次服务调用成功及其耗时"""
+        self.health_monitor.record_success(service_name, latency)
+        self.latency_tracker.record(service_name, latency)
+        self.routing_policy.record(service_name, latency, True)
+    
+    def _record_call_error(
+        self,
+        service_name: str,
+        label: str,
+        error: Exception,
+        errors: List[Dict[str, Any]],
+        skipped_providers: Optional[set] = None,
+        latency: Optional[float] = None
+    ) -> FailoverAction:
+        """
+        记录一次服务调用失败并返回故障转移方式
         
-        # 从环境变量获取API密钥（如果未提供）
-        openai_api_key = openai_api_key or os.environ.get("OPENAI_API_KEY")
-        anthropic_api_key = anthropic_api_key or os.environ.get("ANTHROPIC_API_KEY")
-        gemini_api_key = gemini_api_key or os.environ.get("GEMINI_API_KEY")
+        只有RETRY和SKIP_PROVIDER计入服务失败，失败耗时latency一并计入断路器的
+        慢调用统计；SKIP_PROVIDER时将该服务的提供商加入skipped_providers。
+        超时也只在这里记录一次。
+        """
+        error_msg = str(error)
+        logger.warning(f"{label} {service_name} 调用失败: {error_msg}")
         
-        # 从环境变量获取服务调用顺序（如果未提供）
-        if service_order is None and os.environ.get("SERVICE_ORDER"):
-            service_order = os.environ.get("SERVICE_ORDER").split(",")
-            logger.info(f"从环境变量读取服务调用顺序: {', '.join(service_order)}")
+        # 服务抛出的LLMServiceError已带有类别，无需再解析错误消息
+        error = LLMServiceError.from_exception(error)
+        action = self.failover_actions.get(error.category, FailoverAction.RETRY)
         
-        # 初始化服务配置
-        self.configs = {}
+        # 记录失败，请求本身的错误不影响服务健康状态，只归还探测名额
+        if action in (FailoverAction.RETRY, FailoverAction.SKIP_PROVIDER):
+            self.health_monitor.record_failure(service_name, latency)
+            self.routing_policy.record(service_name, None, False)
+        else:
+            self.health_monitor.release(service_name)
         
-        # 添加主要服务配置
-        if openai_api_key:
-            self.configs["openai_primary"] = LLMServiceConfig(
-                provider="openai",
-                model_name="chatgpt-4o-latest",
-                api_key=openai_api_key,
-                is_primary=True
-            )
-            self.configs["openai_fallback"] = LLMServiceConfig(
-                provider="openai",
-                model_name="gpt-4o-mini",
-                api_key=openai_api_key,
-                is_primary=False
-            )
+        # 记录错误
+        entry = {
+            "service": service_name,
+            "error": error_msg,
+            "is_rate_limited": error.category is ErrorCategory.RATE_LIMIT
+        }
+        entry.update(error.to_dict())
+        errors.append(entry)
         
-        if anthropic_api_key:
-            self.configs["anthropic_primary"] = LLMServiceConfig(
-                provider="anthropic",
-                model_name="claude-3-7-sonnet-20250219",
-                api_key=anthropic_api_key,
-                is_primary=True
-            )
-            self.configs["anthropic_fallback"] = LLMServiceConfig(
-                provider="anthropic",
-                model_name="claude-3-5-sonnet-latest",
-                api_key=anthropic_api_key,
-                is_primary=False
-            )
+        if error.category is ErrorCategory.RATE_LIMIT:
+            # 如果是限流错误，立即尝试下一个服务
+            logger.info(f"检测到限流错误，立即切换到下一个服务")
+        elif action is FailoverAction.SKIP_PROVIDER and skipped_providers is not None:
+            config = self.configs.get(service_name)
+            if config is not None:
+                skipped_providers.add(config.provider)
+        elif action is FailoverAction.FAIL_FAST:
+            logger.info(f"请求错误({error.category.value})，停止故障转移")
+        return action
+    
+    def _all_failed(self, errors: List[Dict[str, Any]], fail_fast: bool = False) -> Dict[str, Any]:
+        """构造所有服务均失败或请求被拒绝时的响应"""
+        error_msg = "请求被服务拒绝，已停止故障转移" if fail_fast else "所有LLM服务调用都失败了"
+        logger.error(f"{error_msg}: {json.dumps(errors, indent=2)}")
         
-        if gemini_api_key:
-            self.configs["gemini_primary"] = LLMServiceConfig(
-                provider="gemini",
-                model_name="gemini-2.0-flash-001",
-                api_key=gemini_api_key,
-                is_primary=True
-            )
-            self.configs["gemini_fallback"] = LLMServiceConfig(
-                provider="gemini",
-                model_name="gemini-2.0-pro-exp-02-05",
-                api_key=gemini_api_key,
-                is_primary=False
-            )
-            # 添加第三级备选服务
-            self.configs["gemini_fallback2"] = LLMServiceConfig(
-                provider="gemini",
-                model_name="gemini-2.0-flash-lite-preview-02-05",
-                api_key=gemini_api_key,
-                is_primary=False
-            )
+        return {
+            "error": error_msg,
+            "details": errors,
+            "raw_content": f"服务调用失败: {error_msg}",
+        }
+    
+    def _call_service(
+        self, 
+        method_name: str, 
+        *args, 
+        race: int = 1,
+        **kwargs
+    ) -> Dict[str, Any]:
+        """
+        调用LLM服务，支持自动服务切换
         
-        # 初始化服务缓存
-        self.services = {}
+        Args:
+            method_name: 方法名称，如'chat'或'analyze'
+            *args, **kwargs: 传递给具体方法的参数
+            race: 同时调用的服务数量，大于1时启用竞速模式
+            
+        Returns:
+            Dict: 服务响应
+        """
+        if race < 1:
+            raise ValueError(f"race必须大于等于1: {race}")
         
-        # 初始化健康监控器
-        self.health_monitor = ServiceHealthMonitor(
-            failure_threshold=failure_threshold,
-            cool_down_period=cool_down_period
-        )
+        cache_key = self._cache_key(method_name, args)
+        if cache_key is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                cached["cached"] = True
+                return cached
         
-        # 设置服务调用顺序
-        self.service_order = service_order or self._default_service_order()
-        logger.info(f"服务调用顺序: {', '.join(self.service_order)}")
+        result = self._call_service_uncached(method_name, race, *args, **kwargs)
         
-        # 初始化基本服务
-        self._initialize_services()
+        if cache_key is not None and "error" not in result:
+            self.cache.put(cache_key, result)
+        return result
     
-    def _default_service_order(self) -> List[str]:
-        """确定默认服务调用顺序"""
-        available_providers = []
-        
-        # 检查哪些提供商可用
-        for config_name in self.configs:
-            if "_primary" in config_name:
-                provider = config_name.split("_")[0]
-                if provider not in available_providers:
-                    available_providers.append(provider)
+    def _call_service_uncached(
+        self,
+        method_name: str,
+        race: int,
+        *args,
+        **kwargs
+    ) -> Dict[str, Any]:
+        """执行故障转移链，不经过响应缓存"""
+        if race > 1 or self.hedge_delay is not None:
+            return self._call_service_concurrent(method_name, race, *args, **kwargs)
         
-        if not available_providers:
-            raise ValueError("未配置任何服务提供商，请提供至少一个API密钥")
+        errors = []
+        skipped_providers = set()
         
-        return available_providers
-    
-    def _initialize_services(self) -> None:
-        """初始化基本服务"""
-        for config_name, config in self.configs.items():
+        for service_name, label in self._iter_candidates(errors, self._image_count(args), skipped_providers):
+            started = time.time()
             try:
-                self.services[config_name] = ServiceFactory.create_service(config)
-                logger.info(f"已初始化服务: {config_name} ({config.model_name})")
+                logger.info(f"尝试使用{label}: {service_name}")
+                result = self._call_with_timeout(service_name, method_name, *args, **kwargs)
+                logger.info(f"{label} {service_name} 调用成功")
+                return result
             except Exception as e:
-                logger.error(f"初始化服务 {config_name} 失败: {str(e)}")
+                action = self._record_call_error(
+                    service_name, label, e, errors, skipped_providers, time.time() - started
+                )
+                if action is FailoverAction.FAIL_FAST:
+                    return self._all_failed(errors, fail_fast=True)
+        
+        # 所有服务都失败
+        return self._all_failed(errors)
     
-    def _get_service(self, provider: str, primary: bool = True) -> Optional[BaseLLMService]:
-        """获取指定提供商的服务"""
-        service_key = f"{provider}_{'primary' if primary else 'fallback'}"
-        return self.services.get(service_key)
+    def _prepare_image(
+        self,
+        image: Optional[Union[ImageInput, PreparedImage]] = None,
+        images: Optional[Iterable[Union[ImageInput, PreparedImage]]] = None
+    ) -> Union[PreparedImage, PreparedImageSet]:
+        """将图像包装为本次请求共享的PreparedImage，多张图像时包装为PreparedImageSet"""
+        if (image is None) == (images is None):
+            raise ValueError("必须且只能提供image或images之一")
+        # 无法识别的图像在调用服务前就报错，避免每个服务都失败并触发断路器
+        if image is not None:
+            prepared = PreparedImage.wrap(image, **self.image_options)
+            prepared.validate()
+            return prepared
+        prepared = [PreparedImage.wrap(item, **self.image_options) for item in images]
+        for item in prepared:
+            item.validate()
+        return PreparedImageSet(prepared, executor=self._image_executor)
     
-    def _is_rate_limited(self, error: Exception) -> bool:
-        """检测是否为限流错误"""
-        error_str = str(error).lower()
+    @staticmethod
+    def _image_count(args: Tuple) -> int:
+        """请求参数中的图像数量"""
+        if len(args) < 2:
+            return 0
+        return len(args[1]) if isinstance(args[1], PreparedImageSet) else 1
+    
+    def _cache_key(self, method_name: str, args: Tuple) -> Optional[str]:
+        """生成请求的缓存键，未启用缓存时返回None"""
+        if self.cache is None:
+            return None
         
-        # 通过错误消息判断是否限流
-        rate_limit_keywords = [
-            'rate limit', 'ratelimit', 'too many requests', 
-            '429', 'quota exceeded', 'capacity', 'throttle'
-        ]
+        prompt = args[0]
+        image_digest = None
+        if len(args) > 1:
+            image = args[1]
+            image_digest = image.digest if isinstance(image, PreparedImageSet) else PreparedImage.wrap(image).digest
+        return ResponseCache.make_key(
+            method_name, prompt, image_digest, self.temperature, self.max_tokens
+        )
+    
+    def _get_hedge_delay(self, service_name: str) -> float:
+        """获取服务的对冲延迟，p95样本不足时使用超时时间的一半"""
+        if self.hedge_delay == "p95":
+            p95 = self.latency_tracker.percentile(service_name, 95)
+            return p95 if p95 is not None else self._timeout_for(service_name) / 2
+        return self.hedge_delay
+    
+    def _call_service_concurrent(
+        self,
+        method_name: str,
+        race: int,
+        *args,
+        **kwargs
+    ) -> Dict[str, Any]:
+        """
+        并发调用故障转移链中的服务，先成功者胜出
         
-        # 任何关键词匹配即认为是限流
-        for keyword in rate_limit_keywords:
-            if keyword in error_str:
-                return True
+        按_call_service的故障转移顺序同时保持race个调用在进行中，有调用失败或
+        超时时由链中的下一个服务补上。race为1且启用对冲时，当前服务超过对冲
+        延迟仍未响应则并行调用下一个服务，每个请求最多发出一次对冲。
+        胜出后其余调用被取消或丢弃。
+        
+        Args:
+            method_name: 方法名称，如'chat'或'analyze'
+            race: 同时进行的调用数
+            *args, **kwargs: 传递给具体方法的参数
+            
+        Returns:
+            Dict: 服务响应
+        """
+        if self._closed:
+            raise RuntimeError("服务已关闭，无法继续调用")
+        
+        errors = []
+        skipped_providers = set()
+        candidates = self._iter_candidates(errors, self._image_count(args), skipped_providers)
+        in_flight = {}  # future -> (服务名称, 服务层级描述, _CallTiming, 是否为对冲请求)
+        hedged = self.hedge_delay is None or race > 1
         
-        return False
+        def launch(is_hedge: bool) -> bool:
+            candidate = next(candidates, None)
+            if candidate is None:
+                return False
+            service_name, label = candidate
+            logger.info(f"尝试使用{label}: {service_name}" + (" (对冲请求)" if is_hedge else ""))
+            method = getattr(self._service_for_call(service_name), method_name)
+            timing = _CallTiming(self._timeout_for(service_name))
+            future = self._submit_call(service_name, timing.wrap(method), *args, **kwargs)
+            in_flight[future] = (service_name, label, timing, is_hedge)
+            return True
+        
+        if race > 1:
+            with self._executor_lock:
+                self._fanout_stats["races"] += 1
+        
+        while len(in_flight) < race and launch(False):
+            pass
+        
+        while in_flight:
+            # 计算下一次需要检查的时间点: 最早的超时时间或对冲时间
+            wake_at = min(timing.deadline() for _, _, timing, _ in in_flight.values())
+            hedge_at = None
+            if not hedged and len(in_flight) == 1:
+                service_name, _, timing, _ = next(iter(in_flight.values()))
+                hedge_at = timing.submitted_at + self._get_hedge_delay(service_name)
+                wake_at = min(wake_at, hedge_at)
+            
+            done, _ = wait(
+                list(in_flight),
+                timeout=max(0.0, wake_at - time.time()),
+                return_when=FIRST_COMPLETED
+            )
+            
+            for future in done:
+                service_name, label, timing, is_hedge = in_flight.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    action = self._record_call_error(
+                        service_name, label, e, errors, skipped_providers, timing.elapsed()
+                    )
+                    if action is FailoverAction.FAIL_FAST:
+                        for other_future, (other_name, _, other_timing, _) in in_flight.items():
+                            self._discard(other_future, other_name, other_timing)
+                        return self._all_failed(errors, fail_fast=True)
+                    continue
+                
+                self._record_success(service_name, timing.elapsed())
+                logger.info(f"{label} {service_name} 调用成功")
+                if is_hedge:
+                    with self._executor_lock:
+                        self._fanout_stats["hedges_won"] += 1
+                
+                # 取消或丢弃其余调用，它们的真实结果仍会更新服务健康状态
+                for other_future, (other_name, _, other_timing, _) in in_flight.items():
+                    self._discard(other_future, other_name, other_timing)
+                return result
+            
+            # 取消排队超时的调用，放弃执行超时的调用
+            now = time.time()
+            for future, (service_name, label, timing, _) in list(in_flight.items()):
+                if now < timing.deadline():
+                    continue
+                if timing.started_at is None and self._cancel_queued(future):
+                    del in_flight[future]
+                    self._record_call_error(
+                        service_name, label, self._queue_timeout_error(service_name, timing.timeout), errors
+                    )
+                elif timing.started_at is not None:
+                    # started_at为None但取消失败时调用刚刚开始执行，下一轮按执行时间判断
+                    del in_flight[future]
+                    self._abandon(future)
+                    self._record_call_error(
+                        service_name,
+                        label,
+                        self._timeout_error(service_name, timing.timeout),
+                        errors,
+                        latency=now - timing.started_at
+                    )
+            
+            if hedge_at is not None and len(in_flight) == 1 and now >= hedge_at:
+                if launch(True):
+                    hedged = True
+                    with self._executor_lock:
+                        self._fanout_stats["hedges_fired"] += 1
+            
+            # 补足失败或超时的调用
+            while len(in_flight) < race and launch(False):
+                pass
+        
+        # 所有服务都失败
+        return self._all_failed(errors)
     
-    def _call_with_timeout(
-        self, 
-        service_name: str, 
-        method_name: str, 
-        *args, 
+    def get_http_pool_stats(self) -> Dict[str, Any]:
+        """
+        获取共享HTTP连接池的使用情况
+        
+        Returns:
+            Dict: 每个(提供商, API密钥)客户端的请求数、连接数和空闲连接数
+        """
+        return self.http_pool.stats()
+    
+    def get_fanout_stats(self) -> Dict[str, int]:
+        """
+        获取对冲请求和竞速模式的统计
+        
+        Returns:
+            Dict: 发出的对冲请求数、对冲胜出次数、竞速请求数和结果被丢弃的额外调用数
+        """
+        with self._executor_lock:
+            return dict(self._fanout_stats)
+    
+    async def _acall_with_timeout(
+        self,
+        service_name: str,
+        method_name: str,
+        *args,
         **kwargs
     ) -> Dict[str, Any]:
-        """带超时控制的服务调用"""
-        service = self.services[service_name]
-        method = getattr(service, method_name)
+        """带超时控制的异步服务调用，超时后取消正在进行的请求"""
+        import asyncio
+        service = self._service_for_call(service_name)
+        method = getattr(service, f"a{method_name}")
         
-        with ThreadPoolExecutor() as executor:
-            future = executor.submit(method, *args, **kwargs)
-            try:
-                result = future.result(timeout=self.service_timeout)
-                self.health_monitor.record_success(service_name)
-                return result
-            except TimeoutError:
-                self.health_monitor.record_failure(service_name)
-                raise Exception(f"服务 {service_name} 响应超时 (>{self.service_timeout}s)")
+        timeout = self._timeout_for(service_name)
+        started_at = time.time()
+        self.routing_policy.on_call_start(service_name)
+        try:
+            if hasattr(asyncio, "timeout"):
+                async with asyncio.timeout(timeout):
+                    result = await method(*args, **kwargs)
+            else:
+                # Python 3.11以下没有asyncio.timeout
+                result = await asyncio.wait_for(
+                    method(*args, **kwargs),
+                    timeout=timeout
+                )
+        except asyncio.TimeoutError:
+            raise self._timeout_error(service_name, timeout)
+        finally:
+            self.routing_policy.on_call_end(service_name)
+        
+        self._record_success(service_name, time.time() - started_at)
+        return result
     
-    def _call_service(
-        self, 
-        method_name: str, 
-        *args, 
+    async def _acall_service(
+        self,
+        method_name: str,
+        *args,
         **kwargs
     ) -> Dict[str, Any]:
         """
-        调用LLM服务，支持自动服务切换
+        异步调用LLM服务，故障转移顺序与_call_service一致
         
         Args:
             method_name: 方法名称，如'chat'或'analyze'
@@ -590,140 +3901,195 @@ class StableLLMService:
         Returns:
             Dict: 服务响应
         """
+        cache_key = self._cache_key(method_name, args)
+        if cache_key is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                cached["cached"] = True
+                return cached
+        
+        result = await self._acall_service_uncached(method_name, *args, **kwargs)
+        
+        if cache_key is not None and "error" not in result:
+            self.cache.put(cache_key, result)
+        return result
+    
+    async def _acall_service_uncached(
+        self,
+        method_name: str,
+        *args,
+        **kwargs
+    ) -> Dict[str, Any]:
+        """异步执行故障转移链，不经过响应缓存"""
         errors = []
+        skipped_providers = set()
         
-        # 1. 尝试所有主要服务
-        for provider in self.service_order:
-            service_name = f"{provider}_primary"
-            
-            # 检查服务是否可用
-            if not self.health_monitor.is_available(service_name):
-                logger.warning(f"服务 {service_name} 暂时禁用，跳过")
-                errors.append({
-                    "service": service_name,
-                    "error": "服务暂时禁用（断路器已触发）"
-                })
-                continue
-            
-            # 检查服务是否已初始化
-            if service_name not in self.services:
-                logger.warning(f"服务 {service_name} 未初始化，跳过")
-                continue
-            
+        for service_name, label in self._iter_candidates(errors, self._image_count(args), skipped_providers):
+            started = time.time()
             try:
-                logger.info(f"尝试使用服务: {service_name}")
-                result = self._call_with_timeout(service_name, method_name, *args, **kwargs)
-                logger.info(f"服务 {service_name} 调用成功")
+                logger.info(f"尝试使用{label}: {service_name}")
+                result = await self._acall_with_timeout(
+                    service_name, method_name, *args, **kwargs
+                )
+                logger.info(f"{label} {service_name} 调用成功")
                 return result
             except Exception as e:
-                error_msg = str(e)
-                logger.warning(f"服务 {service_name} 调用失败: {error_msg}")
-                
-                # 记录失败
-                self.health_monitor.record_failure(service_name)
-                
-                # 记录错误
-                errors.append({
-                    "service": service_name,
-                    "error": error_msg,
-                    "is_rate_limited": self._is_rate_limited(e)
-                })
-                
-                # 如果是限流错误，立即尝试下一个服务
-                if self._is_rate_limited(e):
-                    logger.info(f"检测到限流错误，立即切换到下一个服务")
-                
-                continue
+                action = self._record_call_error(
+                    service_name, label, e, errors, skipped_providers, time.time() - started
+                )
+                if action is FailoverAction.FAIL_FAST:
+                    return self._all_failed(errors, fail_fast=True)
         
-        # 2. 尝试所有备用服务
-        logger.info("所有主要服务调用失败，尝试备用服务")
-        for provider in self.service_order:
-            service_name = f"{provider}_fallback"
-            
-            # 检查服务是否可用
-            if not self.health_monitor.is_available(service_name):
-                logger.warning(f"备用服务 {service_name} 暂时禁用，跳过")
-                errors.append({
-                    "service": service_name,
-                    "error": "服务暂时禁用（断路器已触发）"
-                })
-                continue
+        # 所有服务都失败
+        return self._all_failed(errors)
+    
+    def chat(self, prompt: str, race: int = 1) -> Dict[str, Any]:
+        """
+        发送聊天请求
+        
+        Args:
+            prompt: 用户提示词
+            race: 同时调用的服务数量，大于1时同时请求前race个可用服务，先成功者胜出
             
-            # 检查服务是否已初始化
-            if service_name not in self.services:
-                logger.warning(f"备用服务 {service_name} 未初始化，跳过")
-                continue
+        Returns:
+            Dict: 包含响应内容的字典
+        """
+        return self._call_service("chat", prompt, race=race)
+    
+    def analyze(
+        self,
+        prompt: str,
+        image: Optional[ImageInput] = None,
+        race: int = 1,
+        images: Optional[List[ImageInput]] = None
+    ) -> Dict[str, Any]:
+        """
+        分析图像
+        
+        Args:
+            prompt: 用户提示词
+            image: PIL图像对象、已编码的图像数据(bytes/memoryview)、文件路径或http(s) URL
+            race: 同时调用的服务数量，大于1时同时请求前race个可用服务，先成功者胜出
+            images: 多张图像，按顺序一并发送，与image二选一。图像并行编码，
+                单次请求图像数量超出上限的提供商会被跳过
             
-            try:
-                logger.info(f"尝试使用备用服务: {service_name}")
-                result = self._call_with_timeout(service_name, method_name, *args, **kwargs)
-                logger.info(f"备用服务 {service_name} 调用成功")
-                return result
-            except Exception as e:
-                error_msg = str(e)
-                logger.warning(f"备用服务 {service_name} 调用失败: {error_msg}")
-                
-                # 记录失败
-                self.health_monitor.record_failure(service_name)
-                
-                # 记录错误
-                errors.append({
-                    "service": service_name,
-                    "error": error_msg
-                })
-                
-                continue
+        Returns:
+            Dict: 包含响应内容的字典，多张图像时image_metadata为按图像顺序排列的列表
+        """
+        return self._call_service("analyze", prompt, self._prepare_image(image, images), race=race)
+    
+    def chat_many(
+        self,
+        prompts: Iterable[str],
+        concurrency: int = 8,
+        as_completed: bool = False,
+        race: int = 1
+    ) -> Union[List[Dict[str, Any]], Iterator[Tuple[int, Dict[str, Any]]]]:
+        """
+        批量发送聊天请求
         
-        # 3. 尝试所有第三级备选服务（如果存在）
-        logger.info("所有备用服务调用失败，尝试第三级备选服务")
-        for provider in self.service_order:
-            service_name = f"{provider}_fallback2"
+        Args:
+            prompts: 用户提示词序列
+            concurrency: 同时进行的请求数上限
+            as_completed: 为True时返回按完成顺序产出(序号, 响应)的迭代器
+            race: 每个请求同时调用的服务数量，同chat()
             
-            # 检查服务是否存在和可用
-            if service_name not in self.services:
-                continue
-                
-            if not self.health_monitor.is_available(service_name):
-                logger.warning(f"第三级备选服务 {service_name} 暂时禁用，跳过")
-                errors.append({
-                    "service": service_name,
-                    "error": "服务暂时禁用（断路器已触发）"
-                })
-                continue
+        Returns:
+            按输入顺序排列的响应列表；as_completed为True时返回迭代器。
+            失败的请求返回与chat()相同的{"error", "details"}错误字典
+        """
+        return self._call_many("chat", ((prompt,) for prompt in prompts), concurrency, as_completed, race)
+    
+    def analyze_many(
+        self,
+        items: Iterable[Tuple[str, Union[ImageInput, List[ImageInput]]]],
+        concurrency: int = 8,
+        as_completed: bool = False,
+        race: int = 1
+    ) -> Union[List[Dict[str, Any]], Iterator[Tuple[int, Dict[str, Any]]]]:
+        """
+        批量分析图像
+        
+        Args:
+            items: (提示词, 图像) 序列，图像类型同analyze()，为列表时作为多张图像一并发送
+            concurrency: 同时进行的请求数上限
+            as_completed: 为True时返回按完成顺序产出(序号, 响应)的迭代器
+            race: 每个请求同时调用的服务数量，同analyze()
             
+        Returns:
+            按输入顺序排列的响应列表；as_completed为True时返回迭代器。
+            失败的请求返回与analyze()相同的{"error", "details"}错误字典
+        """
+        def prepare(args: Tuple) -> Tuple:
+            # 在各请求自己的线程中读取图像，单个图像无效只影响该请求
+            prompt, image = args
+            return prompt, (self._prepare_image(images=image) if isinstance(image, list) else self._prepare_image(image))
+        
+        return self._call_many("analyze", items, concurrency, as_completed, race, prepare)
+    
+    def _call_many(
+        self,
+        method_name: str,
+        arg_tuples: Iterable[Tuple],
+        concurrency: int,
+        as_completed: bool,
+        race: int,
+        prepare: Optional[Callable[[Tuple], Tuple]] = None
+    ) -> Union[List[Dict[str, Any]], Iterator[Tuple[int, Dict[str, Any]]]]:
+        """
+        并发执行一批故障转移调用，输入按需读取，内存占用与并发数成正比
+        
+        prepare在每个请求的线程中把输入转换为调用参数，转换失败时该请求返回错误字典。
+        """
+        if concurrency < 1:
+            raise ValueError(f"concurrency必须大于等于1: {concurrency}")
+        # 每个请求的实际调用都在共享线程池中执行，竞速或对冲时一个请求同时占用多个线程，
+        # 并发数超过可容纳的请求数只会让调用排队
+        calls_per_request = max(race, 2 if self.hedge_delay is not None else 1)
+        max_concurrency = max(1, self.max_workers // calls_per_request)
+        if concurrency > max_concurrency:
+            logger.warning(
+                f"并发数 {concurrency} 超过线程池大小 {self.max_workers} 可容纳的请求数"
+                f"(每个请求 {calls_per_request} 个调用)，已限制为 {max_concurrency}"
+            )
+            concurrency = max_concurrency
+        
+        def run(index: int, args: Tuple) -> Tuple[int, Dict[str, Any]]:
             try:
-                logger.info(f"尝试使用第三级备选服务: {service_name}")
-                result = self._call_with_timeout(service_name, method_name, *args, **kwargs)
-                logger.info(f"第三级备选服务 {service_name} 调用成功")
-                return result
+                if prepare is not None:
+                    args = prepare(args)
+                return index, self._call_service(method_name, *args, race=race)
             except Exception as e:
                 error_msg = str(e)
-                logger.warning(f"第三级备选服务 {service_name} 调用失败: {error_msg}")
-                
-                # 记录失败
-                self.health_monitor.record_failure(service_name)
-                
-                # 记录错误
-                errors.append({
-                    "service": service_name,
-                    "error": error_msg
-                })
-                
-                continue
+                return index, {
+                    "error": error_msg,
+                    "details": [{"error": error_msg}],
+                    "raw_content": f"服务调用失败: {error_msg}",
+                }
         
-        # 所有服务都失败
-        error_msg = "所有LLM服务调用都失败了"
-        logger.error(f"{error_msg}: {json.dumps(errors, indent=2)}")
+        def iterate() -> Iterator[Tuple[int, Dict[str, Any]]]:
+            inputs = enumerate(arg_tuples)
+            with ThreadPoolExecutor(
+                max_workers=concurrency,
+                thread_name_prefix="StableLLMService-batch"
+            ) as batch_executor:
+                pending = {batch_executor.submit(run, index, args) for index, args in islice(inputs, concurrency)}
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+                    for index, args in islice(inputs, len(done)):
+                        pending.add(batch_executor.submit(run, index, args))
         
-        return {
-            "error": error_msg,
-            "details": errors,
-            "raw_content": f"服务调用失败: {error_msg}",
-        }
+        if as_completed:
+            return iterate()
+        
+        results = dict(iterate())
+        return [results[index] for index in range(len(results))]
     
-    def chat(self, prompt: str) -> Dict[str, Any]:
+    async def achat(self, prompt: str) -> Dict[str, Any]:
         """
-        发送聊天请求
+        异步发送聊天请求
         
         Args:
             prompt: 用户提示词
@@ -731,20 +4097,26 @@ class StableLLMService:
         Returns:
             Dict: 包含响应内容的字典
         """
-        return self._call_service("chat", prompt)
+        return await self._acall_service("chat", prompt)
     
-    def analyze(self, prompt: str, image: 'Image.Image') -> Dict[str, Any]:
+    async def aanalyze(
+        self,
+        prompt: str,
+        image: Optional[ImageInput] = None,
+        images: Optional[List[ImageInput]] = None
+    ) -> Dict[str, Any]:
         """
-        分析图像
+        异步分析图像
         
         Args:
             prompt: 用户提示词
-            image: PIL图像对象
+            image: PIL图像对象、已编码的图像数据(bytes/memoryview)、文件路径或http(s) URL
+            images: 多张图像，与image二选一，同analyze()
             
         Returns:
             Dict: 包含响应内容的字典
         """
-        return self._call_service("analyze", prompt, image)
+        return await self._acall_service("analyze", prompt, self._prepare_image(image, images))
     
     def get_service_status(self) -> Dict[str, Any]:
         """
@@ -755,15 +4127,25 @@ class StableLLMService:
         """
         status = {}
         
-        for service_name in self.services:
+        for service_name in self.configs:
             status[service_name] = {
                 "available": self.health_monitor.is_available(service_name),
-                "failure_count": self.health_monitor.failure_counts.get(service_name, 0)
+                "failure_count": self.health_monitor.failure_count(service_name),
+                # 尚未构建的服务没有构建统计；calls为0的已构建服务即为闲置客户端
+                "initialized": service_name in self.services
             }
+            status[service_name].update(self._service_stats.get(service_name, {}))
+            if service_name in self._service_errors:
+                status[service_name]["init_error"] = self._service_errors[service_name]
+            routing = self.routing_policy.snapshot(service_name)
+            if routing is not None:
+                status[service_name]["routing"] = routing
             
-            if not self.health_monitor.is_available(service_name):
-                cool_down_remaining = self.health_monitor.disabled_until.get(service_name, 0) - time.time()
-                status[service_name]["cool_down_remaining"] = max(0, round(cool_down_remaining, 1))
+            breaker = self.health_monitor.snapshot(service_name)
+            cool_down_remaining = breaker.pop("cool_down_remaining", None)
+            if cool_down_remaining is not None:
+                status[service_name]["cool_down_remaining"] = cool_down_remaining
+            status[service_name]["breaker"] = breaker
         
         return status
 
@@ -831,6 +4213,11 @@ def demo_image_analysis():
 
 def main():
     """主函数"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[logging.StreamHandler()]
+    )
     # 检查环境变量是否设置了API密钥
     api_keys_found = any([
         os.environ.get("OPENAI_API_KEY"),
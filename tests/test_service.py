@@ -3,9 +3,15 @@
 """
 
 import unittest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
 import sys
 import os
+import time
+import asyncio
+import json
+import tempfile
+import subprocess
+import threading
 from concurrent.futures import TimeoutError
 
 # 确保可以导入stable_llm_service.py
@@ -16,7 +22,61 @@ if 'stable_llm_service' in sys.modules:
     del sys.modules['stable_llm_service']
 
 # 导入模块
-from stable_llm_service import StableLLMService
+from stable_llm_service import (
+    StableLLMService, LatencyTracker, ResponseCache, SQLiteResponseCache, PreparedImage,
+    HTTPClientPool, LatencyAwarePolicy, LoadBalancingPolicy, APIKeyPool,
+    RouteEntry, RoutingTier, DEFAULT_ROUTING_PLAN, compile_routing_plan, ModelRegistry,
+    ErrorCategory, LLMServiceError, classify_error, ServiceHealthMonitor,
+    SlidingWindow, BaseLLMService
+)
+
+class FakeImage:
+    """不依赖PIL的简易图像对象，记录编码次数"""
+    
+    def __init__(self, pixels: bytes = b"\x00\x01\x02", mode: str = "RGB", size=(1, 1), colors=None):
+        self.pixels = pixels
+        self.mode = mode
+        self.size = size
+        self.colors = colors
+        self.info = {}
+        self.save_count = 0
+        self.saved_formats = []
+    
+    def tobytes(self) -> bytes:
+        return self.pixels
+    
+    def getbands(self):
+        return tuple(self.mode)
+    
+    def getcolors(self, maxcolors=256):
+        return self.colors
+    
+    def resize(self, size, resample=None):
+        return FakeImage(self.pixels, self.mode, tuple(size), self.colors)
+    
+    def convert(self, mode):
+        return FakeImage(self.pixels, mode, self.size, self.colors)
+    
+    def save(self, buffer, format, **options):
+        self.save_count += 1
+        self.saved_formats.append((format, options))
+        buffer.write(format.encode("ascii") + b":" + self.pixels)
+
+class CleanEnvMixin:
+    """清除环境中的API密钥，只使用测试中显式提供的密钥"""
+    
+    def setUp(self):
+        """备份并清除环境变量"""
+        self.env_patcher = patch.dict(os.environ)
+        self.env_patcher.start()
+        for key in (
+            "OPENAI_API_KEY", "ANTHROPIC_API_KEY", "GEMINI_API_KEY", "SERVICE_ORDER",
+            "OPENAI_API_KEYS", "ANTHROPIC_API_KEYS", "GEMINI_API_KEYS"
+        ):
+            os.environ.pop(key, None)
+    
+    def tearDown(self):
+        self.env_patcher.stop()
 
 class TestStableLLMService(unittest.TestCase):
     """测试StableLLMService类"""
@@ -100,13 +160,18 @@ class TestStableLLMService(unittest.TestCase):
         mock_service = MagicMock()
         mock_create_service.return_value = mock_service
         
-        # 模拟线程池执行器
+        # 模拟线程池执行器，调用已开始执行但未在超时内完成
         mock_future = MagicMock()
         mock_future.result.side_effect = TimeoutError("Request timed out")
+        mock_future.cancel.return_value = False
+        
+        def submit(fn, *args, **kwargs):
+            fn(*args, **kwargs)
+            return mock_future
         
         mock_executor_instance = MagicMock()
         mock_executor_instance.__enter__.return_value = mock_executor_instance
-        mock_executor_instance.submit.return_value = mock_future
+        mock_executor_instance.submit.side_effect = submit
         
         mock_executor.return_value = mock_executor_instance
         
@@ -123,11 +188,1602 @@ class TestStableLLMService(unittest.TestCase):
         service.health_monitor = health_monitor_spy
         
         # 执行带超时的调用
-        with self.assertRaises(Exception):
+        with self.assertRaises(LLMServiceError) as ctx:
             service._call_with_timeout("openai_primary", "chat", "test prompt")
+        self.assertIs(ctx.exception.category, ErrorCategory.TIMEOUT)
+        
+        # 超时由故障转移链统一记录，这里不重复计入失败
+        health_monitor_spy.record_failure.assert_not_called()
+    
+    @patch('stable_llm_service.ServiceFactory.create_service')
+    def test_shared_executor_reused(self, mock_create_service):
+        """测试所有调用复用同一个线程池"""
+        mock_service = MagicMock()
+        mock_service.chat.return_value = {"raw_content": "ok"}
+        mock_create_service.return_value = mock_service
+        
+        with StableLLMService(max_workers=2) as service:
+            executor = service._executor
+            for _ in range(5):
+                self.assertEqual(service.chat("hi")["raw_content"], "ok")
+            
+            self.assertIs(service._executor, executor)
+            stats = service.get_executor_stats()
+            self.assertEqual(stats["max_workers"], 2)
+            self.assertEqual(stats["submitted"], 5)
+            self.assertLessEqual(stats["threads"], 2)
+        
+        # 退出上下文后服务被关闭
+        self.assertTrue(service.get_executor_stats()["closed"])
+        with self.assertRaises(RuntimeError):
+            service._call_with_timeout("openai_primary", "chat", "hi")
+    
+    @patch('stable_llm_service.ServiceFactory.create_service')
+    def test_queued_call_timeout_not_counted(self, mock_create_service):
+        """测试线程池被挂起的调用占满时，排队超时的服务不计入失败，超时从开始执行时计算"""
+        release = threading.Event()
+        
+        hung_service = MagicMock()
+        hung_service.chat.side_effect = lambda prompt: release.wait(5.0)
+        fast_service = MagicMock()
+        fast_service.chat.return_value = {"raw_content": "fast"}
+        mock_create_service.side_effect = lambda config: (
+            hung_service if config.provider == "openai" else fast_service
+        )
+        
+        service = StableLLMService(
+            openai_api_key="k1",
+            anthropic_api_key="k2",
+            service_timeout=0.1,
+            service_order=["openai", "anthropic"],
+            max_workers=1
+        )
+        try:
+            result = service.chat("hi")
+            categories = {detail["service"]: detail.get("category") for detail in result["details"]}
+            self.assertEqual(categories["openai_primary"], "timeout")
+            self.assertEqual(categories["anthropic_primary"], "queue_timeout")
+            self.assertEqual(service.health_monitor.failure_count("openai_primary"), 1)
+            self.assertEqual(service.health_monitor.failure_count("anthropic_primary"), 0)
+            
+            # 竞速模式下排队超时同样不计入失败
+            result = service.chat("hi", race=2)
+            self.assertIn("queue_timeout", [detail.get("category") for detail in result["details"]])
+            self.assertEqual(service.health_monitor.failure_count("anthropic_primary"), 0)
+        finally:
+            release.set()
+            service.close()
+    
+    @patch('stable_llm_service.ServiceFactory.create_service')
+    def test_route_entry_timeout_overrides_service_timeout(self, mock_create_service):
+        """测试路由条目中的timeout决定该模型的调用超时"""
+        slow_service = MagicMock()
+        slow_service.chat.side_effect = lambda prompt: time.sleep(0.15) or {"raw_content": "slow"}
+        mock_create_service.return_value = slow_service
+        
+        plan = (RoutingTier("primary", (RouteEntry("openai", "o1", {"timeout": 1.0}),)),)
+        with StableLLMService(openai_api_key="k", service_timeout=0.05, routing_plan=plan) as service:
+            self.assertEqual(service.chat("hi")["raw_content"], "slow")
+            self.assertEqual(service.chat("hi", race=2)["raw_content"], "slow")
+        
+        plan = (RoutingTier("primary", (RouteEntry("openai", "o1", {"timeout": 0.05}),)),)
+        with StableLLMService(openai_api_key="k", service_timeout=1.0, routing_plan=plan) as service:
+            result = service.chat("hi")
+            self.assertEqual(result["details"][0]["category"], "timeout")
+            self.assertIn("0.05", result["details"][0]["error"])
+    
+    @patch('stable_llm_service.ServiceFactory.create_service')
+    def test_timeout_does_not_wait_for_hung_call(self, mock_create_service):
+        """测试超时后立即故障转移，不等待挂起的调用"""
+        release = threading.Event()
+        
+        hung_service = MagicMock()
+        hung_service.chat.side_effect = lambda prompt: release.wait(5.0)
+        fast_service = MagicMock()
+        fast_service.chat.return_value = {"raw_content": "fast"}
+        
+        mock_create_service.side_effect = lambda config: (
+            hung_service if config.provider == "openai" else fast_service
+        )
+        
+        service = StableLLMService(
+            service_timeout=0.05,
+            service_order=["openai", "anthropic"]
+        )
+        self.assertEqual(service.configs["openai_primary"].timeout, 0.05)
+        
+        try:
+            start = time.time()
+            result = service.chat("hi")
+            elapsed = time.time() - start
+            
+            self.assertEqual(result["raw_content"], "fast")
+            self.assertLess(elapsed, 1.0)
+            
+            stats = service.get_executor_stats()
+            self.assertEqual(stats["abandoned_calls"], 1)
+            self.assertEqual(stats["leaked_calls"], 1)
+            # 超时只计一次失败
+            self.assertEqual(service.health_monitor.failure_count("openai_primary"), 1)
+        finally:
+            release.set()
+            service.close()
+        
+        self.assertEqual(service.get_executor_stats()["leaked_calls"], 0)
+
+class TestLazyServices(CleanEnvMixin, unittest.TestCase):
+    """测试服务按需构建"""
+    
+    @patch('stable_llm_service.ServiceFactory.create_service')
+    def test_services_built_on_first_use(self, mock_create_service):
+        """测试只构建实际调用到的服务"""
+        mock_service = MagicMock()
+        mock_service.chat.return_value = {"raw_content": "ok"}
+        mock_create_service.return_value = mock_service
+        
+        with StableLLMService(openai_api_key="k1", anthropic_api_key="k2") as service:
+            mock_create_service.assert_not_called()
+            service.chat("hi")
+            service.chat("again")
+            
+            self.assertEqual(mock_create_service.call_count, 1)
+            status = service.get_service_status()
+            first = service.service_order[0] + "_primary"
+            self.assertTrue(status[first]["initialized"])
+            self.assertEqual(status[first]["calls"], 2)
+            self.assertIn("construct_time", status[first])
+            self.assertIsNone(status[first]["memory_bytes"])  # 默认不测量内存
+            self.assertFalse(status["anthropic_fallback"]["initialized"])
+    
+    @patch('stable_llm_service.ServiceFactory.create_service')
+    def test_concurrent_first_use_builds_once(self, mock_create_service):
+        """测试并发的首次调用只构建一次服务"""
+        def slow_create(config):
+            time.sleep(0.05)
+            service = MagicMock()
+            service.chat.return_value = {"raw_content": "ok"}
+            return service
+        mock_create_service.side_effect = slow_create
+        
+        with StableLLMService(openai_api_key="k", service_order=["openai"]) as service:
+            threads = [threading.Thread(target=service.chat, args=("hi",)) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(mock_create_service.call_count, 1)
+            self.assertEqual(service.get_service_status()["openai_primary"]["calls"], 8)
+    
+    @patch('stable_llm_service.ServiceFactory.create_service')
+    def test_warmup_measures_memory_on_request(self, mock_create_service):
+        """测试只有warmup(measure_memory=True)才用tracemalloc估算内存占用"""
+        import tracemalloc
+        
+        def create(config):
+            service = MagicMock()
+            service.buffer = bytearray(256 * 1024)
+            return service
+        mock_create_service.side_effect = create
+        
+        with StableLLMService(openai_api_key="k", service_order=["openai"]) as service:
+            with patch('stable_llm_service.StableLLMService._measure_memory') as measure:
+                service.warmup(["openai_primary"])
+                measure.assert_not_called()
+            results = service.warmup(["openai_fallback"], measure_memory=True)
+            self.assertIsNone(service.get_service_status()["openai_primary"]["memory_bytes"])
+            self.assertGreaterEqual(results["openai_fallback"]["memory_bytes"], 256 * 1024)
+            self.assertFalse(tracemalloc.is_tracing())
+    
+    @patch('stable_llm_service.ServiceFactory.create_service')
+    def test_warmup_and_failed_construction(self, mock_create_service):
+        """测试warmup构建所有服务，构建失败的服务被跳过且不重试"""
+        def create(config):
+            if config.provider == "openai":
+                raise ImportError("未安装openai")
+            service = MagicMock()
+            service.chat.return_value = {"raw_content": "anthropic"}
+            return service
+        mock_create_service.side_effect = create
+        
+        with StableLLMService(openai_api_key="k1", anthropic_api_key="k2",
+                              service_order=["openai", "anthropic"]) as service:
+            results = service.warmup()
+            self.assertEqual(set(results), set(service.configs))
+            self.assertIn("error", results["openai_primary"])
+            self.assertIn("construct_time", results["anthropic_primary"])
+            
+            calls = mock_create_service.call_count
+            self.assertEqual(service.chat("hi")["raw_content"], "anthropic")
+            self.assertEqual(mock_create_service.call_count, calls)
+            self.assertEqual(service.get_service_status()["openai_primary"]["init_error"], "未安装openai")
+
+class TestHTTPClientPool(CleanEnvMixin, unittest.TestCase):
+    """测试同一提供商的模型共享HTTP客户端"""
+    
+    @patch('stable_llm_service.httpx', create=True)
+    @patch('stable_llm_service.openai', create=True)
+    def test_models_share_client_per_key(self, mock_openai, mock_httpx):
+        """测试主要模型与备用模型共享同一客户端，不同密钥使用不同客户端"""
+        mock_httpx.Client.side_effect = lambda **kwargs: MagicMock()
+        mock_httpx.AsyncClient.side_effect = lambda **kwargs: MagicMock()
+        pool = HTTPClientPool(max_connections=16, http2=True)
+        
+        with StableLLMService(openai_api_key="k1", http_pool=pool) as service:
+            service.warmup(["openai_primary", "openai_fallback"])
+            with StableLLMService(openai_api_key="k2", http_pool=pool) as other:
+                other.warmup(["openai_primary"])
+        
+        sync_clients = [call.kwargs["http_client"] for call in mock_openai.OpenAI.call_args_list]
+        self.assertIs(sync_clients[0], sync_clients[1])
+        self.assertIsNot(sync_clients[0], sync_clients[2])
+        async_clients = [call.kwargs["http_client"] for call in mock_openai.AsyncOpenAI.call_args_list]
+        self.assertIs(async_clients[0], async_clients[1])
+        
+        self.assertEqual(mock_httpx.Client.call_count, 2)
+        self.assertTrue(mock_httpx.Client.call_args.kwargs["http2"])
+        mock_httpx.Limits.assert_called_with(
+            max_connections=16, max_keepalive_connections=32, keepalive_expiry=60.0
+        )
+        # 传入的连接池由调用方关闭
+        sync_clients[0].close.assert_not_called()
+        
+        stats = pool.stats()
+        self.assertEqual(len(stats), 4)
+        self.assertTrue(all(entry["requests"] == 0 for entry in stats.values()))
+        self.assertTrue(all("k1" not in name for name in stats))
+        
+        pool.close()
+        sync_clients[0].close.assert_called_once()
+    
+    @patch('stable_llm_service.httpx', create=True)
+    def test_request_hook_counts_requests(self, mock_httpx):
+        """测试事件钩子统计请求数"""
+        pool = HTTPClientPool()
+        pool.client("openai", "k")
+        hook = mock_httpx.Client.call_args.kwargs["event_hooks"]["request"][0]
+        hook(MagicMock())
+        hook(MagicMock())
+        self.assertEqual(next(iter(pool.stats().values()))["requests"], 2)
+
+class RateLimitError(Exception):
+    """与SDK同名的限流异常"""
+
+class BadRequestError(Exception):
+    """与SDK同名的请求错误"""
+    
+    def __init__(self, message, status_code=400, code=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.code = code
+
+class TestErrorClassification(CleanEnvMixin, unittest.TestCase):
+    """测试结构化错误分类"""
+    
+    def test_classify_by_type_status_and_code(self):
+        """测试按异常类型、错误码和状态码分类，消息中的关键词不会误判"""
+        self.assertEqual(classify_error(RateLimitError("slow down")), ErrorCategory.RATE_LIMIT)
+        self.assertEqual(
+            classify_error(BadRequestError("prompt mentions 429 and capacity")),
+            ErrorCategory.INVALID_REQUEST
+        )
+        self.assertEqual(
+            classify_error(BadRequestError("blocked", code="content_filter")),
+            ErrorCategory.CONTENT_FILTER
+        )
+        server_error = Exception("oops")
+        server_error.status_code = 503
+        self.assertEqual(classify_error(server_error), ErrorCategory.SERVER)
+        self.assertEqual(classify_error(TimeoutError()), ErrorCategory.TIMEOUT)
+        self.assertEqual(classify_error(Exception("Invalid API key")), ErrorCategory.UNKNOWN)
+    
+    def test_classify_model_not_found_and_gemini_invalid_key(self):
+        """测试404归为模型不存在，Gemini以InvalidArgument返回的无效密钥归为认证错误"""
+        class NotFoundError(Exception):
+            pass
+        class InvalidArgument(Exception):
+            pass
+        self.assertEqual(classify_error(NotFoundError("model retired")), ErrorCategory.MODEL_NOT_FOUND)
+        not_found = Exception("no such model")
+        not_found.status_code = 404
+        self.assertEqual(classify_error(not_found), ErrorCategory.MODEL_NOT_FOUND)
+        self.assertEqual(
+            classify_error(InvalidArgument("400 API key not valid. Please pass a valid API key.")),
+            ErrorCategory.AUTH
+        )
+        self.assertEqual(classify_error(InvalidArgument("bad field")), ErrorCategory.INVALID_REQUEST)
+    
+    @patch('stable_llm_service.openai', create=True)
+    def test_service_raises_structured_error(self, mock_openai):
+        """测试服务抛出携带SDK异常类型、状态码和Retry-After的错误"""
+        sdk_error = RateLimitError("slow down")
+        sdk_error.status_code = 429
+        sdk_error.response = MagicMock(headers={"retry-after": "7"})
+        mock_openai.OpenAI.return_value.chat.completions.create.side_effect = sdk_error
+        
+        with StableLLMService(openai_api_key="k", service_order=["openai"]) as service:
+            with self.assertRaises(LLMServiceError) as context:
+                service._service_for_call("openai_primary").chat("hi")
+            error = context.exception
+            self.assertEqual(error.category, ErrorCategory.RATE_LIMIT)
+            self.assertEqual((error.status_code, error.retry_after, error.error_type), (429, 7.0, "RateLimitError"))
+            self.assertIs(error.__cause__, sdk_error)
+            
+            result = service.chat("hi")
+            self.assertEqual(result["details"][0]["category"], "rate_limit")
+            self.assertTrue(result["details"][0]["is_rate_limited"])
+
+class AuthenticationError(Exception):
+    """与SDK同名的认证错误"""
+
+class TestFailoverActions(CleanEnvMixin, unittest.TestCase):
+    """测试按错误类别决定故障转移方式"""
+    
+    def _create_service(self, mock_create_service, errors, **kwargs):
+        """errors: 服务名称中的提供商和层级 -> 该服务抛出的异常，未列出的服务调用成功"""
+        calls = []
+        
+        def create(config):
+            service = MagicMock()
+            def chat(prompt):
+                name = f"{config.provider}_{'primary' if config.is_primary else config.model_name}"
+                calls.append(name)
+                if name in errors:
+                    raise LLMServiceError.from_exception(errors[name], config.provider)
+                return {"raw_content": name}
+            service.chat.side_effect = chat
+            return service
+        mock_create_service.side_effect = create
+        service = StableLLMService(
+            openai_api_key="k1", anthropic_api_key="k2", service_order=["openai", "anthropic"], **kwargs
+        )
+        return service, calls
+    
+    @patch('stable_llm_service.ServiceFactory.create_service')
+    def test_invalid_request_fails_fast(self, mock_create_service):
+        """测试请求错误立即返回，不调用其余服务，也不计入服务失败"""
+        service, calls = self._create_service(
+            mock_create_service, {"openai_primary": BadRequestError("malformed")}
+        )
+        with service:
+            result = service.chat("hi")
+            self.assertIn("error", result)
+            self.assertEqual(calls, ["openai_primary"])
+            self.assertEqual(result["details"][0]["category"], "invalid_request")
+            self.assertEqual(service.health_monitor.failure_counts.get("openai_primary", 0), 0)
+    
+    @patch('stable_llm_service.ServiceFactory.create_service')
+    def test_context_length_skips_model(self, mock_create_service):
+        """测试超出上下文长度只跳过该模型"""
+        service, calls = self._create_service(mock_create_service, {
+            "openai_primary": BadRequestError("too long", code="context_length_exceeded")
+        })
+        with service:
+            self.assertEqual(service.chat("hi")["raw_content"], "anthropic_primary")
+            self.assertEqual(service.health_monitor.failure_counts.get("openai_primary", 0), 0)
+    
+    @patch('stable_llm_service.ServiceFactory.create_service')
+    def test_model_not_found_skips_model(self, mock_create_service):
+        """测试模型不存在(已下线)时继续尝试下一个服务，不计入服务失败"""
+        class NotFoundError(Exception):
+            status_code = 404
+        service, calls = self._create_service(mock_create_service, {
+            "openai_primary": NotFoundError("The model `gpt-4-retired` does not exist")
+        })
+        with service:
+            self.assertEqual(service.chat("hi")["raw_content"], "anthropic_primary")
+            self.assertEqual(calls, ["openai_primary", "anthropic_primary"])
+            self.assertEqual(service.health_monitor.failure_counts.get("openai_primary", 0), 0)
+    
+    @patch('stable_llm_service.ServiceFactory.create_service')
+    def test_auth_error_skips_provider(self, mock_create_service):
+        """测试认证失败跳过同一提供商的其余服务，可通过failover_actions改为立即返回"""
+        service, calls = self._create_service(mock_create_service, {
+            "openai_primary": AuthenticationError("bad key"),
+            "anthropic_primary": Exception("boom")
+        })
+        with service:
+            self.assertEqual(service.chat("hi")["raw_content"], "anthropic_claude-3-5-sonnet-latest")
+            self.assertEqual(calls, ["openai_primary", "anthropic_primary", "anthropic_claude-3-5-sonnet-latest"])
+            self.assertEqual(service.health_monitor.failure_counts["openai_primary"], 1)
+        
+        service, calls = self._create_service(
+            mock_create_service, {"openai_primary": AuthenticationError("bad key")},
+            failover_actions={"auth": "fail_fast"}
+        )
+        with service:
+            self.assertIn("error", service.chat("hi"))
+            self.assertEqual(calls, ["openai_primary"])
+    
+    def test_request_errors_do_not_trip_key_breaker(self):
+        """测试请求错误不计入API密钥的失败次数"""
+        pool = APIKeyPool(["k1"], failure_threshold=1)
+        self.assertFalse(pool.release(pool.acquire(), BadRequestError("malformed")))
+        self.assertEqual(pool.acquire(), "k1")
+
+class TestCircuitBreaker(CleanEnvMixin, unittest.TestCase):
+    """测试带半开状态的断路器"""
+    
+    def test_half_open_probe_and_backoff(self):
+        """测试冷却期后只放行探测请求，探测失败按指数退避重新打开，成功则关闭"""
+        monitor = ServiceHealthMonitor(failure_threshold=2, cool_down_period=0.05)
+        monitor.record_failure("s")
+        self.assertTrue(monitor.try_acquire("s"))
+        monitor.record_failure("s")
+        self.assertEqual(monitor.state("s"), "open")
+        self.assertFalse(monitor.try_acquire("s"))
+        
+        time.sleep(0.06)
+        self.assertTrue(monitor.is_available("s"))
+        self.assertTrue(monitor.try_acquire("s"))
+        self.assertFalse(monitor.try_acquire("s"))  # 只放行一个探测请求
+        monitor.release("s")
+        self.assertTrue(monitor.try_acquire("s"))
+        monitor.record_failure("s")
+        snapshot = monitor.snapshot("s")
+        self.assertEqual((snapshot["state"], snapshot["trips"]), ("open", 2))
+        self.assertGreater(snapshot["cool_down_remaining"], 0.05)  # 冷却期翻倍为0.1秒
+        
+        time.sleep(0.11)
+        self.assertTrue(monitor.try_acquire("s"))
+        monitor.record_success("s")
+        snapshot = monitor.snapshot("s")
+        self.assertEqual((snapshot["state"], snapshot["trips"]), ("closed", 0))
+        self.assertEqual(
+            [(t["from"], t["to"]) for t in snapshot["transitions"]],
+            [("closed", "open"), ("open", "half_open"), ("half_open", "open"),
+             ("open", "half_open"), ("half_open", "closed")]
+        )
+    
+    def test_sliding_window_expires_buckets(self):
+        """测试滑动窗口按桶过期，总计只包含窗口内的调用"""
+        window = SlidingWindow(window_size=10.0, bucket_count=5)
+        window.record(False, now=100.0)
+        window.record(True, slow=True, now=103.0)
+        window.record(True, now=105.0)
+        self.assertEqual(window.rates(now=105.0), (3, 1 / 3, 1 / 3))
+        self.assertEqual(window.rates(now=113.0)[0], 1)  # 100-104秒的桶已过期
+        self.assertEqual(window.rates(now=200.0), (0, 0.0, 0.0))
+    
+    def test_failure_rate_and_slow_call_rate_trip(self):
+        """测试非连续失败和慢调用在达到最小调用数后按比率触发断路器"""
+        monitor = ServiceHealthMonitor(failure_threshold=3, failure_rate_threshold=0.4, minimum_calls=5)
+        for success in (True, False, True, False):
+            if success:
+                monitor.record_success("s", 0.1)
+            else:
+                monitor.record_failure("s")
+        self.assertEqual(monitor.state("s"), "closed")  # 未达到最小调用数
+        monitor.record_success("s", 0.1)
+        self.assertEqual(monitor.state("s"), "open")  # 失败率40%
+        
+        monitor = ServiceHealthMonitor(slow_call_threshold=1.0, slow_call_rate_threshold=0.5, minimum_calls=4)
+        for latency in (0.5, 12.0, 0.5, 12.0):
+            monitor.record_success("s", latency)
+        self.assertEqual(monitor.state("s"), "open")
+        self.assertEqual(monitor.snapshot("s")["window"]["calls"], 0)  # 打开后窗口重新统计
+    
+    def test_concurrent_stress(self):
+        """测试多线程同时记录结果和获取探测名额时计数准确、探测名额不超发"""
+        monitor = ServiceHealthMonitor(
+            failure_threshold=1000000, failure_rate_threshold=1.1, minimum_calls=1, window_size=600.0
+        )
+        threads, per_thread = 16, 500
+        barrier = threading.Barrier(threads)
+        errors = []
+        
+        def hammer(index):
+            try:
+                barrier.wait()
+                for i in range(per_thread):
+                    name = f"s{i % 4}"
+                    if (index + i) % 3:
+                        monitor.record_success(name, 0.01)
+                    else:
+                        monitor.record_failure(name)
+                    monitor.try_acquire(name)
+                    monitor.is_available(name)
+            except Exception as e:
+                errors.append(e)
+        
+        workers = [threading.Thread(target=hammer, args=(i,)) for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        
+        self.assertEqual(errors, [])
+        total = sum(monitor.snapshot(f"s{i}")["window"]["calls"] for i in range(4))
+        self.assertEqual(total, threads * per_thread)
+        
+        # 半开状态下并发获取探测名额，只有half_open_probes个成功
+        monitor = ServiceHealthMonitor(failure_threshold=1, cool_down_period=0.01, half_open_probes=2)
+        monitor.record_failure("s")
+        time.sleep(0.02)
+        granted = []
+        barrier = threading.Barrier(threads)
+        
+        def acquire():
+            barrier.wait()
+            granted.append(monitor.try_acquire("s"))
+        
+        workers = [threading.Thread(target=acquire) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(granted.count(True), 2)
+    
+    @patch('stable_llm_service.ServiceFactory.create_service')
+    def test_breaker_state_in_service_status(self, mock_create_service):
+        """测试服务状态中包含断路器状态，半开时探测成功后恢复"""
+        mock_service = MagicMock()
+        mock_service.chat.side_effect = [Exception("boom"), {"raw_content": "ok"}, {"raw_content": "ok"}]
+        mock_create_service.return_value = mock_service
+        
+        with StableLLMService(
+            openai_api_key="k", service_order=["openai"], failure_threshold=1, cool_down_period=0.05,
+            routing_plan=[RoutingTier("primary", (RouteEntry("openai", "m"),))]
+        ) as service:
+            self.assertIn("error", service.chat("hi"))
+            status = service.get_service_status()["openai_primary"]
+            self.assertEqual(status["breaker"]["state"], "open")
+            self.assertFalse(status["available"])
+            self.assertIn("error", service.chat("hi"))  # 冷却期内不调用服务
+            self.assertEqual(mock_service.chat.call_count, 1)
+            
+            time.sleep(0.06)
+            self.assertEqual(service.get_service_status()["openai_primary"]["breaker"]["state"], "half_open")
+            self.assertEqual(service.chat("hi")["raw_content"], "ok")
+            self.assertEqual(service.get_service_status()["openai_primary"]["breaker"]["state"], "closed")
+
+class TestAPIKeyPool(CleanEnvMixin, unittest.TestCase):
+    """测试同一提供商的多个API密钥"""
+    
+    def test_rotation_cool_down_and_breaker(self):
+        """测试轮询选择密钥，限流和连续失败的密钥各自冷却"""
+        pool = APIKeyPool(["k1", "k2", "k3"], failure_threshold=2, cool_down_period=30.0)
+        self.assertEqual([pool.acquire() for _ in range(4)], ["k1", "k2", "k3", "k1"])
+        for key in ("k1", "k2", "k3", "k1"):
+            pool.release(key)
+        
+        rate_limited = Exception("429 Too Many Requests")
+        rate_limited.response = MagicMock(headers={"retry-after": "5"})
+        self.assertTrue(pool.release(pool.acquire(), rate_limited))  # k2
+        self.assertFalse(pool.release(pool.acquire(), Exception("boom")))  # k3
+        self.assertFalse(pool.release(pool.acquire(), Exception("boom")))  # k1
+        self.assertFalse(pool.release(pool.acquire(), Exception("boom")))  # k3，触发断路器
+        
+        self.assertEqual(pool.acquire(), "k1")
+        stats = list(pool.stats().values())
+        self.assertEqual(stats[1]["cool_down_remaining"], 5.0)
+        self.assertEqual(stats[2]["cool_down_remaining"], 30.0)
+        self.assertEqual(stats[0]["in_flight"], 1)
+    
+    def test_least_loaded(self):
+        """测试选择进行中请求最少的密钥"""
+        pool = APIKeyPool(["k1", "k2"], strategy="least_loaded")
+        self.assertEqual(pool.acquire(), "k1")
+        self.assertEqual(pool.acquire(), "k2")
+        pool.release("k1")
+        self.assertEqual(pool.acquire(), "k1")
+    
+    @patch('stable_llm_service.openai', create=True)
+    def test_rate_limited_key_retried_with_next_key(self, mock_openai):
+        """测试密钥被限流时换用下一个密钥，不禁用整个提供商"""
+        clients = {}
+        
+        def create_client(api_key, **kwargs):
+            client = MagicMock()
+            if api_key == "k1":
+                client.chat.completions.create.side_effect = Exception("Rate limit exceeded")
+            else:
+                client.chat.completions.create.return_value.choices[0].message.content = api_key
+            clients[api_key] = client
+            return client
+        mock_openai.OpenAI.side_effect = create_client
+        
+        os.environ["OPENAI_API_KEYS"] = "k1, k2"
+        with StableLLMService(service_order=["openai"]) as service:
+            for _ in range(3):
+                self.assertEqual(service.chat("hi")["raw_content"], "k2")
+            
+            # k1被限流后进入冷却，之后的请求不再使用k1
+            self.assertEqual(clients["k1"].chat.completions.create.call_count, 1)
+            self.assertTrue(service.health_monitor.is_available("openai_primary"))
+            self.assertEqual(service.health_monitor.failure_counts.get("openai_primary", 0), 0)
+            key_stats = list(service.get_key_pool_stats()["openai"].values())
+            self.assertEqual(key_stats[0]["rate_limited"], 1)
+            self.assertEqual(key_stats[1]["requests"], 3)
+    
+    @patch('stable_llm_service.genai', create=True)
+    def test_gemini_calls_go_through_key_pool(self, mock_genai):
+        """测试Gemini只保留第一个密钥，调用经过密钥池，限流时该密钥进入冷却"""
+        model = mock_genai.GenerativeModel.return_value
+        model.generate_content.return_value.text = "ok"
+        
+        with StableLLMService(gemini_api_key=["g1", "g2"], service_order=["gemini"]) as service:
+            self.assertEqual(service.chat("hi")["raw_content"], "ok")
+            mock_genai.configure.assert_called_with(api_key="g1")
+            key_stats = list(service.get_key_pool_stats()["gemini"].values())
+            self.assertEqual(len(key_stats), 1)
+            self.assertEqual(key_stats[0]["requests"], 1)
+            
+            model.generate_content.side_effect = RateLimitError("quota exhausted")
+            self.assertIn("error", service.chat("hi"))
+            key_stats = list(service.get_key_pool_stats()["gemini"].values())
+            self.assertEqual(key_stats[0]["rate_limited"], 1)
+            self.assertGreater(key_stats[0]["cool_down_remaining"], 0)
+
+class TestRoutingPlan(CleanEnvMixin, unittest.TestCase):
+    """测试声明式路由计划"""
+    
+    def test_default_plan_compiled(self):
+        """测试默认计划只保留已配置密钥的提供商，并按服务调用顺序排列"""
+        pools = {"openai": APIKeyPool(["k1"]), "gemini": APIKeyPool(["k2"])}
+        plan = compile_routing_plan(DEFAULT_ROUTING_PLAN, pools, ["gemini", "openai"], timeout=5.0)
+        
+        self.assertEqual(
+            [tier.service_names for tier in plan.tiers],
+            [("gemini_primary", "openai_primary"), ("gemini_fallback", "openai_fallback"), ("gemini_fallback2",)]
+        )
+        self.assertEqual(plan.configs["openai_fallback"].model_name, "gpt-4o-mini")
+        self.assertEqual(plan.configs["openai_fallback"].timeout, 5.0)
+        self.assertFalse(plan.configs["openai_fallback"].is_primary)
+        self.assertEqual(plan.max_images["openai_primary"], 10)
+        with self.assertRaises(TypeError):
+            plan.configs["x"] = None
+    
+    def test_invalid_plans_rejected(self):
+        """测试重复的服务名称和未知选项被拒绝"""
+        pools = {"openai": APIKeyPool(["k"])}
+        duplicate = [RoutingTier("fast", (RouteEntry("openai", "a"), RouteEntry("openai", "b")))]
+        with self.assertRaises(ValueError):
+            compile_routing_plan(duplicate, pools, ["openai"])
+        unknown = [RoutingTier("fast", (RouteEntry("openai", "a", {"top_k": 3}),))]
+        with self.assertRaises(ValueError):
+            compile_routing_plan(unknown, pools, ["openai"])
+    
+    @patch('stable_llm_service.ServiceFactory.create_service')
+    def test_custom_plan_failover_order(self, mock_create_service):
+        """测试任意层数和模型数的计划按顺序故障转移"""
+        calls = []
+        
+        def create(config):
+            service = MagicMock()
+            def chat(prompt):
+                calls.append((config.model_name, config.max_tokens))
+                if config.model_name != "last-resort":
+                    raise Exception("boom")
+                return {"raw_content": config.model_name}
+            service.chat.side_effect = chat
+            return service
+        mock_create_service.side_effect = create
+        
+        plan = [
+            {"name": "fast", "entries": [
+                {"provider": "openai", "model": "mini", "name": "openai_mini"},
+                {"provider": "openai", "model": "nano", "name": "openai_nano", "options": {"max_tokens": 100}},
+            ]},
+            {"name": "strong", "entries": [{"provider": "anthropic", "model": "big"}]},
+            {"name": "cheap", "entries": [{"provider": "gemini", "model": "flash"}]},
+            {"name": "final", "entries": [{"provider": "anthropic", "model": "last-resort"}]},
+        ]
+        with StableLLMService(
+            openai_api_key="k1", anthropic_api_key="k2", routing_plan=plan, max_tokens=500
+        ) as service:
+            self.assertEqual(service.chat("hi")["raw_content"], "last-resort")
+            self.assertEqual(
+                calls,
+                [("mini", 500), ("nano", 100), ("big", 500), ("last-resort", 500)]
+            )
+            self.assertEqual(
+                set(service.get_service_status()),
+                {"openai_mini", "openai_nano", "anthropic_strong", "anthropic_final"}
+            )
+
+class TestModelRegistry(CleanEnvMixin, unittest.TestCase):
+    """测试模型注册表及其热加载"""
+    
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "models.json")
+    
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        super().tearDown()
+    
+    def _write(self, primary_model, fallback_model="mini", extra_tier=False):
+        registry = {
+            "providers": {"openai": {"options": {"timeout": 20.0}, "limits": {"max_images": 2}}},
+            "tiers": [
+                {"name": "primary", "entries": [{"provider": "openai", "model": primary_model}]},
+                {"name": "fallback", "entries": [{"provider": "openai", "model": fallback_model}]},
+            ]
+        }
+        if extra_tier:
+            registry["tiers"].append({"name": "last", "entries": [{"provider": "openai", "model": "nano"}]})
+        with open(self.path, "w") as f:
+            json.dump(registry, f)
+    
+    @patch('stable_llm_service.ServiceFactory.create_service')
+    def test_registry_loaded(self, mock_create_service):
+        """测试注册表中的模型、提供商默认选项和限制生效"""
+        mock_create_service.side_effect = lambda config: MagicMock()
+        self._write("big")
+        with StableLLMService(openai_api_key="k", registry=self.path, reload_interval=None) as service:
+            self.assertEqual(service.configs["openai_primary"].model_name, "big")
+            self.assertEqual(service.configs["openai_fallback"].timeout, 20.0)
+            self.assertEqual(service._plan.max_images["openai_primary"], 2)
+            self.assertIsNone(service._watcher)
+        with self.assertRaises(ValueError):
+            StableLLMService(openai_api_key="k", registry=self.path, routing_plan=DEFAULT_ROUTING_PLAN)
+        with self.assertRaises(ValueError):
+            ModelRegistry.parse({"tiers": [{"name": "primary", "entries": [{"provider": "openai"}]}]})
+    
+    @patch('stable_llm_service.ServiceFactory.create_service')
+    def test_reload_swaps_plan_and_keeps_unchanged_services(self, mock_create_service):
+        """测试重新加载只重建配置变化的服务，进行中的请求继续使用旧路由表"""
+        mock_create_service.side_effect = lambda config: MagicMock()
+        self._write("big")
+        with StableLLMService(openai_api_key="k", registry=self.path, reload_interval=None) as service:
+            service.warmup()
+            old_plan = service._plan
+            kept = service.services["openai_fallback"]
+            
+            self._write("bigger", extra_tier=True)
+            diff = service.reload_registry()
+            
+            self.assertEqual(diff["changed"], ["openai_primary"])
+            self.assertEqual(diff["kept"], ["openai_fallback"])
+            self.assertEqual(diff["added"], ["openai_last"])
+            self.assertIs(service.services["openai_fallback"], kept)
+            self.assertNotIn("openai_primary", service.services)
+            self.assertEqual(old_plan.configs["openai_primary"].model_name, "big")
+            self.assertEqual(service.configs["openai_primary"].model_name, "bigger")
+            self.assertEqual(mock_create_service.call_count, 2)
+            
+            # 格式错误的注册表不影响当前路由表
+            with open(self.path, "w") as f:
+                f.write("{")
+            with self.assertRaises(ValueError):
+                service.reload_registry()
+            self.assertEqual(service.configs["openai_primary"].model_name, "bigger")
+    
+    @patch('stable_llm_service.ServiceFactory.create_service')
+    def test_file_change_triggers_reload(self, mock_create_service):
+        """测试监视线程在文件变化后自动重新加载"""
+        mock_create_service.side_effect = lambda config: MagicMock()
+        self._write("big")
+        with StableLLMService(openai_api_key="k", registry=self.path, reload_interval=0.01) as service:
+            self._write("much-bigger-model")
+            deadline = time.time() + 2.0
+            while service.reload_count == 0 and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(service.configs["openai_primary"].model_name, "much-bigger-model")
+        self.assertFalse(service._watcher.is_alive())
+
+class TestHedging(CleanEnvMixin, unittest.TestCase):
+    """测试对冲请求和竞速模式"""
+    
+    def _create_service(self, mock_create_service, primary_delay, **kwargs):
+        slow_service = MagicMock()
+        slow_service.chat.side_effect = lambda prompt: (
+            time.sleep(primary_delay) or {"raw_content": "primary"}
+        )
+        fast_service = MagicMock()
+        fast_service.chat.return_value = {"raw_content": "hedge"}
+        mock_create_service.side_effect = lambda config: (
+            slow_service if config.provider == "openai" else fast_service
+        )
+        return StableLLMService(
+            openai_api_key="k1",
+            anthropic_api_key="k2",
+            service_timeout=2.0,
+            service_order=["openai", "anthropic"],
+            **kwargs
+        )
+    
+    @patch('stable_llm_service.ServiceFactory.create_service')
+    def test_hedge_wins_over_slow_primary(self, mock_create_service):
+        """测试主服务过慢时对冲请求胜出"""
+        service = self._create_service(mock_create_service, 0.3, hedge_delay=0.05)
+        
+        start = time.time()
+        result = service.chat("hi")
+        
+        self.assertEqual(result["raw_content"], "hedge")
+        self.assertLess(time.time() - start, 0.25)
+        self.assertEqual(
+            service.get_fanout_stats(),
+            {"hedges_fired": 1, "hedges_won": 1, "races": 0, "extra_calls": 1}
+        )
+        
+        # 被丢弃的主服务调用最终成功，不应计为失败
+        service.close(wait=True)
+        self.assertEqual(service.health_monitor.failure_counts["openai_primary"], 0)
+    
+    @patch('stable_llm_service.ServiceFactory.create_service')
+    def test_no_hedge_when_primary_is_fast(self, mock_create_service):
+        """测试主服务及时响应时不发出对冲请求"""
+        service = self._create_service(mock_create_service, 0.0, hedge_delay=0.5)
+        
+        self.assertEqual(service.chat("hi")["raw_content"], "primary")
+        self.assertEqual(service.get_fanout_stats()["hedges_fired"], 0)
+        service.close()
+    
+    @patch('stable_llm_service.ServiceFactory.create_service')
+    def test_race_timeout_reported_as_timeout(self, mock_create_service):
+        """测试竞速模式下的超时与顺序调用一样报告为timeout类别"""
+        release = threading.Event()
+        hung_service = MagicMock()
+        hung_service.chat.side_effect = lambda prompt: release.wait(5.0)
+        mock_create_service.return_value = hung_service
+        
+        service = StableLLMService(openai_api_key="k1", service_timeout=0.05, service_order=["openai"])
+        try:
+            result = service.chat("hi", race=2)
+            timeouts = [detail for detail in result["details"] if "category" in detail]
+            self.assertEqual(len(timeouts), 2)
+            for detail in timeouts:
+                self.assertEqual((detail["category"], detail["error_type"]), ("timeout", "TimeoutError"))
+        finally:
+            release.set()
+            service.close()
+    
+    @patch('stable_llm_service.ServiceFactory.create_service')
+    def test_race_first_success_wins(self, mock_create_service):
+        """测试竞速模式下先成功者胜出，失败者补位，丢弃的调用不计为失败"""
+        failing_service = MagicMock()
+        failing_service.chat.side_effect = Exception("boom")
+        slow_service = MagicMock()
+        slow_service.chat.side_effect = lambda prompt: (
+            time.sleep(0.3) or {"raw_content": "slow"}
+        )
+        fast_service = MagicMock()
+        fast_service.chat.return_value = {"raw_content": "fast"}
+        services = {"openai": failing_service, "anthropic": slow_service, "gemini": fast_service}
+        mock_create_service.side_effect = lambda config: services[config.provider]
+        
+        service = StableLLMService(
+            openai_api_key="k1",
+            anthropic_api_key="k2",
+            gemini_api_key="k3",
+            service_timeout=2.0,
+            service_order=["openai", "anthropic", "gemini"]
+        )
+        
+        result = service.chat("hi", race=2)
+        
+        self.assertEqual(result["raw_content"], "fast")
+        stats = service.get_fanout_stats()
+        self.assertEqual(stats["races"], 1)
+        self.assertEqual(stats["extra_calls"], 1)
+        
+        service.close(wait=True)
+        failure_counts = service.health_monitor.failure_counts
+        self.assertEqual(failure_counts["openai_primary"], 1)
+        self.assertEqual(failure_counts["anthropic_primary"], 0)
+        self.assertEqual(failure_counts["gemini_primary"], 0)
+    
+    def test_latency_percentile(self):
+        """测试延迟分位数计算"""
+        tracker = LatencyTracker(window_size=100, min_samples=10)
+        self.assertIsNone(tracker.percentile("svc", 95))
+        
+        for i in range(1, 101):
+            tracker.record("svc", i / 100)
+        
+        self.assertAlmostEqual(tracker.percentile("svc", 95), 0.95)
+        self.assertAlmostEqual(tracker.percentile("svc", 50), 0.50)
+
+class TestLatencyAwareRouting(CleanEnvMixin, unittest.TestCase):
+    """测试按延迟和成功率动态路由"""
+    
+    def test_slow_and_failing_services_demoted(self):
+        """测试延迟高或失败多的服务排在后面"""
+        policy = LatencyAwarePolicy(exploration=0)
+        names = ["openai_primary", "anthropic_primary", "gemini_primary"]
+        self.assertEqual(policy.order(names), names)  # 没有样本时保持静态顺序
+        
+        for _ in range(5):
+            policy.record("openai_primary", 3.0, True)
+            policy.record("anthropic_primary", 1.0, True)
+            policy.record("gemini_primary", 1.0, False)
+        self.assertEqual(policy.order(names), ["anthropic_primary", "openai_primary", "gemini_primary"])
+    
+    def test_stale_stats_decay(self):
+        """测试长时间没有样本的服务重新获得优先级"""
+        policy = LatencyAwarePolicy(half_life=10.0, exploration=0)
+        names = ["openai_primary", "anthropic_primary"]
+        with patch('stable_llm_service.time.time', return_value=1000.0):
+            policy.record("openai_primary", 5.0, False)
+            policy.record("anthropic_primary", 1.0, True)
+            self.assertEqual(policy.order(names), ["anthropic_primary", "openai_primary"])
+        with patch('stable_llm_service.time.time', return_value=1000.0 + 200):
+            # 陈旧的统计几乎完全衰减，一次新的成功样本即可让恢复的服务重新排在前面
+            policy.record("openai_primary", 0.5, True)
+            policy.record("anthropic_primary", 1.0, True)
+            self.assertEqual(policy.order(names), names)
+    
+    def test_exploration(self):
+        """测试探索流量把非最优服务排到最前"""
+        rng = MagicMock()
+        rng.random.return_value = 0.0
+        rng.randrange.return_value = 2
+        policy = LatencyAwarePolicy(exploration=0.1, rng=rng)
+        names = ["a", "b", "c"]
+        self.assertEqual(policy.order(names), ["c", "a", "b"])
+        self.assertEqual(policy.explorations, 1)
+    
+    @patch('stable_llm_service.ServiceFactory.create_service')
+    def test_service_routes_to_faster_provider(self, mock_create_service):
+        """测试启用策略后请求被路由到更快的服务"""
+        slow_service = MagicMock()
+        slow_service.chat.side_effect = lambda prompt: time.sleep(0.05) or {"raw_content": "slow"}
+        fast_service = MagicMock()
+        fast_service.chat.return_value = {"raw_content": "fast"}
+        mock_create_service.side_effect = lambda config: (
+            slow_service if config.provider == "openai" else fast_service
+        )
+        
+        with StableLLMService(
+            openai_api_key="k1",
+            anthropic_api_key="k2",
+            service_order=["openai", "anthropic"],
+            routing_policy=LatencyAwarePolicy(exploration=0)
+        ) as service:
+            self.assertEqual(service.chat("hi")["raw_content"], "slow")
+            # anthropic_primary尚无样本，按乐观估计优先尝试
+            self.assertEqual(service.chat("hi")["raw_content"], "fast")
+            self.assertEqual(service.chat("hi")["raw_content"], "fast")
+            self.assertIn("ewma_latency", service.get_service_status()["openai_primary"]["routing"])
+
+class TestLoadBalancing(CleanEnvMixin, unittest.TestCase):
+    """测试主要服务层级的负载均衡"""
+    
+    def test_weighted_share_follows_quotas(self):
+        """测试首选比例与配额推导的权重成正比，备用层级保持静态顺序"""
+        import random
+        policy = LoadBalancingPolicy.from_quotas(
+            {"openai": {"rpm": 300}, "anthropic": {"rpm": 1000, "tpm": 100000}},
+            tokens_per_request=1000,
+            rng=random.Random(42)
+        )
+        policy.bind({"openai_primary": "openai", "anthropic_primary": "anthropic"})
+        self.assertEqual(policy.weight("openai_primary"), 300)
+        self.assertEqual(policy.weight("anthropic_primary"), 100)
+        
+        names = ["openai_primary", "anthropic_primary"]
+        for _ in range(4000):
+            policy.order(names)
+        share = policy.selected["openai_primary"] / 4000
+        self.assertAlmostEqual(share, 0.75, delta=0.03)
+        
+        fallback = ["openai_fallback", "anthropic_fallback"]
+        self.assertEqual(policy.order(fallback, "fallback"), fallback)
+    
+    def test_least_outstanding(self):
+        """测试优先选择相对权重进行中调用数最少的服务"""
+        policy = LoadBalancingPolicy(weights={"a": 2.0, "b": 1.0}, strategy="least_outstanding")
+        for _ in range(3):
+            policy.on_call_start("a")
+        policy.on_call_start("b")
+        self.assertEqual(policy.order(["a", "b"]), ["b", "a"])  # 3/2 > 1/1
+        policy.on_call_end("a")
+        policy.on_call_end("a")
+        self.assertEqual(policy.order(["a", "b"]), ["a", "b"])  # 1/2 < 1/1
+        self.assertEqual(policy.snapshot("a")["outstanding"], 1)
+    
+    def test_provider_weights_follow_routing_plan(self):
+        """测试提供商权重按路由计划中的提供商匹配，自定义服务名称同样生效"""
+        plan = (
+            RoutingTier("primary", (
+                RouteEntry("openai", "gpt-4o", name="gpt4o"),
+                RouteEntry("anthropic", "claude-3-7-sonnet-20250219", name="claude_sonnet"),
+            )),
+        )
+        policy = LoadBalancingPolicy.from_quotas({"openai": {"rpm": 300}, "anthropic": {"rpm": 100}})
+        with StableLLMService(
+            openai_api_key="k1",
+            anthropic_api_key="k2",
+            routing_plan=plan,
+            routing_policy=policy
+        ) as service:
+            self.assertEqual(policy.weight("gpt4o"), 300)
+            self.assertEqual(policy.weight("claude_sonnet"), 100)
+            self.assertEqual(service.get_service_status()["claude_sonnet"]["routing"]["weight"], 100)
+    
+    @patch('stable_llm_service.ServiceFactory.create_service')
+    def test_requests_spread_across_primary_tier(self, mock_create_service):
+        """测试请求分摊到所有主要服务，调用结束后进行中计数归零"""
+        def create(config):
+            service = MagicMock()
+            service.chat.return_value = {"raw_content": config.provider}
+            return service
+        mock_create_service.side_effect = create
+        
+        with StableLLMService(
+            openai_api_key="k1",
+            anthropic_api_key="k2",
+            routing_policy="weighted"
+        ) as service:
+            results = service.chat_many(["hi"] * 40, concurrency=4)
+            providers = {result["raw_content"] for result in results}
+            self.assertEqual(providers, {"openai", "anthropic"})
+            
+            # 进行中计数在调用线程的完成回调中递减，稍作等待
+            deadline = time.time() + 1.0
+            while service.routing_policy.outstanding.get("openai_primary") and time.time() < deadline:
+                time.sleep(0.01)
+            status = service.get_service_status()
+            self.assertEqual(status["openai_primary"]["routing"]["outstanding"], 0)
+            self.assertEqual(
+                status["openai_primary"]["routing"]["selected"] + status["anthropic_primary"]["routing"]["selected"],
+                40
+            )
+
+class TestBatchAPI(CleanEnvMixin, unittest.TestCase):
+    """测试批量接口chat_many/analyze_many"""
+    
+    @patch('stable_llm_service.ServiceFactory.create_service')
+    def test_chat_many_preserves_order(self, mock_create_service):
+        """测试结果按输入顺序返回，失败项返回错误字典"""
+        def chat(prompt):
+            if prompt == "bad":
+                raise Exception("boom")
+            time.sleep(0.01 * (5 - int(prompt)))
+            return {"raw_content": prompt}
+        
+        mock_service = MagicMock()
+        mock_service.chat.side_effect = chat
+        mock_create_service.return_value = mock_service
+        
+        with StableLLMService(openai_api_key="k1", max_workers=4) as service:
+            prompts = ["0", "1", "bad", "3", "4"]
+            results = service.chat_many(prompts, concurrency=4)
+        
+        self.assertEqual(len(results), 5)
+        self.assertEqual([r.get("raw_content") for r in results[:2]], ["0", "1"])
+        self.assertEqual([r.get("raw_content") for r in results[3:]], ["3", "4"])
+        self.assertIn("error", results[2])
+        self.assertIn("details", results[2])
+    
+    @patch('stable_llm_service.ServiceFactory.create_service')
+    def test_chat_many_as_completed_bounds_concurrency(self, mock_create_service):
+        """测试as_completed迭代器和并发上限"""
+        lock = threading.Lock()
+        state = {"active": 0, "peak": 0}
+        
+        def chat(prompt):
+            with lock:
+                state["active"] += 1
+                state["peak"] = max(state["peak"], state["active"])
+            time.sleep(0.01)
+            with lock:
+                state["active"] -= 1
+            return {"raw_content": prompt}
+        
+        mock_service = MagicMock()
+        mock_service.chat.side_effect = chat
+        mock_create_service.return_value = mock_service
+        
+        with StableLLMService(openai_api_key="k1", max_workers=8) as service:
+            pairs = list(service.chat_many((str(i) for i in range(20)), concurrency=3, as_completed=True))
+        
+        self.assertEqual(sorted(index for index, _ in pairs), list(range(20)))
+        for index, result in pairs:
+            self.assertEqual(result["raw_content"], str(index))
+        self.assertLessEqual(state["peak"], 3)
+    
+    def test_concurrency_limited_by_calls_per_request(self):
+        """测试竞速时按每个请求占用的线程数限制并发"""
+        lock = threading.Lock()
+        state = {"active": 0, "peak": 0}
+        
+        def call_service(method_name, *args, race=1):
+            with lock:
+                state["active"] += 1
+                state["peak"] = max(state["peak"], state["active"])
+            time.sleep(0.01)
+            with lock:
+                state["active"] -= 1
+            return {"raw_content": args[0]}
+        
+        with StableLLMService(openai_api_key="k1", max_workers=4) as service:
+            with patch.object(service, "_call_service", side_effect=call_service):
+                results = service.chat_many([str(i) for i in range(12)], concurrency=8, race=2)
+        
+        self.assertEqual([result["raw_content"] for result in results], [str(i) for i in range(12)])
+        self.assertLessEqual(state["peak"], 2)
+    
+    @patch('stable_llm_service.ServiceFactory.create_service')
+    def test_analyze_many_bad_image_fails_only_its_item(self, mock_create_service):
+        """测试单个图像无法读取时只有该请求返回错误字典"""
+        mock_service = MagicMock()
+        mock_service.analyze.return_value = {"raw_content": "ok"}
+        mock_create_service.return_value = mock_service
+        
+        jpeg = b"\xff\xd8\xff\xe0" + b"\x00" * 32
+        with StableLLMService(openai_api_key="k1") as service:
+            results = service.analyze_many([
+                ("a", jpeg),
+                ("b", "/nonexistent/photo.jpg"),
+                ("c", b"not an image"),
+                ("d", [jpeg, jpeg])
+            ])
+        
+        self.assertEqual(results[0]["raw_content"], "ok")
+        self.assertIn("error", results[1])
+        self.assertIn("error", results[2])
+        self.assertEqual(results[3]["raw_content"], "ok")
+        self.assertEqual(mock_service.analyze.call_count, 2)
+
+class TestResponseCache(CleanEnvMixin, unittest.TestCase):
+    """测试响应缓存"""
+    
+    def test_lru_eviction_and_ttl(self):
+        """测试LRU淘汰和TTL过期"""
+        cache = ResponseCache(ttl=60.0, max_entries=2)
+        cache.put("a", {"raw_content": "A"})
+        cache.put("b", {"raw_content": "B"})
+        self.assertEqual(cache.get("a")["raw_content"], "A")  # a变为最近使用
+        cache.put("c", {"raw_content": "C"})  # 淘汰b
+        
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("a"))
+        self.assertEqual(cache.stats()["evictions"], 1)
+        
+        with patch('stable_llm_service.time.time', return_value=time.time() + 61):
+            self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()["expirations"], 1)
+    
+    def test_max_bytes(self):
+        """测试按字节数限制容量"""
+        cache = ResponseCache(max_bytes=100)
+        cache.put("a", {"raw_content": "x" * 40})
+        cache.put("b", {"raw_content": "y" * 40})
+        
+        self.assertIsNone(cache.get("a"))
+        self.assertIsNotNone(cache.get("b"))
+        self.assertLessEqual(cache.stats()["bytes"], 100)
+    
+    def test_key_normalization(self):
+        """测试缓存键对提示词首尾空白不敏感，对生成参数敏感"""
+        key = ResponseCache.make_key("chat", "hello", None, 0.0, 100)
+        self.assertEqual(key, ResponseCache.make_key("chat", "  hello\n", None, 0.0, 100))
+        self.assertNotEqual(key, ResponseCache.make_key("chat", "hello", None, 0.5, 100))
+        self.assertNotEqual(key, ResponseCache.make_key("analyze", "hello", "digest", 0.0, 100))
+    
+    @patch('stable_llm_service.ServiceFactory.create_service')
+    def test_cached_chat_skips_provider(self, mock_create_service):
+        """测试重复请求命中缓存，不再调用服务"""
+        mock_service = MagicMock()
+        mock_service.chat.return_value = {"raw_content": "answer"}
+        mock_create_service.return_value = mock_service
+        
+        cache = ResponseCache()
+        with StableLLMService(openai_api_key="k1", temperature=0.0, cache=cache) as service:
+            first = service.chat("What is 1+1?")
+            second = service.chat("What is 1+1?")
+        
+        self.assertNotIn("cached", first)
+        self.assertTrue(second["cached"])
+        self.assertEqual(second["raw_content"], "answer")
+        self.assertEqual(mock_service.chat.call_count, 1)
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(service.configs["openai_primary"].temperature, 0.0)
+
+class TestSQLiteResponseCache(unittest.TestCase):
+    """测试磁盘响应缓存"""
+    
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "cache.db")
+    
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    
+    def test_shared_between_instances_and_processes(self):
+        """测试多个实例和进程共享同一个缓存文件"""
+        writer = SQLiteResponseCache(self.path)
+        writer.put("a", {"raw_content": "A"})
+        
+        reader = SQLiteResponseCache(self.path)
+        self.assertEqual(reader.get("a"), {"raw_content": "A"})
+        self.assertIsNone(reader.get("missing"))
+        
+        # 另一个进程写入的条目对当前进程可见
+        code = (
+            "import sys; sys.path.insert(0, sys.argv[1]);"
+            "import logging; logging.disable(logging.CRITICAL);"
+            "from stable_llm_service import SQLiteResponseCache;"
+            "SQLiteResponseCache(sys.argv[2]).put('b', {'raw_content': 'B'})"
+        )
+        root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+        subprocess.run([sys.executable, "-c", code, root, self.path], check=True)
+        self.assertEqual(reader.get("b"), {"raw_content": "B"})
+        
+        stats = reader.stats()
+        self.assertEqual(stats["entries"], 2)
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(stats["misses"], 1)
+        writer.close()
+        reader.close()
+    
+    def test_eviction_and_ttl(self):
+        """测试按条目数淘汰最久未使用的条目和TTL过期"""
+        cache = SQLiteResponseCache(self.path, ttl=60.0, max_entries=2, touch_interval=0.0)
+        cache.put("a", {"raw_content": "A"})
+        time.sleep(0.01)
+        cache.put("b", {"raw_content": "B"})
+        time.sleep(0.01)
+        cache.get("a")  # a变为最近使用
+        cache.put("c", {"raw_content": "C"})
+        
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("a"))
+        self.assertEqual(cache.stats()["evictions"], 1)
+        
+        with patch('stable_llm_service.time.time', return_value=time.time() + 61):
+            self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()["expirations"], 1)
+        cache.close()
+    
+    def test_totals_maintained_without_scanning(self):
+        """测试条目数和字节数在覆盖写入、过期、清空后保持准确，旧缓存文件按现有数据初始化计数"""
+        import sqlite3
+        conn = sqlite3.connect(self.path)
+        conn.execute(
+            "CREATE TABLE responses (key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+            "size INTEGER NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        conn.execute("INSERT INTO responses VALUES ('old', '{}', 2, ?, ?)", (time.time() + 60, time.time()))
+        conn.commit()
+        conn.close()
+        
+        cache = SQLiteResponseCache(self.path, ttl=60.0)
+        self.assertEqual((cache.stats()["entries"], cache.stats()["bytes"]), (1, 2))
+        cache.put("a", {"raw_content": "A"})
+        cache.put("a", {"raw_content": "AAAA"})  # 覆盖写入只更新字节数
+        expected = 2 + len('{"raw_content": "AAAA"}')
+        self.assertEqual((cache.stats()["entries"], cache.stats()["bytes"]), (2, expected))
+        
+        with patch('stable_llm_service.time.time', return_value=time.time() + 61):
+            self.assertIsNone(cache.get("a"))
+        self.assertEqual((cache.stats()["entries"], cache.stats()["bytes"]), (1, 2))
+        cache.clear()
+        self.assertEqual((cache.stats()["entries"], cache.stats()["bytes"]), (0, 0))
+        cache.close()
+
+class TestPreparedImage(CleanEnvMixin, unittest.TestCase):
+    """测试图像只编码一次"""
+    
+    def setUp(self):
+        super().setUp()
+        PreparedImage.clear_memo()
+    
+    @patch('stable_llm_service.anthropic', create=True)
+    @patch('stable_llm_service.openai', create=True)
+    def test_image_encoded_once_across_failover(self, mock_openai, mock_anthropic):
+        """测试故障转移链中的所有尝试共享同一份编码结果"""
+        mock_openai.OpenAI.return_value.chat.completions.create.side_effect = Exception("boom")
+        response = MagicMock()
+        response.content[0].text = "a cat"
+        mock_anthropic.Anthropic.return_value.messages.create.return_value = response
+        
+        image = FakeImage()
+        with StableLLMService(
+            openai_api_key="k1",
+            anthropic_api_key="k2",
+            service_order=["openai", "anthropic"]
+        ) as service:
+            result = service.analyze("describe", image)
+        
+        self.assertEqual(result["raw_content"], "a cat")
+        # openai_primary 失败后由 anthropic_primary 成功，只编码一次
+        self.assertEqual(mock_openai.OpenAI.return_value.chat.completions.create.call_count, 1)
+        self.assertEqual(image.save_count, 1)
+        
+        request = mock_anthropic.Anthropic.return_value.messages.create.call_args.kwargs
+        data = request["messages"][0]["content"][1]["source"]["data"]
+        self.assertEqual(data, PreparedImage(image).encoded_for("anthropic").base64_data)
+        self.assertEqual(result["image_metadata"]["format"], "JPEG")
+    
+    def test_memo_skips_reencoding_repeat_images(self):
+        """测试相同内容的图像跨请求复用编码结果"""
+        first = FakeImage(b"same")
+        second = FakeImage(b"same")
+        other = FakeImage(b"other")
+        
+        encoded = PreparedImage(first).encoded_for("openai")
+        self.assertEqual(PreparedImage(second).encoded_for("openai"), encoded)
+        self.assertEqual(second.save_count, 0)
+        self.assertNotEqual(PreparedImage(other).encoded_for("openai"), encoded)
+        self.assertEqual(other.save_count, 1)
+    
+    def test_provider_target_size(self):
+        """测试按提供商的有效分辨率缩小图像，且不放大小图"""
+        photo = PreparedImage(FakeImage(size=(4000, 3000)))
+        self.assertEqual(photo.target_size("openai"), (1024, 768))
+        self.assertEqual(photo.target_size("anthropic"), (1568, 1176))
+        self.assertEqual(photo.target_size("gemini"), (3072, 2304))
+        
+        small = PreparedImage(FakeImage(size=(300, 200)))
+        self.assertEqual(small.target_size("openai"), (300, 200))
+        
+        original = PreparedImage(FakeImage(size=(4000, 3000)), downscale=False)
+        self.assertEqual(original.target_size("openai"), (4000, 3000))
+    
+    def test_format_selection_and_metadata(self):
+        """测试按内容选择编码格式并报告元数据"""
+        photo = FakeImage(size=(4000, 3000))
+        encoded = PreparedImage(photo, quality=70).encoded_for("anthropic")
+        self.assertEqual(encoded.media_type, "image/jpeg")
+        self.assertEqual(photo.save_count, 0)  # 编码的是缩小后的图像
+        self.assertEqual(encoded.metadata["sent_size"], [1568, 1176])
+        self.assertEqual(encoded.metadata["original_bytes"], 4000 * 3000 * 3)
+        self.assertGreater(encoded.metadata["bytes_saved"], 0)
+        
+        transparent = PreparedImage(FakeImage(b"rgba", mode="RGBA"))
+        self.assertEqual(transparent.encoded_for("openai").media_type, "image/png")
+        
+        chart = PreparedImage(FakeImage(b"chart", colors=[(10, (0, 0, 0))]))
+        self.assertEqual(chart.encoded_for("openai").media_type, "image/png")
+        
+        forced = FakeImage(b"forced")
+        PreparedImage(forced, image_format="WEBP", quality=60).encoded_for("openai")
+        self.assertEqual(forced.saved_formats, [("WEBP", {"quality": 60})])
+
+class TestImageInputs(unittest.TestCase):
+    """测试analyze接受已编码数据、文件路径和URL"""
+    
+    JPEG_BYTES = b"\xff\xd8\xff\xe0" + b"\x00" * 32
+    
+    def setUp(self):
+        PreparedImage.clear_memo()
+    
+    def test_bytes_and_memoryview_pass_through(self):
+        """测试提供商可接受的格式直接上传，不解码"""
+        for source in (self.JPEG_BYTES, memoryview(self.JPEG_BYTES)):
+            encoded = PreparedImage(source, downscale=False).encoded_for("anthropic")
+            self.assertEqual(encoded.media_type, "image/jpeg")
+            self.assertEqual(bytes(encoded.data), self.JPEG_BYTES)
+            self.assertTrue(encoded.metadata["passthrough"])
+    
+    def test_pass_through_without_pil(self):
+        """测试未安装PIL时默认配置(downscale=True)下已编码数据直接上传"""
+        import stable_llm_service
+        with patch.dict(sys.modules, {"PIL": None, "PIL.Image": None}), \
+                patch.object(stable_llm_service, "Image", None):
+            encoded = PreparedImage(self.JPEG_BYTES).encoded_for("openai")
+            self.assertEqual(bytes(encoded.data), self.JPEG_BYTES)
+            self.assertTrue(encoded.metadata["passthrough"])
+            
+            # 需要重新编码的格式无法处理，按请求错误处理
+            bmp = PreparedImage(b"BM" + b"\x00" * 32, image_format="PNG")
+            with self.assertRaises(LLMServiceError) as ctx:
+                BaseLLMService._encode_images(MagicMock(provider="openai"), bmp)
+            self.assertIs(ctx.exception.category, ErrorCategory.INVALID_REQUEST)
+    
+    def test_file_path_read_via_mmap(self):
+        """测试文件路径通过mmap读取后直接上传"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "photo.jpg")
+            with open(path, "wb") as f:
+                f.write(self.JPEG_BYTES)
+            
+            prepared = PreparedImage(path, downscale=False)
+            encoded = prepared.encoded_for("openai")
+            self.assertEqual(bytes(encoded.data), self.JPEG_BYTES)
+            self.assertEqual(prepared.digest, PreparedImage(self.JPEG_BYTES).digest)
+            del encoded, prepared
+    
+    def test_url_passed_to_openai_and_fetched_for_gemini(self):
+        """测试URL直接传给支持的提供商，其余提供商下载后上传"""
+        url = "https://example.com/cat.jpg"
+        prepared = PreparedImage(url, downscale=False)
+        self.assertEqual(prepared.encoded_for("openai").url, url)
+        
+        response = MagicMock()
+        response.__enter__.return_value.read.return_value = self.JPEG_BYTES
+        with patch('urllib.request.urlopen', return_value=response) as urlopen:
+            encoded = prepared.encoded_for("gemini")
+            prepared.encoded_for("gemini")
+        
+        urlopen.assert_called_once()
+        self.assertIsNone(encoded.url)
+        self.assertEqual(bytes(encoded.data), self.JPEG_BYTES)
+    
+    @patch('stable_llm_service.Image', create=True)
+    def test_unsupported_format_is_transcoded(self, mock_image):
+        """测试提供商不接受的格式才用PIL解码并重新编码"""
+        gif_bytes = b"GIF89a" + b"\x00" * 32
+        decoded = FakeImage(b"gif", colors=[(1, (0, 0, 0))])
+        mock_image.open.return_value = decoded
+        
+        prepared = PreparedImage(gif_bytes)
+        self.assertTrue(prepared.encoded_for("openai").metadata["passthrough"])
+        mock_image.open.assert_called_once()  # 只读取文件头以获取尺寸
+        self.assertEqual(decoded.save_count, 0)
+        
+        encoded = prepared.encoded_for("gemini")
+        self.assertEqual(encoded.media_type, "image/png")
+        self.assertEqual(encoded.metadata["original_bytes"], len(gif_bytes))
+        self.assertEqual(decoded.save_count, 1)
+    
+    @patch('stable_llm_service.ServiceFactory.create_service')
+    def test_invalid_image_rejected_before_calling_services(self, mock_create_service):
+        """测试无法识别的图像在调用服务前报错，下载失败只调用一次服务且不计入失败"""
+        import urllib.error
+        with StableLLMService(openai_api_key="k", gemini_api_key="k", service_order=["openai"]) as service:
+            with self.assertRaises(ValueError):
+                service.analyze("what", b"not an image at all")
+            with tempfile.NamedTemporaryFile(suffix=".jpg") as empty:
+                with self.assertRaises(ValueError):
+                    service.analyze("what", empty.name)
+            mock_create_service.assert_not_called()
+        
+        class EncodingService(BaseLLMService):
+            def analyze(self, prompt, image):
+                return {"raw_content": str(self._encode_images(image))}
+        mock_create_service.side_effect = EncodingService
+        
+        with StableLLMService(gemini_api_key="k", service_order=["gemini"]) as service:
+            with patch('urllib.request.urlopen', side_effect=urllib.error.URLError("unreachable")):
+                result = service.analyze("what", "https://example.com/missing.jpg")
+            self.assertEqual(len(result["details"]), 1)
+            self.assertEqual(result["details"][0]["category"], "invalid_request")
+            self.assertEqual(service.health_monitor.failure_count("gemini_primary"), 0)
+
+class TestMultiImage(CleanEnvMixin, unittest.TestCase):
+    """测试多图像分析"""
+    
+    def setUp(self):
+        super().setUp()
+        PreparedImage.clear_memo()
+    
+    @patch('stable_llm_service.anthropic', create=True)
+    @patch('stable_llm_service.openai', create=True)
+    def test_images_sent_in_order_with_metadata(self, mock_openai, mock_anthropic):
+        """测试多张图像按顺序放入同一请求，每张图像只编码一次"""
+        response = MagicMock()
+        response.content[0].text = "two cats"
+        mock_anthropic.Anthropic.return_value.messages.create.return_value = response
+        
+        images = [FakeImage(b"first"), FakeImage(b"second"), FakeImage(b"third")]
+        with StableLLMService(anthropic_api_key="k", service_order=["anthropic"]) as service:
+            result = service.analyze("compare", images=images)
+        
+        content = mock_anthropic.Anthropic.return_value.messages.create.call_args.kwargs["messages"][0]["content"]
+        self.assertEqual([part["type"] for part in content], ["text", "image", "image", "image"])
+        self.assertEqual(
+            [part["source"]["data"] for part in content[1:]],
+            [PreparedImage(image).encoded_for("anthropic").base64_data for image in images]
+        )
+        self.assertEqual([image.save_count for image in images], [1, 1, 1])
+        self.assertEqual(len(result["image_metadata"]), 3)
+    
+    @patch('stable_llm_service.anthropic', create=True)
+    @patch('stable_llm_service.openai', create=True)
+    def test_provider_over_image_limit_skipped(self, mock_openai, mock_anthropic):
+        """测试图像数量超出上限的提供商被跳过且不计入失败"""
+        response = MagicMock()
+        response.content[0].text = "many"
+        mock_anthropic.Anthropic.return_value.messages.create.return_value = response
+        
+        images = [FakeImage(bytes([i])) for i in range(12)]
+        with StableLLMService(
+            openai_api_key="k1",
+            anthropic_api_key="k2",
+            service_order=["openai", "anthropic"]
+        ) as service:
+            result = service.analyze("count", images=images)
+            failures = service.health_monitor.failure_counts
+        
+        self.assertEqual(result["raw_content"], "many")
+        mock_openai.OpenAI.return_value.chat.completions.create.assert_not_called()
+        self.assertEqual(failures.get("openai_primary", 0), 0)
+    
+    @patch('stable_llm_service.ServiceFactory.create_service')
+    def test_image_and_images_are_exclusive(self, mock_create_service):
+        """测试image与images必须且只能提供一个"""
+        with StableLLMService(openai_api_key="k", service_order=["openai"]) as service:
+            with self.assertRaises(ValueError):
+                service.analyze("x")
+            with self.assertRaises(ValueError):
+                service.analyze("x", FakeImage(), images=[FakeImage()])
+
+class TestLazyImports(unittest.TestCase):
+    """测试提供商SDK和PIL延迟导入"""
+    
+    def test_import_has_no_side_effects(self):
+        """测试导入模块时不加载SDK/PIL/asyncio，也不配置日志"""
+        script = (
+            "import sys, logging, stable_llm_service; "
+            "heavy = ('openai', 'anthropic', 'google.generativeai', 'PIL', 'dotenv', 'asyncio'); "
+            "print([m for m in heavy if m in sys.modules], len(logging.getLogger().handlers))"
+        )
+        result = subprocess.run(
+            [sys.executable, "-c", script],
+            cwd=os.path.join(os.path.dirname(__file__), '..'),
+            capture_output=True, text=True, check=True
+        )
+        self.assertEqual(result.stdout.strip(), "[] 0")
+    
+    def test_sdk_imported_when_service_built(self):
+        """测试首次构建服务时才导入对应SDK"""
+        import stable_llm_service
+        fake_openai = MagicMock()
+        with patch.dict(sys.modules, {"openai": fake_openai}), \
+                patch.object(stable_llm_service, "openai", None):
+            from stable_llm_service import LLMServiceConfig, OpenAIService
+            service = OpenAIService(LLMServiceConfig("openai", "gpt-4o", "k"))
+            self.assertIs(service.client, fake_openai.OpenAI.return_value)
+            self.assertIs(stable_llm_service.openai, fake_openai)
+    
+    def test_missing_sdk_raises_import_error(self):
+        """测试SDK未安装时给出安装提示"""
+        import stable_llm_service
+        with patch.dict(sys.modules, {"anthropic": None}), \
+                patch.object(stable_llm_service, "anthropic", None):
+            with self.assertRaisesRegex(ImportError, "pip install anthropic"):
+                stable_llm_service._lazy_import("anthropic")
+
+class TestAsyncAPI(CleanEnvMixin, unittest.IsolatedAsyncioTestCase):
+    """测试异步接口achat/aanalyze"""
+    
+    @patch('stable_llm_service.ServiceFactory.create_service')
+    async def test_achat_fails_over_and_cancels_hung_call(self, mock_create_service):
+        """测试异步超时后取消挂起请求并切换到下一个服务"""
+        cancelled = asyncio.Event()
+        
+        async def hang(prompt):
+            try:
+                await asyncio.sleep(5.0)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+        
+        hung_service = MagicMock()
+        hung_service.achat = hang
+        fast_service = MagicMock()
+        fast_service.achat = AsyncMock(return_value={"raw_content": "fast"})
+        
+        mock_create_service.side_effect = lambda config: (
+            hung_service if config.provider == "openai" else fast_service
+        )
+        
+        service = StableLLMService(
+            openai_api_key="k1",
+            anthropic_api_key="k2",
+            service_timeout=0.05,
+            service_order=["openai", "anthropic"],
+            health_monitor=ServiceHealthMonitor(slow_call_threshold=0.04, slow_call_rate_threshold=1.0)
+        )
+        
+        result = await service.achat("hi")
+        
+        self.assertEqual(result["raw_content"], "fast")
+        self.assertTrue(cancelled.is_set())
+        # 超时只计一次失败，且按实际耗时计为慢调用
+        self.assertEqual(service.health_monitor.failure_counts["openai_primary"], 1)
+        window = service.health_monitor.snapshot("openai_primary")["window"]
+        self.assertEqual((window["calls"], window["slow_call_rate"]), (1, 1.0))
+        service.close()
+    
+    @patch('stable_llm_service.ServiceFactory.create_service')
+    async def test_achat_all_failed(self, mock_create_service):
+        """测试所有服务失败时返回错误字典"""
+        failing_service = MagicMock()
+        failing_service.achat = AsyncMock(side_effect=Exception("boom"))
+        mock_create_service.return_value = failing_service
+        
+        async with StableLLMService(openai_api_key="k1") as service:
+            result = await service.achat("hi")
         
-        # 验证失败被记录
-        health_monitor_spy.record_failure.assert_called_once_with("openai_primary")
+        self.assertIn("error", result)
+        self.assertEqual(len(result["details"]), 2)
 
 if __name__ == '__main__':
     unittest.main() 
\ No newline at end of file